@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Load-generation benchmark for the Stock Inspirations app.
+
+Runs the app in-process against fake model backends (no GPU calls) and drives
+it over HTTP at a fixed request rate with a cap on in-flight requests.
+Prints a JSON report with latency percentiles, throughput, error rates and
+per-mode / per-inspiration breakdowns.
+
+Examples:
+    python benchmark.py --rps 20 --duration 30 --concurrency 16
+    python benchmark.py --mix marketplace_pure=3,creative_color_material=1 --output bench.json
+    python benchmark.py --baseline bench.json --max-regression 0.10
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from stock_inspirations_app import (
+    INSPIRATIONS,
+    StockInspirations,
+    install_fake_backends,
+)
+
+DEFAULT_MIX = "marketplace_pure=3,creative_color_material=2,creative_worms_eye_full=1,creative_fuse_images=1"
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """Parse 'name=weight,name=weight' into a weight per inspiration."""
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.strip().partition("=")
+        if name not in INSPIRATIONS:
+            raise SystemExit(f"Unknown inspiration in --mix: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Percentile with linear interpolation between closest ranks."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(samples: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+    """Aggregate request samples into a report section."""
+    latencies = [s["latency"] for s in samples if s["ok"]]
+    errors = sum(1 for s in samples if not s["ok"])
+    return {
+        "requests": len(samples),
+        "successes": len(samples) - errors,
+        "errors": errors,
+        "error_rate": errors / len(samples) if samples else 0.0,
+        "throughput_rps": (len(samples) - errors) / elapsed if elapsed else 0.0,
+        "latency": {
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies) if latencies else None
+        },
+        "status_codes": dict(Counter(str(s["status"]) for s in samples))
+    }
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    """Start the app in-process and drive it at the configured rate."""
+    install_fake_backends(
+        latency_median=args.latency,
+        latency_sigma=args.sigma,
+        submit_latency=args.submit_latency,
+        failure_rate=args.failure_rate,
+        seed=args.seed
+    )
+    mix = parse_mix(args.mix)
+    names = list(mix)
+    weights = [mix[n] for n in names]
+    rng = random.Random(args.seed)
+    total = args.requests or int(args.rps * args.duration)
+
+    app = StockInspirations(_allow_init=True)._build_app()
+    in_flight = asyncio.Semaphore(args.concurrency)
+    samples: List[Dict[str, Any]] = []
+
+    async def one_request(client: httpx.AsyncClient, name: str, seq: int, scheduled: float) -> None:
+        inspiration = INSPIRATIONS[name]
+        payload = {
+            "inspiration_name": name,
+            "image_urls": [f"https://bench.local/{seq}/{i}.jpg" for i in range(inspiration["min_images"])],
+            "use_cache": args.use_cache,
+            # Benchmark URLs are placeholders; the fake backends never fetch them
+            "validate_images": False
+        }
+        # Latency counts from the scheduled send time, so time spent waiting for an
+        # in-flight slot (or behind a stalled event loop) is not omitted
+        async with in_flight:
+            # The planner may switch modes; successful responses report the one used
+            mode = inspiration.get("execution_mode", "batch")
+            try:
+                response = await client.post("/", json=payload)
+                status = response.status_code
+                if status == 200:
+                    mode = response.json()["execution_mode"]
+            except Exception:
+                status = "exception"
+            samples.append({
+                "inspiration": name,
+                "mode": mode,
+                "status": status,
+                "ok": status == 200,
+                "latency": time.perf_counter() - scheduled
+            })
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            tasks = []
+            start = time.perf_counter()
+            for seq in range(total):
+                # Open-loop arrivals: requests are issued on schedule even if earlier ones are slow
+                scheduled = start + seq / args.rps
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                name = rng.choices(names, weights)[0]
+                tasks.append(asyncio.create_task(one_request(client, name, seq, scheduled)))
+            await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - start
+
+    by_mode = defaultdict(list)
+    by_inspiration = defaultdict(list)
+    for sample in samples:
+        by_mode[sample["mode"]].append(sample)
+        by_inspiration[sample["inspiration"]].append(sample)
+
+    return {
+        "config": {
+            "rps": args.rps,
+            "requests": total,
+            "concurrency": args.concurrency,
+            "mix": mix,
+            "use_cache": args.use_cache,
+            "fake_backend": {
+                "latency_median": args.latency,
+                "latency_sigma": args.sigma,
+                "submit_latency": args.submit_latency,
+                "failure_rate": args.failure_rate,
+                "seed": args.seed
+            }
+        },
+        "elapsed": elapsed,
+        "overall": summarize(samples, elapsed),
+        "by_mode": {mode: summarize(s, elapsed) for mode, s in sorted(by_mode.items())},
+        "by_inspiration": {name: summarize(s, elapsed) for name, s in sorted(by_inspiration.items())}
+    }
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> List[str]:
+    """List regressions of report against baseline beyond max_regression (fraction)."""
+    regressions = []
+    for pct in ("p50", "p95", "p99"):
+        new = report["overall"]["latency"][pct]
+        old = baseline["overall"]["latency"][pct]
+        if new is not None and old and new > old * (1 + max_regression):
+            regressions.append(f"{pct} latency {old:.3f}s -> {new:.3f}s")
+    new_tp = report["overall"]["throughput_rps"]
+    old_tp = baseline["overall"]["throughput_rps"]
+    if old_tp and new_tp < old_tp * (1 - max_regression):
+        regressions.append(f"throughput {old_tp:.2f} -> {new_tp:.2f} req/s")
+    new_err = report["overall"]["error_rate"]
+    old_err = baseline["overall"]["error_rate"]
+    if new_err > old_err + max_regression:
+        regressions.append(f"error rate {old_err:.1%} -> {new_err:.1%}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the Stock Inspirations app against fake backends")
+    parser.add_argument("--rps", type=float, default=10.0, help="Request arrival rate (requests/second)")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of arrivals (ignored with --requests)")
+    parser.add_argument("--requests", type=int, default=0, help="Total requests to send")
+    parser.add_argument("--concurrency", type=int, default=32, help="Max requests in flight")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Inspiration weights, e.g. 'marketplace_pure=3,creative_color_material=1'")
+    parser.add_argument("--use-cache", action="store_true", help="Allow result cache hits (off by default)")
+    parser.add_argument("--latency", type=float, default=1.0, help="Fake backend median job latency (s)")
+    parser.add_argument("--sigma", type=float, default=0.25, help="Fake backend log-normal latency shape")
+    parser.add_argument("--submit-latency", type=float, default=0.05, help="Fake backend submit round trip (s)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fake backend job failure probability")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for arrivals and fake backend")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    parser.add_argument("--baseline", help="Compare against a previous JSON report")
+    parser.add_argument("--max-regression", type=float, default=0.10, help="Allowed regression fraction vs baseline")
+    args = parser.parse_args()
+
+    # App request logs go to stderr so stdout stays valid JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        report = asyncio.run(run_benchmark(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
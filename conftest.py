@@ -0,0 +1,3 @@
+# test_deployed_endpoint.py is a manual script against the live deployment
+# (needs FAL_KEY and network access), not part of the unit test suite.
+collect_ignore = ["test_deployed_endpoint.py"]
@@ -1,17 +1,36 @@
 """
 Stock Image Inspirations - FAL Serverless App
 A blackbox service that applies fixed inspirations to images.
-Always generates 3 images per request.
+Generates 3 images per request by default (1-12 on request).
 Self-contained version with embedded configuration.
 """
 
+import io
+import os
+import json
+import math
+import random
 import uuid
 import time
 import asyncio
-from typing import List, Optional, Dict, Any, Literal, get_args
-from pydantic import BaseModel, Field
+import hashlib
+import heapq
+import ipaddress
+import socket
+import sqlite3
+import importlib.util
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, nullcontext
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import List, Optional, Dict, Any, Literal, Tuple, Union, Callable, Awaitable, AsyncContextManager, Mapping, FrozenSet, Set, get_args
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+import httpx
 from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, StreamingResponse
 import fal
+import fal_client
 
 # ============================================================================
 # INSPIRATIONS CONFIGURATION (Embedded)
@@ -42,6 +61,7 @@ INSPIRATIONS = {
         "min_images": 1,
         "max_images": 1,
         "execution_mode": "parallel",  # parallel = 3 separate requests for diversity
+        "allowed_modes": ["parallel"],  # diversity needs separate requests
         "model": "fal-ai/nano-banana/edit"
     },
 
@@ -55,6 +75,7 @@ INSPIRATIONS = {
         "min_images": 1,
         "max_images": 1,
         "execution_mode": "parallel",  # parallel = 3 separate requests for diversity
+        "allowed_modes": ["parallel"],  # diversity needs separate requests
         "model": "fal-ai/nano-banana/edit"
     },
 
@@ -274,6 +295,7 @@ INSPIRATIONS = {
         "min_images": 1,
         "max_images": 1,
         "execution_mode": "parallel",  # Different closeup angles, need parallel
+        "allowed_modes": ["parallel"],  # diversity needs separate requests
         "model": "fal-ai/nano-banana/edit"
     },
     
@@ -287,6 +309,7 @@ INSPIRATIONS = {
         "min_images": 1,
         "max_images": 1,
         "execution_mode": "parallel",  # Different poses, need parallel
+        "allowed_modes": ["parallel"],  # diversity needs separate requests
         "model": "fal-ai/nano-banana/edit"
     },
 
@@ -538,8 +561,20 @@ def _create_inspiration_literal():
         return str
     return Literal[keys]  # type: ignore
 
-# Create the dynamic Literal type
-InspirationName = Literal[tuple(INSPIRATIONS.keys())]  # type: ignore
+# Create the dynamic Literal type. With an external registry (hot-reloadable,
+# see INSPIRATION REGISTRY) names are checked against the loaded plans instead.
+if os.environ.get("STOCK_INSPIRATIONS_REGISTRY"):
+    InspirationName = str
+else:
+    InspirationName = Literal[tuple(INSPIRATIONS.keys())]  # type: ignore
+
+# Output aspect ratios accepted by the API
+ASPECT_RATIOS = ("1:1", "2:3", "4:5", "16:9", "9:16")
+AspectRatio = Literal[ASPECT_RATIOS]  # type: ignore
+
+# Render quality tiers, cheapest first; "standard" is the default
+QUALITY_TIERS = ("draft", "standard", "final")
+Quality = Literal[QUALITY_TIERS]  # type: ignore
 
 
 def get_inspiration(name: str) -> Optional[Dict[str, Any]]:
@@ -574,139 +609,3423 @@ def build_prompt(inspiration_name: str, extra_prompt: Optional[str] = None) -> s
     return base_prompt
 
 
-# ============================================================================
-# EXECUTION UNIT - Handles both parallel and batch execution
-# ============================================================================
+# ============================================================================
+# UPSTREAM CLIENT - One pooled fal client shared by all upstream calls
+# ============================================================================
+
+# Connection pool limits for fal queue/status/result calls. Parallel mode keeps
+# several jobs per request in flight, each polling its status.
+FAL_MAX_CONNECTIONS = 64
+FAL_MAX_KEEPALIVE_CONNECTIONS = 32
+FAL_KEEPALIVE_EXPIRY = 60.0
+
+# Timeouts (seconds) for a single upstream HTTP call (not a whole job)
+FAL_CONNECT_TIMEOUT = 5.0
+FAL_REQUEST_TIMEOUT = 60.0
+
+# fal queue REST API; FAL_QUEUE_RUN_HOST / FAL_RUN_HOST override it as in fal_client
+FAL_QUEUE_URL = "https://" + os.environ.get(
+    "FAL_QUEUE_RUN_HOST", f"queue.{os.environ.get('FAL_RUN_HOST', 'fal.run')}"
+)
+
+# Seconds between status polls of one upstream job
+FAL_POLL_INTERVAL = 0.1
+
+
+def fal_authorization(key: Optional[str] = None) -> str:
+    """
+    Authorization header value for the fal API, from key or FAL_KEY (or FAL_KEY_ID/FAL_KEY_SECRET).
+    
+    Raises:
+        RuntimeError: If no credentials are configured
+    """
+    if key is None:
+        key = os.environ.get("FAL_KEY")
+    if not key and os.environ.get("FAL_KEY_ID") and os.environ.get("FAL_KEY_SECRET"):
+        key = f"{os.environ['FAL_KEY_ID']}:{os.environ['FAL_KEY_SECRET']}"
+    if not key:
+        raise RuntimeError("fal credentials not found: set FAL_KEY (or FAL_KEY_ID and FAL_KEY_SECRET)")
+    return f"Key {key}"
+
+
+def parse_queue_status(data: Dict[str, Any]) -> Any:
+    """Map a queue status response to fal_client's Queued / InProgress / Completed."""
+    status = data.get("status")
+    if status == "IN_QUEUE":
+        return fal_client.Queued(position=data.get("queue_position", 0))
+    if status == "IN_PROGRESS":
+        return fal_client.InProgress(logs=data.get("logs"))
+    if status == "COMPLETED":
+        # Legacy apps don't report metrics
+        return fal_client.Completed(logs=data.get("logs"), metrics=data.get("metrics") or {})
+    raise ValueError(f"Unknown upstream job status: {status}")
+
+
+class FalQueueHandle:
+    """
+    One job on the fal queue, with the fal_client.AsyncRequestHandle interface
+    (status, iter_events, get, cancel) over the shared HTTP client.
+    
+    HTTP errors are raised as httpx.HTTPStatusError, so callers can tell
+    permanent (4xx) from transient (429, 5xx) failures.
+    """
+    
+    def __init__(self, client: httpx.AsyncClient, request_id: str, status_url: str, response_url: str, cancel_url: str):
+        self.client = client
+        self.request_id = request_id
+        self.status_url = status_url
+        self.response_url = response_url
+        self.cancel_url = cancel_url
+    
+    async def status(self, *, with_logs: bool = False) -> Any:
+        response = await self.client.get(self.status_url, params={"logs": int(with_logs)})
+        response.raise_for_status()
+        return parse_queue_status(response.json())
+    
+    async def iter_events(self, *, with_logs: bool = False, interval: float = FAL_POLL_INTERVAL):
+        """Poll the job's status until it completes, yielding each status."""
+        while True:
+            status = await self.status(with_logs=with_logs)
+            yield status
+            if isinstance(status, fal_client.Completed):
+                return
+            await asyncio.sleep(interval)
+    
+    async def get(self, *, interval: float = FAL_POLL_INTERVAL) -> Dict[str, Any]:
+        """Wait for the job to complete and return its result."""
+        async for _ in self.iter_events(interval=interval):
+            pass
+        return await self.result()
+    
+    async def result(self) -> Dict[str, Any]:
+        """Fetch the result of a job already seen Completed, without polling its status again."""
+        response = await self.client.get(self.response_url)
+        response.raise_for_status()
+        return response.json()
+    
+    async def cancel(self) -> None:
+        response = await self.client.put(self.cancel_url)
+        response.raise_for_status()
+
+
+class PooledFalClient:
+    """
+    fal queue client with an explicitly sized, long-lived connection pool.
+    
+    Submit, status, result and cancel calls go straight to the queue REST
+    API through one httpx client with FAL_* limits and timeouts, HTTP/2 when
+    the h2 package is installed, and a request counter for the pool metrics.
+    Uploads use fal_client's public upload API.
+    """
+    
+    def __init__(self, key: Optional[str] = None, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.key = key
+        self.http2 = importlib.util.find_spec("h2") is not None
+        # transport replaces the pooled one (tests)
+        self._transport = transport or httpx.AsyncHTTPTransport(
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_connections=FAL_MAX_CONNECTIONS,
+                max_keepalive_connections=FAL_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=FAL_KEEPALIVE_EXPIRY
+            )
+        )
+        self._http: Optional[httpx.AsyncClient] = None
+        self._uploader: Optional[fal_client.AsyncClient] = None
+        self.requests = 0
+    
+    @property
+    def http(self) -> httpx.AsyncClient:
+        # Built on first use, so missing credentials fail upstream calls rather than startup
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                transport=self._transport,
+                headers={"Authorization": fal_authorization(self.key)},
+                timeout=httpx.Timeout(FAL_REQUEST_TIMEOUT, connect=FAL_CONNECT_TIMEOUT),
+                event_hooks={"request": [self._count_request]}
+            )
+        return self._http
+    
+    async def _count_request(self, request: httpx.Request) -> None:
+        self.requests += 1
+    
+    async def submit(self, model_id: str, arguments: Dict[str, Any]) -> FalQueueHandle:
+        """Queue a job for model_id and return its handle."""
+        response = await self.http.post(f"{FAL_QUEUE_URL}/{model_id}", json=arguments)
+        response.raise_for_status()
+        data = response.json()
+        return FalQueueHandle(
+            self.http,
+            request_id=data["request_id"],
+            status_url=data["status_url"],
+            response_url=data["response_url"],
+            cancel_url=data["cancel_url"]
+        )
+    
+    async def upload(self, data: bytes, content_type: str) -> str:
+        """Upload bytes to fal storage; returns the URL."""
+        if self._uploader is None:
+            self._uploader = fal_client.AsyncClient(key=self.key)
+        return await self._uploader.upload(data, content_type)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """Request counters and connection pool occupancy."""
+        # httpx does not expose pool state publicly; read it best-effort
+        connections = getattr(getattr(self._transport, "_pool", None), "connections", [])
+        idle = sum(1 for c in connections if c.is_idle())
+        return {
+            "requests": self.requests,
+            "connections": len(connections),
+            "active_connections": len(connections) - idle,
+            "idle_connections": idle,
+            "max_connections": FAL_MAX_CONNECTIONS,
+            "http2": self.http2
+        }
+    
+    async def aclose(self) -> None:
+        if self._http is not None:
+            await self._http.aclose()
+        await self._transport.aclose()
+
+
+# Client used by backends and uploads; None = fal_client's module-level default
+_FAL_CLIENT: Optional[PooledFalClient] = None
+
+
+def set_fal_client(client: Optional[PooledFalClient]) -> None:
+    """Route all upstream calls through client (None restores the fal_client default)."""
+    global _FAL_CLIENT
+    _FAL_CLIENT = client
+
+
+async def fal_submit(model_id: str, arguments: Dict[str, Any]) -> Any:
+    """Submit a job to a model's queue through the shared client; returns its handle."""
+    if _FAL_CLIENT is not None:
+        return await _FAL_CLIENT.submit(model_id, arguments=arguments)
+    return await fal_client.submit_async(model_id, arguments=arguments)
+
+
+async def fal_upload(data: bytes, content_type: str) -> str:
+    """Upload bytes to fal storage through the shared client; returns the URL."""
+    if _FAL_CLIENT is not None:
+        return await _FAL_CLIENT.upload(data, content_type)
+    return await fal_client.upload_async(data, content_type)
+
+
+# ============================================================================
+# MODEL BACKENDS - Argument building and job submission per model
+# ============================================================================
+
+# Aspect ratio to dimensions mapping for Qwen model
+QWEN_ASPECT_RATIO_DIMENSIONS = {
+    "1:1": {"width": 1080, "height": 1080},
+    "2:3": {"width": 1000, "height": 1500},
+    "4:5": {"width": 1080, "height": 1350},
+    "16:9": {"width": 1920, "height": 1080},
+    "9:16": {"width": 1080, "height": 1920}
+}
+
+# Qwen settings per quality tier: draft for fast browsing of angles, final for the render
+QWEN_QUALITY_TIERS = {
+    "draft": {"num_inference_steps": 12, "acceleration": "high", "dimension_scale": 0.5},
+    "standard": {"num_inference_steps": 30, "acceleration": "none", "dimension_scale": 1.0},
+    "final": {"num_inference_steps": 40, "acceleration": "none", "dimension_scale": 1.0}
+}
+
+# Output size Qwen renders when no aspect ratio is given
+QWEN_DEFAULT_IMAGE_SIZE = {"width": 1024, "height": 1024}
+
+
+def _scale_dimensions(dimensions: Dict[str, int], scale: float) -> Dict[str, int]:
+    if scale == 1.0:
+        return dimensions
+    return {side: max(16, round(size * scale / 16) * 16) for side, size in dimensions.items()}
+
+
+# Qwen output dimensions per tier and aspect ratio (scaled, rounded to multiples of 16).
+# Scaled tiers also get an explicit size under None (no aspect ratio), since the
+# model's default size would otherwise render them full size.
+QWEN_TIER_DIMENSIONS = {
+    tier: {
+        **({} if settings["dimension_scale"] == 1.0 else {
+            None: _scale_dimensions(QWEN_DEFAULT_IMAGE_SIZE, settings["dimension_scale"])
+        }),
+        **{
+            ratio: _scale_dimensions(dimensions, settings["dimension_scale"])
+            for ratio, dimensions in QWEN_ASPECT_RATIO_DIMENSIONS.items()
+        }
+    }
+    for tier, settings in QWEN_QUALITY_TIERS.items()
+}
+
+# Estimated USD per generated image for per-image priced models (nano-banana list price)
+DEFAULT_PRICE_PER_IMAGE = 0.039
+
+# Qwen multiple-angles: estimated USD per output megapixel at QWEN_REFERENCE_STEPS steps
+QWEN_PRICE_PER_MEGAPIXEL = 0.035
+QWEN_REFERENCE_STEPS = 30
+
+
+class ModelBackend:
+    """
+    Base backend: knows how to build arguments for a model and submit jobs to it.
+    
+    Arguments are split into a request-independent template (fixed parameters,
+    camera parameters, aspect ratio handling) and the per-request parts
+    (image_urls, plus the prompt if uses_prompt), so templates can be
+    precomputed per inspiration, quality tier and aspect ratio.
+    
+    submit() returns a handle with the fal_client.AsyncRequestHandle interface
+    (get, iter_events, cancel).
+    """
+    
+    # Whether the model takes a text prompt
+    uses_prompt = True
+    
+    # Max num_images the model accepts in one call
+    max_images_per_call = 4
+    
+    # Estimated USD per generated image (see estimate_cost)
+    price_per_image = DEFAULT_PRICE_PER_IMAGE
+    
+    def __init__(self, model_id: str):
+        self.model_id = model_id
+    
+    def estimate_cost(self, arguments: Dict[str, Any]) -> float:
+        """Estimated USD cost of one upstream call with these arguments."""
+        return self.price_per_image * arguments.get("num_images", 1)
+    
+    def argument_template(
+        self,
+        aspect_ratio: Optional[str],
+        camera_params: Optional[Dict[str, Any]] = None,
+        quality: str = "standard"
+    ) -> Dict[str, Any]:
+        """
+        Arguments shared by every request with this aspect ratio and quality tier.
+        
+        Models without step or size parameters use the same arguments for
+        every tier.
+        
+        Raises:
+            ValueError: If the aspect ratio is not supported by the model
+        """
+        raise NotImplementedError
+    
+    async def submit(self, arguments: Dict[str, Any]) -> Any:
+        return await fal_submit(self.model_id, arguments)
+
+
+class PromptEditBackend(ModelBackend):
+    """Prompt-driven edit models such as fal-ai/nano-banana/edit."""
+    
+    def argument_template(self, aspect_ratio, camera_params=None, quality="standard"):
+        # No step or output size parameters, so every quality tier is the same render
+        template = {
+            "output_format": "png",
+            "limit_generations": True
+        }
+        if aspect_ratio:
+            # Nano Banana uses aspect_ratio string
+            template["aspect_ratio"] = aspect_ratio
+        return template
+
+
+class QwenMultipleAnglesBackend(ModelBackend):
+    """Qwen multiple-angles LoRA: camera parameters instead of a text prompt."""
+    
+    uses_prompt = False
+    
+    def argument_template(self, aspect_ratio, camera_params=None, quality="standard"):
+        # Qwen doesn't use text prompts - fixed parameters only
+        tier = QWEN_QUALITY_TIERS[quality]
+        template = {
+            "output_format": "png",
+            "guidance_scale": 5,
+            "num_inference_steps": tier["num_inference_steps"],
+            "acceleration": tier["acceleration"],
+            "negative_prompt": "bad quality, blurred, artifact"
+        }
+        
+        if camera_params:
+            template.update(camera_params)
+        
+        # Qwen model uses width/height instead of aspect_ratio string
+        if aspect_ratio:
+            if aspect_ratio not in QWEN_ASPECT_RATIO_DIMENSIONS:
+                raise ValueError(f"Unsupported aspect ratio for Qwen model: {aspect_ratio}")
+            template["image_size"] = QWEN_TIER_DIMENSIONS[quality][aspect_ratio]
+        elif None in QWEN_TIER_DIMENSIONS[quality]:
+            # Draft is half size with or without an aspect ratio
+            template["image_size"] = QWEN_TIER_DIMENSIONS[quality][None]
+        
+        return template
+    
+    def estimate_cost(self, arguments):
+        # Priced by output megapixels (the size actually requested), scaled by denoising steps
+        size = arguments.get("image_size") or QWEN_DEFAULT_IMAGE_SIZE
+        megapixels = size["width"] * size["height"] / 1_000_000
+        steps = arguments.get("num_inference_steps", QWEN_REFERENCE_STEPS)
+        per_image = QWEN_PRICE_PER_MEGAPIXEL * megapixels * steps / QWEN_REFERENCE_STEPS
+        return per_image * arguments.get("num_images", 1)
+
+
+class FakeBackendError(RuntimeError):
+    """Simulated upstream failure raised by FakeBackend (a transient 5xx)."""
+    
+    status_code = 503
+
+
+class FakeRequestHandle:
+    """In-process stand-in for fal_client.AsyncRequestHandle."""
+    
+    def __init__(self, request_id: str, num_images: int, latency: float, fail: bool):
+        self.request_id = request_id
+        self.num_images = num_images
+        self.latency = latency
+        self.fail = fail
+        self.cancelled = False
+        self._done = asyncio.get_running_loop().create_future()
+        self._task = asyncio.create_task(self._run())
+    
+    async def _run(self) -> None:
+        await asyncio.sleep(self.latency)
+        if not self._done.done():
+            self._done.set_result(None)
+    
+    async def iter_events(self, *, with_logs: bool = False, interval: float = 0.1):
+        yield fal_client.Queued(position=0)
+        yield fal_client.InProgress(logs=[] if with_logs else None)
+        await asyncio.shield(self._done)
+        yield fal_client.Completed(logs=[] if with_logs else None, metrics={"inference_time": self.latency})
+    
+    async def get(self, *, interval: float = 0.1) -> Dict[str, Any]:
+        await asyncio.shield(self._done)
+        if self.cancelled:
+            raise FakeBackendError(f"Request {self.request_id} was cancelled")
+        if self.fail:
+            raise FakeBackendError(f"Simulated failure for request {self.request_id}")
+        return {
+            "images": [
+                {"url": f"https://fake.local/{self.request_id}/{i}.png", "content_type": "image/png"}
+                for i in range(self.num_images)
+            ]
+        }
+    
+    async def cancel(self) -> None:
+        self.cancelled = True
+        self._task.cancel()
+        if not self._done.done():
+            self._done.set_result(None)
+
+
+class FakeBackend(ModelBackend):
+    """
+    Offline backend for benchmarks and load tests.
+    
+    Builds arguments with the wrapped real backend, then simulates the job:
+    latency is drawn from a log-normal distribution (median latency_median,
+    shape latency_sigma) and each job fails with probability failure_rate.
+    """
+    
+    def __init__(
+        self,
+        wrapped: ModelBackend,
+        latency_median: float = 8.0,
+        latency_sigma: float = 0.25,
+        submit_latency: float = 0.05,
+        failure_rate: float = 0.0,
+        seed: Optional[int] = None
+    ):
+        super().__init__(wrapped.model_id)
+        self.wrapped = wrapped
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.submit_latency = submit_latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.submitted = 0
+    
+    @property
+    def uses_prompt(self) -> bool:
+        return self.wrapped.uses_prompt
+    
+    @property
+    def max_images_per_call(self) -> int:
+        return self.wrapped.max_images_per_call
+    
+    def argument_template(self, aspect_ratio, camera_params=None, quality="standard"):
+        return self.wrapped.argument_template(aspect_ratio, camera_params, quality)
+    
+    def estimate_cost(self, arguments):
+        return self.wrapped.estimate_cost(arguments)
+    
+    async def submit(self, arguments: Dict[str, Any]) -> FakeRequestHandle:
+        await asyncio.sleep(self.submit_latency)
+        self.submitted += 1
+        latency = self.latency_median * math.exp(self.random.gauss(0.0, self.latency_sigma))
+        fail = self.random.random() < self.failure_rate
+        return FakeRequestHandle(
+            request_id=f"fake-{self.submitted}",
+            num_images=arguments.get("num_images", 1),
+            latency=latency,
+            fail=fail
+        )
+
+
+# Backend registry keyed by model id
+MODEL_BACKENDS: Dict[str, ModelBackend] = {}
+
+
+def register_backend(backend: ModelBackend) -> None:
+    """Register (or replace) the backend for backend.model_id."""
+    MODEL_BACKENDS[backend.model_id] = backend
+
+
+def get_backend(model: str) -> ModelBackend:
+    """
+    Get the registered backend for a model (see register_backend).
+    
+    Raises:
+        ValueError: If no backend is registered for the model
+    """
+    backend = MODEL_BACKENDS.get(model)
+    if backend is None:
+        raise ValueError(f"Unknown model: {model} (supported: {', '.join(sorted(MODEL_BACKENDS))})")
+    return backend
+
+
+def build_arguments(
+    backend: ModelBackend,
+    template: Mapping[str, Any],
+    image_urls: List[str],
+    prompt: str
+) -> Dict[str, Any]:
+    """Merge a request's image URLs (and prompt, if the model takes one) into an argument template."""
+    arguments = {"image_urls": image_urls, **template}
+    if backend.uses_prompt:
+        arguments["prompt"] = prompt
+    return arguments
+
+
+def install_fake_backends(**fake_options: Any) -> None:
+    """
+    Replace every registered backend with a FakeBackend wrapping it.
+    
+    Keyword arguments are passed to FakeBackend (latency_median, failure_rate, ...).
+    """
+    for model, backend in list(MODEL_BACKENDS.items()):
+        if isinstance(backend, FakeBackend):
+            backend = backend.wrapped
+        register_backend(FakeBackend(backend, **fake_options))
+
+
+register_backend(PromptEditBackend("fal-ai/nano-banana/edit"))
+register_backend(QwenMultipleAnglesBackend("fal-ai/qwen-image-edit-plus-lora-gallery/multiple-angles"))
+
+
+# ============================================================================
+# EXECUTION PLANS - Inspirations compiled and validated at startup
+# ============================================================================
+
+EXECUTION_MODES = ("batch", "parallel")
+
+REQUIRED_INSPIRATION_KEYS = ("name", "category", "prompt_template", "min_images", "max_images")
+
+
+@dataclass(frozen=True)
+class InspirationPlan:
+    """
+    Immutable, pre-resolved execution plan for one inspiration.
+    
+    argument_templates maps every quality tier and supported aspect ratio
+    (None = model default) to the request-independent model arguments, so a
+    request only has to look up its template and merge in the image URLs and
+    prompt. name is the registry key; display_name is the config's "name".
+    """
+    name: str
+    display_name: str
+    category: str
+    prompt_template: str
+    min_images: int
+    max_images: int
+    num_images: int
+    execution_mode: str
+    allowed_modes: Tuple[str, ...]
+    model: str
+    backend: ModelBackend
+    argument_templates: Mapping[str, Mapping[Optional[str], Mapping[str, Any]]]
+    
+    @property
+    def aspect_ratios(self) -> List[str]:
+        """Aspect ratios this inspiration's model supports."""
+        return [ratio for ratio in self.argument_templates["standard"] if ratio is not None]
+    
+    def build_prompt(self, extra_prompt: Optional[str] = None) -> str:
+        if extra_prompt:
+            return f"{self.prompt_template}. {extra_prompt}"
+        return self.prompt_template
+    
+    def arguments(
+        self,
+        image_urls: List[str],
+        prompt: str,
+        aspect_ratio: Optional[str],
+        quality: str = "standard"
+    ) -> Dict[str, Any]:
+        """
+        Model arguments for one request.
+        
+        Raises:
+            ValueError: If the aspect ratio is not supported by the model
+        """
+        template = self.argument_templates[quality].get(aspect_ratio)
+        if template is None:
+            raise ValueError(f"Unsupported aspect ratio for {self.model}: {aspect_ratio}")
+        return build_arguments(self.backend, template, image_urls, prompt)
+
+
+def compile_plan(name: str, inspiration: Dict[str, Any]) -> InspirationPlan:
+    """
+    Validate one inspiration config and compile it into a plan.
+    
+    Raises:
+        ValueError: If the config is invalid
+    """
+    missing = [key for key in REQUIRED_INSPIRATION_KEYS if key not in inspiration]
+    if missing:
+        raise ValueError(f"Inspiration '{name}' is missing {', '.join(missing)}")
+    
+    execution_mode = inspiration.get("execution_mode", "batch")
+    if execution_mode not in EXECUTION_MODES:
+        raise ValueError(f"Inspiration '{name}' has unknown execution_mode: {execution_mode}")
+    
+    # Modes the planner may switch between; execution_mode is the default
+    allowed_modes = tuple(inspiration.get("allowed_modes", EXECUTION_MODES))
+    if execution_mode not in allowed_modes or not set(allowed_modes) <= set(EXECUTION_MODES):
+        raise ValueError(f"Inspiration '{name}' has invalid allowed_modes: {list(allowed_modes)}")
+    
+    min_images, max_images = inspiration["min_images"], inspiration["max_images"]
+    if not (isinstance(min_images, int) and isinstance(max_images, int) and 1 <= min_images <= max_images):
+        raise ValueError(f"Inspiration '{name}' has invalid image range: {min_images}-{max_images}")
+    
+    num_images = inspiration.get("num_images", DEFAULT_NUM_IMAGES)
+    if not (isinstance(num_images, int) and 1 <= num_images <= MAX_NUM_IMAGES):
+        raise ValueError(f"Inspiration '{name}' has invalid num_images: {num_images!r}")
+    
+    camera_params = inspiration.get("camera_params")
+    if camera_params is not None and not isinstance(camera_params, dict):
+        raise ValueError(f"Inspiration '{name}' has invalid camera_params: {camera_params!r}")
+    
+    model = inspiration.get("model", "fal-ai/nano-banana/edit")
+    backend = get_backend(model)
+    if backend.uses_prompt and not isinstance(inspiration["prompt_template"], str):
+        raise ValueError(f"Inspiration '{name}' needs a string prompt_template for {model}")
+    
+    argument_templates: Dict[str, Mapping[Optional[str], Mapping[str, Any]]] = {}
+    for quality in QUALITY_TIERS:
+        templates: Dict[Optional[str], Mapping[str, Any]] = {}
+        for aspect_ratio in (None, *ASPECT_RATIOS):
+            try:
+                template = backend.argument_template(aspect_ratio, camera_params, quality)
+            except ValueError:
+                continue
+            templates[aspect_ratio] = MappingProxyType(template)
+        argument_templates[quality] = MappingProxyType(templates)
+    if None not in argument_templates["standard"]:
+        raise ValueError(f"Inspiration '{name}' cannot build default arguments for {model}")
+    
+    return InspirationPlan(
+        name=name,
+        display_name=inspiration["name"],
+        category=inspiration["category"],
+        prompt_template=inspiration["prompt_template"],
+        min_images=min_images,
+        max_images=max_images,
+        num_images=num_images,
+        execution_mode=execution_mode,
+        allowed_modes=allowed_modes,
+        model=model,
+        backend=backend,
+        argument_templates=MappingProxyType(argument_templates)
+    )
+
+
+def compile_plans(inspirations: Dict[str, Dict[str, Any]]) -> Mapping[str, InspirationPlan]:
+    """
+    Compile every inspiration; fails on the first invalid config.
+    
+    Backends are resolved here, so install_fake_backends() must run before.
+    """
+    return MappingProxyType({name: compile_plan(name, config) for name, config in inspirations.items()})
+
+
+# ============================================================================
+# INSPIRATION REGISTRY - Load from files, index, and hot-swap compiled plans
+# ============================================================================
+
+# Registry file or directory of *.json / *.yaml / *.yml files (unset = embedded INSPIRATIONS)
+INSPIRATIONS_REGISTRY_PATH = os.environ.get("STOCK_INSPIRATIONS_REGISTRY")
+
+# Seconds between checks of the registry files for changes (0 = reload only on request)
+REGISTRY_POLL_INTERVAL = float(os.environ.get("STOCK_INSPIRATIONS_REGISTRY_POLL", "30"))
+
+# Files picked up when the registry path is a directory
+REGISTRY_FILE_SUFFIXES = (".json", ".yaml", ".yml")
+
+# Accepted input image URL prefixes (data: URIs carry the image inline)
+ALLOWED_IMAGE_URL_PREFIXES = ("https://", "http://", "data:image/")
+
+# Max length of extra_prompt in characters
+MAX_EXTRA_PROMPT_CHARS = 2000
+
+
+class InspirationConfig(BaseModel):
+    """Schema of one inspiration definition (embedded or loaded from a registry file)."""
+    model_config = ConfigDict(extra="forbid")
+    
+    name: str
+    category: str
+    description: str = ""
+    prompt_template: str
+    num_images: int = 3
+    input_type: Literal["single", "multiple"] = "single"
+    min_images: int
+    max_images: int
+    execution_mode: Literal[EXECUTION_MODES] = "batch"  # type: ignore
+    allowed_modes: Optional[List[Literal[EXECUTION_MODES]]] = None  # type: ignore
+    model: str = "fal-ai/nano-banana/edit"
+    camera_params: Optional[Dict[str, Any]] = None
+
+
+@dataclass(frozen=True)
+class InputConstraints:
+    """Request constraints of one inspiration, with their error messages prebuilt."""
+    min_images: int
+    max_images: int
+    aspect_ratios: FrozenSet[str]
+    image_count_error: str
+    aspect_ratio_error: str
+
+
+@dataclass(frozen=True)
+class Registry:
+    """
+    Compiled inspirations plus indexes, swapped as one object on reload.
+    
+    Requests read app.registry once, so a reload never changes the plans
+    under a request that is already running.
+    """
+    plans: Mapping[str, InspirationPlan]
+    categories: Mapping[str, Tuple[str, ...]]
+    constraints: Mapping[str, InputConstraints]
+    available: str
+    source: str
+    version: str
+    loaded_at: float
+    
+    def validate(
+        self,
+        inspiration_name: str,
+        image_urls: List[str],
+        aspect_ratio: Optional[str] = None,
+        extra_prompt: Optional[str] = None
+    ) -> List[str]:
+        """
+        Check a request against the constraint index in one pass, without I/O.
+        
+        Returns:
+            Every problem found (empty if the request is valid)
+        """
+        constraints = self.constraints.get(inspiration_name)
+        if constraints is None:
+            return [f"Unknown inspiration: {inspiration_name}. Available: {self.available}"]
+        errors = []
+        if not constraints.min_images <= len(image_urls) <= constraints.max_images:
+            errors.append(f"{constraints.image_count_error}, but {len(image_urls)} were provided")
+        if aspect_ratio is not None and aspect_ratio not in constraints.aspect_ratios:
+            errors.append(constraints.aspect_ratio_error)
+        errors.extend(validate_shared_inputs(image_urls, extra_prompt))
+        return errors
+
+
+def validate_shared_inputs(image_urls: List[str], extra_prompt: Optional[str] = None) -> List[str]:
+    """Checks that don't depend on the inspiration: URL schemes, duplicate URLs, prompt length."""
+    errors = []
+    for url in image_urls:
+        if not url.startswith(ALLOWED_IMAGE_URL_PREFIXES):
+            errors.append(f"Unsupported image URL '{url[:64]}': use http(s):// or data:image/ URLs")
+    if len(set(image_urls)) != len(image_urls):
+        errors.append("image_urls contains duplicate URLs")
+    if extra_prompt is not None and len(extra_prompt) > MAX_EXTRA_PROMPT_CHARS:
+        errors.append(f"extra_prompt is {len(extra_prompt)} characters (max {MAX_EXTRA_PROMPT_CHARS})")
+    return errors
+
+
+def _registry_files(path: str) -> List[str]:
+    if os.path.isdir(path):
+        return sorted(
+            os.path.join(path, name) for name in os.listdir(path)
+            if name.endswith(REGISTRY_FILE_SUFFIXES)
+        )
+    return [path]
+
+
+def registry_fingerprint(path: str) -> Tuple[Tuple[str, int, int], ...]:
+    """Cheap change detector: (file, mtime, size) of every registry file."""
+    fingerprint = []
+    for file_path in _registry_files(path):
+        stat = os.stat(file_path)
+        fingerprint.append((file_path, stat.st_mtime_ns, stat.st_size))
+    return tuple(fingerprint)
+
+
+def _parse_registry_file(file_path: str, text: str) -> Any:
+    if file_path.endswith(".json"):
+        try:
+            return json.loads(text)
+        except ValueError as e:
+            raise ValueError(f"Cannot parse registry file {file_path}: {e}")
+    try:
+        import yaml
+    except ImportError:
+        raise ValueError(f"PyYAML is required to load {file_path}")
+    try:
+        return yaml.safe_load(text)
+    except yaml.YAMLError as e:
+        raise ValueError(f"Cannot parse registry file {file_path}: {e}")
+
+
+def load_inspirations(path: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Load and schema-validate inspirations from a file or directory.
+    
+    Each file holds a mapping of inspiration key to definition, optionally
+    under a top-level "inspirations" key. YAML needs PyYAML installed.
+    
+    Raises:
+        ValueError: If a file is unreadable or a definition is invalid
+    """
+    inspirations: Dict[str, Dict[str, Any]] = {}
+    for file_path in _registry_files(path):
+        try:
+            with open(file_path, encoding="utf-8") as f:
+                text = f.read()
+        except OSError as e:
+            raise ValueError(f"Cannot read registry file {file_path}: {e}")
+        data = _parse_registry_file(file_path, text)
+        
+        if isinstance(data, dict) and "inspirations" in data:
+            data = data["inspirations"]
+        if not isinstance(data, dict):
+            raise ValueError(f"Registry file {file_path} must contain a mapping of inspirations")
+        
+        for name, config in data.items():
+            if name in inspirations:
+                raise ValueError(f"Inspiration '{name}' is defined twice (again in {file_path})")
+            inspirations[name] = config
+    
+    if not inspirations:
+        raise ValueError(f"No inspirations found in {path}")
+    return inspirations
+
+
+def build_registry(inspirations: Dict[str, Dict[str, Any]], source: str) -> Registry:
+    """
+    Validate inspirations against the schema, compile them and index by category.
+    
+    Raises:
+        ValueError: If any inspiration is invalid
+    """
+    validated = {}
+    for name, config in inspirations.items():
+        try:
+            validated[name] = InspirationConfig.model_validate(config).model_dump(exclude_none=True)
+        except ValidationError as e:
+            raise ValueError(f"Inspiration '{name}' does not match the schema: {e}")
+    
+    plans = compile_plans(validated)
+    categories: Dict[str, List[str]] = {}
+    constraints: Dict[str, InputConstraints] = {}
+    for name, plan in plans.items():
+        categories.setdefault(plan.category, []).append(name)
+        constraints[name] = InputConstraints(
+            min_images=plan.min_images,
+            max_images=plan.max_images,
+            aspect_ratios=frozenset(plan.aspect_ratios),
+            image_count_error=f"Inspiration '{name}' requires {plan.min_images}-{plan.max_images} images",
+            aspect_ratio_error=(
+                f"Inspiration '{name}' ({plan.model}) supports aspect ratios {', '.join(plan.aspect_ratios)}"
+            )
+        )
+    
+    encoded = json.dumps(validated, sort_keys=True, separators=(",", ":"))
+    return Registry(
+        plans=plans,
+        categories=MappingProxyType({category: tuple(names) for category, names in sorted(categories.items())}),
+        constraints=MappingProxyType(constraints),
+        available=", ".join(plans),
+        source=source,
+        version=hashlib.sha256(encoded.encode("utf-8")).hexdigest()[:12],
+        loaded_at=time.time()
+    )
+
+
+def load_registry(path: Optional[str] = INSPIRATIONS_REGISTRY_PATH) -> Registry:
+    """Registry from path, or from the embedded INSPIRATIONS if path is unset."""
+    if path:
+        return build_registry(load_inspirations(path), source=path)
+    return build_registry(INSPIRATIONS, source="embedded")
+
+
+# ============================================================================
+# EXECUTION UNIT - Handles both parallel and batch execution
+# ============================================================================
+
+# Callback receiving each generated image dict as soon as it is available
+ImageCallback = Callable[[Dict[str, Any]], Awaitable[None]]
+
+# Callback receiving each upstream status event (see GenerationStats.event)
+ProgressCallback = Callable[[Dict[str, Any]], Awaitable[None]]
+
+# Images generated when neither the request nor the inspiration sets num_images
+DEFAULT_NUM_IMAGES = 3
+
+# Max images a single request may ask for
+MAX_NUM_IMAGES = 12
+
+# Max seconds a single parallel request (submit + wait, including retries) may take before it is dropped
+VARIANT_TIMEOUT = 90.0
+
+# Retries after a failed upstream job, with full-jitter exponential backoff
+RETRY_ATTEMPTS = 2
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 4.0
+
+# Submit a duplicate (hedge) when a job runs longer than this percentile of
+# recent job latencies for the same model; needs HEDGE_MIN_SAMPLES first
+HEDGE_PERCENTILE = 90
+HEDGE_MIN_SAMPLES = 20
+
+
+class UpstreamError(RuntimeError):
+    """An upstream job completed without usable images."""
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Whether an upstream failure is transient: timeouts, connection errors, 429 and 5xx.
+    
+    Other 4xx responses (invalid arguments, rejected inputs) and jobs that
+    complete without images fail the same way on every attempt.
+    """
+    if isinstance(error, (asyncio.TimeoutError, httpx.TransportError)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+    else:
+        status = getattr(error, "status_code", None)
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+
+def upstream_rejection(error: BaseException) -> Optional[Tuple[int, str]]:
+    """
+    HTTP status and upstream message for a permanent upstream HTTP failure, or None.
+    
+    Inputs the model rejects (400, 422) are the caller's to fix and pass
+    through as 422; any other non-retryable status (e.g. 401/403 on our own
+    credentials) is the gateway's problem and becomes a 502.
+    """
+    response = getattr(error, "response", None)
+    if not isinstance(response, httpx.Response) or is_retryable(error):
+        return None
+    try:
+        detail = response.json().get("detail", response.text)
+    except (ValueError, AttributeError):
+        detail = response.text
+    if isinstance(detail, list):
+        # Validation errors: [{"loc": [...], "msg": "...", ...}, ...]
+        detail = "; ".join(str(item.get("msg", item)) if isinstance(item, dict) else str(item) for item in detail)
+    status = 422 if response.status_code in (400, 422) else 502
+    return status, f"Upstream model rejected the request ({response.status_code}): {detail}"
+
+
+@dataclass
+class GenerationStats:
+    """Counters, per-stage timing spans and upstream status events collected while executing one generation."""
+    upstream_calls: int = 0
+    retries: int = 0
+    hedges: int = 0
+    images: int = 0
+    inference_seconds: float = 0.0
+    cost: float = 0.0
+    diversity_checked: int = 0
+    duplicates: int = 0
+    regenerated: int = 0
+    dropped: List[str] = field(default_factory=list)
+    spans: List[Tuple[str, float]] = field(default_factory=list)
+    execution_mode: Optional[str] = None
+    timeline: List[Dict[str, Any]] = field(default_factory=list)
+    on_progress: Optional[ProgressCallback] = None
+    started_at: float = field(default_factory=time.time)
+    
+    def record(self, stage: str, seconds: float) -> None:
+        self.spans.append((stage, seconds))
+    
+    async def event(self, job: str, status: str, **details: Any) -> None:
+        """
+        Append a status event for one upstream job and forward it to on_progress.
+        
+        Args:
+            job: Sub-request name ("batch", "batch-2", "request-2", "request-2-hedge", ...)
+            status: submitted, queued, in_progress, completed, hedged, retrying or failed
+            **details: Optional position (queued) or detail text
+        """
+        event = {"job": job, "status": status, "elapsed": time.time() - self.started_at, **details}
+        self.timeline.append(event)
+        if self.on_progress:
+            await self.on_progress(event)
+
+
+class LatencyTracker:
+    """Rolling window of successful job latencies per (model, num_images)."""
+    
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples: Dict[Tuple[str, int], "deque[float]"] = {}
+    
+    def record(self, model: str, num_images: int, latency: float) -> None:
+        samples = self._samples.setdefault((model, num_images), deque(maxlen=self.window))
+        samples.append(latency)
+    
+    def percentile(self, model: str, num_images: int, pct: float, min_samples: int = 1) -> Optional[float]:
+        samples = self._samples.get((model, num_images))
+        if not samples or len(samples) < min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+JOB_LATENCIES = LatencyTracker()
+
+
+async def _cancel_quietly(handle: Any) -> None:
+    """Best-effort cancel of an upstream job whose result is no longer needed."""
+    try:
+        await handle.cancel()
+    except Exception:
+        pass
+
+
+# Cancels still in flight; the event loop only keeps weak references to tasks
+_PENDING_CANCELS: Set["asyncio.Task[None]"] = set()
+
+
+def cancel_in_background(handle: Any) -> None:
+    """Cancel an upstream job without waiting for it, keeping the task alive until it finishes."""
+    task = asyncio.ensure_future(_cancel_quietly(handle))
+    _PENDING_CANCELS.add(task)
+    task.add_done_callback(_PENDING_CANCELS.discard)
+
+
+async def completed_result(handle: Any) -> Dict[str, Any]:
+    """Result of a job whose status events already reached Completed."""
+    if isinstance(handle, FalQueueHandle):
+        return await handle.result()
+    if isinstance(handle, fal_client.AsyncRequestHandle):
+        # fal_client's get() would poll the status once more before fetching
+        response = await handle.client.get(handle.response_url)
+        response.raise_for_status()
+        return response.json()
+    return await handle.get()
+
+
+# Context manager holding an admission slot for one extra upstream job (a hedge)
+HedgeAdmission = Callable[[], AsyncContextManager[Any]]
+
+# Called once per finished upstream attempt with its num_images, latency and error (None on success)
+AttemptCallback = Callable[[int, float, Optional[BaseException]], None]
+
+
+async def _run_hedged_job(
+    backend: ModelBackend,
+    arguments: Dict[str, Any],
+    label: str,
+    stats: GenerationStats,
+    job: str = "batch",
+    admit_hedge: Optional[HedgeAdmission] = None,
+    on_attempt: Optional[AttemptCallback] = None
+) -> Dict[str, Any]:
+    """
+    Submit one upstream job, hedging it with a duplicate if it becomes a straggler.
+    
+    The hedge is an extra upstream job, so it runs inside admit_hedge (one
+    more slot of the model's limiter, in the request's lane and tenant
+    share) when given. A hedge the limiter sheds is skipped. Returns the
+    first result with images and cancels the other job. Every attempt that
+    finishes or fails (not one cancelled as the loser) is reported to
+    on_attempt.
+    """
+    num_images = arguments.get("num_images", 1)
+    hedge_after = JOB_LATENCIES.percentile(
+        backend.model_id, num_images, HEDGE_PERCENTILE, min_samples=HEDGE_MIN_SAMPLES
+    )
+    start = time.time()
+    
+    def report(started: float, error: Optional[BaseException]) -> None:
+        if on_attempt is not None:
+            on_attempt(num_images, time.time() - started, error)
+    
+    async def fetch(handle: Any, submitted_at: float, name: str) -> Dict[str, Any]:
+        try:
+            result = await fetch_result(handle, submitted_at, name)
+        except Exception as e:
+            report(submitted_at, e)
+            raise
+        report(submitted_at, None)
+        return result
+    
+    async def fetch_result(handle: Any, submitted_at: float, name: str) -> Dict[str, Any]:
+        # Follow status events to split upstream time into queue wait and model runtime
+        started_at = None
+        position = None
+        async for event in handle.iter_events(with_logs=True):
+            if isinstance(event, fal_client.Queued):
+                if event.position != position:
+                    position = event.position
+                    await stats.event(name, "queued", position=position)
+                continue
+            if isinstance(event, fal_client.Completed):
+                stats.inference_seconds += (getattr(event, "metrics", None) or {}).get("inference_time") or 0.0
+            if started_at is None:
+                started_at = time.time()
+                await stats.event(name, "in_progress")
+            for log in getattr(event, "logs", None) or []:
+                print(f"{label} {log.get('message', '')}")
+        completed_at = time.time()
+        if started_at is None:
+            started_at = completed_at
+        await stats.event(name, "completed")
+        result = await completed_result(handle)
+        stats.record("queue_wait", started_at - submitted_at)
+        stats.record("model_runtime", completed_at - started_at)
+        stats.record("result_fetch", time.time() - completed_at)
+        if not result.get("images"):
+            raise UpstreamError("Upstream job returned no images")
+        return result
+    
+    async def submit(name: str) -> Any:
+        submit_start = time.time()
+        try:
+            handle = await backend.submit(arguments)
+        except Exception as e:
+            report(submit_start, e)
+            raise
+        stats.upstream_calls += 1
+        # Every submitted job is billed, including retries and hedges
+        stats.cost += backend.estimate_cost(arguments)
+        stats.record("submit", time.time() - submit_start)
+        await stats.event(name, "submitted")
+        return handle
+    
+    async def run_hedge(name: str) -> Dict[str, Any]:
+        # May wait in the limiter's queue; cancelled there if the original finishes first
+        async with admit_hedge() if admit_hedge is not None else nullcontext():
+            hedge = await submit(name)
+            stats.hedges += 1
+            try:
+                return await fetch(hedge, time.time(), name)
+            except asyncio.CancelledError:
+                cancel_in_background(hedge)
+                raise
+    
+    handle = await submit(job)
+    print(f"{label} submitted ({time.time() - start:.2f}s)")
+    # The hedge task cancels its own upstream job, so it maps to no handle
+    jobs: Dict["asyncio.Future[Dict[str, Any]]", Optional[Any]] = {
+        asyncio.ensure_future(fetch(handle, time.time(), job)): handle
+    }
+    
+    try:
+        if hedge_after is not None:
+            done, _ = await asyncio.wait(jobs, timeout=max(0.0, hedge_after - (time.time() - start)))
+            if not done:
+                print(f"{label} exceeded p{HEDGE_PERCENTILE} ({hedge_after:.2f}s), hedging")
+                await stats.event(job, "hedged", detail=f"running past p{HEDGE_PERCENTILE} ({hedge_after:.2f}s)")
+                jobs[asyncio.ensure_future(run_hedge(f"{job}-hedge"))] = None
+        
+        last_error: Optional[BaseException] = None
+        while jobs:
+            done, _ = await asyncio.wait(jobs, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                original = jobs.pop(task) is not None
+                if task.exception() is None:
+                    JOB_LATENCIES.record(backend.model_id, num_images, time.time() - start)
+                    return task.result()
+                if not original and isinstance(task.exception(), AdmissionRejected):
+                    # No capacity for a duplicate - keep waiting on the original
+                    print(f"{label} hedge skipped: {task.exception()}")
+                    continue
+                last_error = task.exception()
+        raise last_error
+    finally:
+        # Cancel the loser (or everything, if we were cancelled ourselves)
+        for task, loser in jobs.items():
+            task.cancel()
+            if loser is not None:
+                cancel_in_background(loser)
+        if jobs:
+            # Let a queued hedge leave the admission queue before the caller's slot is released
+            await asyncio.wait(jobs)
+
+
+async def run_upstream_job(
+    backend: ModelBackend,
+    arguments: Dict[str, Any],
+    label: str,
+    stats: GenerationStats,
+    job: str = "batch",
+    admit_hedge: Optional[HedgeAdmission] = None,
+    on_attempt: Optional[AttemptCallback] = None
+) -> Dict[str, Any]:
+    """Run one upstream job with hedging, retrying transient failures with jittered backoff."""
+    attempt = 0
+    while True:
+        try:
+            return await _run_hedged_job(backend, arguments, label, stats, job, admit_hedge, on_attempt)
+        except Exception as e:
+            if attempt >= RETRY_ATTEMPTS or not is_retryable(e):
+                await stats.event(job, "failed", detail=str(e))
+                raise
+            attempt += 1
+            stats.retries += 1
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            await stats.event(job, "retrying", detail=f"retry {attempt}/{RETRY_ATTEMPTS} after: {e}")
+            print(f"{label} failed ({e}), retry {attempt}/{RETRY_ATTEMPTS} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+
+async def execute_generation(
+    model: str,
+    prompt: str,
+    image_urls: List[str],
+    aspect_ratio: Optional[str],
+    execution_mode: str,
+    request_id: str,
+    camera_params: Optional[Dict[str, Any]] = None,
+    num_images: int = DEFAULT_NUM_IMAGES,
+    variant_timeout: Optional[float] = VARIANT_TIMEOUT,
+    on_image: Optional[ImageCallback] = None,
+    stats: Optional[GenerationStats] = None
+) -> List[Dict[str, Any]]:
+    """
+    Execute image generation with specified strategy.
+    
+    Args:
+        model: Model endpoint (e.g., "fal-ai/nano-banana/edit")
+        prompt: Generation prompt
+        image_urls: Input image URLs
+        aspect_ratio: Optional aspect ratio
+        execution_mode: "parallel" or "batch"
+        request_id: Request ID for logging
+        camera_params: Optional camera parameters (Qwen multiple-angles only)
+        num_images: Number of images to generate
+        variant_timeout: Max seconds per parallel request (None = no limit)
+        on_image: Optional callback awaited with each image as soon as it is ready
+        stats: Optional counters updated with upstream calls, retries and hedges
+    
+    Returns:
+        List of generated images with per-image latency in seconds
+    
+    Raises:
+        ValueError: If the model, execution mode, aspect ratio or image count is not supported
+    """
+    if execution_mode not in EXECUTION_MODES:
+        raise ValueError(f"Unknown execution_mode: {execution_mode}")
+    if not 1 <= num_images <= MAX_NUM_IMAGES:
+        raise ValueError(f"num_images must be between 1 and {MAX_NUM_IMAGES}, got {num_images}")
+    if aspect_ratio is not None and aspect_ratio not in ASPECT_RATIOS:
+        raise ValueError(f"Unsupported aspect ratio for {model}: {aspect_ratio}")
+    # Only the one template this call needs, not a whole plan's tiers and ratios
+    backend = get_backend(model)
+    template = backend.argument_template(aspect_ratio, camera_params)
+    return await run_generation(
+        backend, build_arguments(backend, template, image_urls, prompt), execution_mode, request_id,
+        num_images, variant_timeout, on_image, stats
+    )
+
+
+def split_images(num_images: int, execution_mode: str, max_per_call: int) -> List[int]:
+    """
+    Split a request's image count into upstream calls.
+    
+    Parallel mode makes one call per image (independent samples for
+    diversity). Batch mode makes as few calls as the model's per-call
+    maximum allows, with images spread evenly so the calls finish together.
+    
+    Returns:
+        num_images per upstream call
+    """
+    if execution_mode == "parallel":
+        return [1] * num_images
+    calls = math.ceil(num_images / max_per_call)
+    return [num_images // calls + (1 if i < num_images % calls else 0) for i in range(calls)]
+
+
+def estimate_generation_cost(
+    backend: ModelBackend,
+    base_arguments: Dict[str, Any],
+    execution_mode: str,
+    num_images: int
+) -> float:
+    """Estimated USD cost of a generation's planned upstream calls (no retries or hedges)."""
+    return sum(
+        backend.estimate_cost({**base_arguments, "num_images": call_images})
+        for call_images in split_images(num_images, execution_mode, backend.max_images_per_call)
+    )
+
+
+async def run_generation(
+    backend: ModelBackend,
+    base_arguments: Dict[str, Any],
+    execution_mode: str,
+    request_id: str,
+    num_images: int = DEFAULT_NUM_IMAGES,
+    variant_timeout: Optional[float] = VARIANT_TIMEOUT,
+    on_image: Optional[ImageCallback] = None,
+    stats: Optional[GenerationStats] = None,
+    admit_hedge: Optional[HedgeAdmission] = None,
+    on_attempt: Optional[AttemptCallback] = None
+) -> List[Dict[str, Any]]:
+    """
+    Run a generation from fully built arguments (see execute_generation).
+    
+    This is the request path for compiled inspiration plans, which build
+    base_arguments from a precomputed template. The image count is split
+    into upstream calls by split_images() and all calls run concurrently;
+    hedges of straggling calls each run inside admit_hedge, if given, and
+    every upstream attempt (timeouts included) is reported to on_attempt.
+    A call that still fails after retries (or, in parallel mode, times out)
+    is dropped and its reason added to stats.dropped; the generation fails
+    only if every call fails.
+    """
+    if stats is None:
+        stats = GenerationStats()
+    
+    calls = split_images(num_images, execution_mode, backend.max_images_per_call)
+    parallel = execution_mode == "parallel"
+    if parallel:
+        # PARALLEL MODE: separate requests for maximum diversity
+        print(f"[{request_id}] Execution mode: PARALLEL ({len(calls)} separate requests)")
+    else:
+        # BATCH MODE: as few requests as possible, several images each
+        print(f"[{request_id}] Execution mode: BATCH ({len(calls)} request(s), {num_images} images)")
+    
+    async def run_call(call_idx: int, call_images: int, first_index: int) -> List[Dict[str, Any]]:
+        """Run one upstream call; returns [] if it still fails after retries."""
+        call_start = time.time()
+        if parallel:
+            label = f"[{request_id}] Request {call_idx+1}/{len(calls)}"
+            job = f"request-{call_idx+1}"
+        else:
+            label = f"[{request_id}] Batch request" + (f" {call_idx+1}/{len(calls)}" if len(calls) > 1 else "")
+            job = "batch" if len(calls) == 1 else f"batch-{call_idx+1}"
+        arguments = {**base_arguments, "num_images": call_images}
+        
+        try:
+            result = await asyncio.wait_for(
+                run_upstream_job(
+                    backend, arguments, label, stats, job=job, admit_hedge=admit_hedge, on_attempt=on_attempt
+                ),
+                timeout=variant_timeout if parallel else None
+            )
+        except asyncio.TimeoutError as e:
+            if on_attempt is not None:
+                on_attempt(call_images, time.time() - call_start, e)
+            print(f"{label} timed out after {variant_timeout}s")
+            await stats.event(job, "failed", detail=f"timed out after {variant_timeout}s")
+            stats.dropped.append(f"{job}: timed out after {variant_timeout}s")
+            return []
+        except Exception as e:
+            print(f"{label} failed: {e}")
+            call_errors.append(e)
+            stats.dropped.append(f"{job}: {e}")
+            return []
+        
+        latency = time.time() - call_start
+        print(f"{label} completed in {latency:.2f}s")
+        
+        # Parse results
+        images = [
+            {"url": img.get("url", ""), "index": first_index + i, "latency": latency}
+            for i, img in enumerate(result.get("images", [])[:call_images])
+        ]
+        stats.images += len(images)
+        stats.record("result_parsing", time.time() - call_start - latency)
+        if on_image:
+            for image in images:
+                await on_image(image)
+        return images
+    
+    # Submit and wait for all calls concurrently
+    call_errors: List[Exception] = []
+    offsets = [sum(calls[:i]) for i in range(len(calls))]
+    results = await asyncio.gather(*[
+        run_call(i, call_images, offsets[i]) for i, call_images in enumerate(calls)
+    ])
+    
+    generated_images = [img for images in results for img in images]
+    if not generated_images:
+        if call_errors:
+            raise call_errors[-1]
+        raise TimeoutError(f"No parallel request completed within {variant_timeout}s")
+    
+    print(f"[{request_id}] Collected {len(generated_images)}/{num_images} images")
+    return generated_images
+
+
+# ============================================================================
+# ADMISSION CONTROL - Per-model adaptive concurrency limits
+# ============================================================================
+
+# Per-model limiter settings; models not listed use DEFAULT_ADMISSION_LIMITS.
+# Limits count upstream jobs, so a generation takes one slot per upstream call.
+DEFAULT_ADMISSION_LIMITS = {
+    "initial_limit": 8,
+    "min_limit": 2,
+    "max_limit": 32,
+    "max_queue": 32,
+    "queue_timeout": 10.0
+}
+
+MODEL_ADMISSION_LIMITS = {
+    "fal-ai/nano-banana/edit": {"initial_limit": 12, "max_limit": 48},
+    "fal-ai/qwen-image-edit-plus-lora-gallery/multiple-angles": {"initial_limit": 6, "max_limit": 16}
+}
+
+
+# Scheduling lanes, highest priority first
+PRIORITY_LANES = ("interactive", "standard", "bulk")
+
+# Lanes whose queued requests are evicted when a preempting lane finds the queue full
+PREEMPTIBLE_LANES = ("bulk",)
+
+# Lanes whose arrivals evict queued preemptible work; below the queue limit
+# every higher lane already overtakes queued bulk work (strict priority)
+PREEMPTING_LANES = ("interactive",)
+
+# Queue timeout multiplier per lane: bulk work tolerates long waits, interactive fails fast
+LANE_QUEUE_TIMEOUT_FACTORS = {"interactive": 1.0, "standard": 1.0, "bulk": 6.0}
+
+# Fair-queuing weights per API key as JSON, e.g. {"<api key>": 4, "*": 1} (default 1);
+# "*" weights the shared anonymous tenant that unlisted keys fall into
+TENANT_WEIGHTS_JSON = os.environ.get("STOCK_INSPIRATIONS_TENANT_WEIGHTS", "")
+
+Priority = Literal[PRIORITY_LANES]  # type: ignore
+
+
+class AdmissionRejected(Exception):
+    """Raised when a model's limiter sheds a request (mapped to HTTP 429)."""
+    
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass(eq=False)
+class Waiter:
+    """A request waiting for admission."""
+    weight: int
+    lane: str
+    tenant: str
+    future: asyncio.Future
+    tag: float = 0.0
+    enqueued_at: float = field(default_factory=time.time)
+    removed: bool = False
+
+
+class LaneScheduler:
+    """
+    Admission queue of one limiter: strict priority between lanes, weighted
+    fair queuing between tenants within a lane.
+    
+    Each waiter gets a virtual finish tag, max(lane virtual time, tenant's
+    previous tag) + weight / tenant weight, and the lowest tag of the highest
+    non-empty lane goes next. A tenant with a deep backlog therefore gets its
+    weighted share of its lane instead of blocking everyone queued behind it.
+    """
+    
+    def __init__(self, tenant_weights: Optional[Dict[str, float]] = None):
+        self.tenant_weights = tenant_weights or {}
+        self._heaps: Dict[str, List[Tuple[float, int, Waiter]]] = {lane: [] for lane in PRIORITY_LANES}
+        self._virtual_time = {lane: 0.0 for lane in PRIORITY_LANES}
+        self._finish: Dict[Tuple[str, str], float] = {}
+        self._seq = 0
+        self.depth = {lane: 0 for lane in PRIORITY_LANES}
+        # Summed admission weight (upstream jobs) of the queued waiters
+        self.weight = 0
+    
+    def __len__(self) -> int:
+        return sum(self.depth.values())
+    
+    def push(self, waiter: Waiter) -> None:
+        key = (waiter.lane, waiter.tenant)
+        weight = self.tenant_weights.get(waiter.tenant, self.tenant_weights.get("*", 1.0))
+        waiter.tag = max(self._virtual_time[waiter.lane], self._finish.get(key, 0.0)) + waiter.weight / weight
+        self._finish[key] = waiter.tag
+        self._seq += 1
+        heapq.heappush(self._heaps[waiter.lane], (waiter.tag, self._seq, waiter))
+        self.depth[waiter.lane] += 1
+        self.weight += waiter.weight
+    
+    def peek(self) -> Optional[Waiter]:
+        """Next waiter to admit, without removing it."""
+        for lane in PRIORITY_LANES:
+            heap = self._heaps[lane]
+            while heap and heap[0][2].removed:
+                heapq.heappop(heap)
+            if heap:
+                return heap[0][2]
+        return None
+    
+    def pop(self) -> Waiter:
+        waiter = self.peek()
+        heapq.heappop(self._heaps[waiter.lane])
+        self._remove_bookkeeping(waiter)
+        self._virtual_time[waiter.lane] = waiter.tag
+        return waiter
+    
+    def remove(self, waiter: Waiter) -> None:
+        """Drop a waiter (timed out, cancelled or preempted); lazily removed from its heap."""
+        if not waiter.removed:
+            waiter.removed = True
+            self._remove_bookkeeping(waiter)
+    
+    def _remove_bookkeeping(self, waiter: Waiter) -> None:
+        self.depth[waiter.lane] -= 1
+        self.weight -= waiter.weight
+        if not self.depth[waiter.lane]:
+            # Idle lane: forget per-tenant tags so they don't accumulate
+            self._finish = {key: tag for key, tag in self._finish.items() if key[0] != waiter.lane}
+    
+    def preemptible(self, lane: str) -> Optional[Waiter]:
+        """Newest queued waiter in a preemptible lane below lane, lowest lane first."""
+        rank = PRIORITY_LANES.index(lane)
+        for lower in reversed(PRIORITY_LANES[rank + 1:]):
+            if lower not in PREEMPTIBLE_LANES:
+                continue
+            candidates = [waiter for _, _, waiter in self._heaps[lower] if not waiter.removed]
+            if candidates:
+                return max(candidates, key=lambda waiter: waiter.enqueued_at)
+        return None
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limiter for one model.
+    
+    Slots are held per request (acquire/release), but the limit learns from
+    individual upstream attempts (observe): it grows by about one slot per
+    window of successful, normal-latency attempts and shrinks by `backoff` on
+    transient errors (is_retryable: timeouts, 429, 5xx) or when an attempt's
+    latency exceeds `latency_tolerance` times the EWMA of recent successful
+    attempts of the same size (num_images). Permanent errors such as a 422
+    for bad input say nothing about upstream load and are ignored.
+    Requests that don't fit wait in a bounded LaneScheduler queue for up to
+    `queue_timeout` seconds (scaled per lane) before being rejected.
+    
+    Queued bulk work is deferred whenever interactive (or standard) waiters
+    are present: a free slot always goes to the highest non-empty lane, and
+    nothing bypasses the queue while it is non-empty. Below the queue limit
+    that costs bulk only wait time, which its longer lane timeout allows, so
+    it is not evicted; once the queue is full, an interactive arrival evicts
+    the newest queued bulk request instead of being rejected.
+    """
+    
+    def __init__(
+        self,
+        model: str,
+        initial_limit: float = 8,
+        min_limit: float = 2,
+        max_limit: float = 32,
+        max_queue: int = 32,
+        queue_timeout: float = 10.0,
+        latency_tolerance: float = 2.0,
+        backoff: float = 0.75,
+        tenant_weights: Optional[Dict[str, float]] = None
+    ):
+        self.model = model
+        self.limit = float(initial_limit)
+        self.min_limit = float(min_limit)
+        self.max_limit = float(max_limit)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self.in_flight = 0
+        self.baseline_latency: Dict[int, float] = {}
+        self._queue = LaneScheduler(tenant_weights)
+        self.admitted = 0
+        self.rejected = 0
+        self.errors = 0
+        self.preempted = {lane: 0 for lane in PRIORITY_LANES}
+    
+    def _fits(self, weight: int) -> bool:
+        # An idle limiter always admits, so weights above the limit can't starve
+        return self.in_flight == 0 or self.in_flight + weight <= self.limit
+    
+    async def acquire(self, weight: int = 1, lane: str = "standard", tenant: str = "anonymous") -> None:
+        if not len(self._queue) and self._fits(weight):
+            self.in_flight += weight
+            self.admitted += 1
+            return
+        
+        if len(self._queue) >= self.max_queue:
+            victim = self._queue.preemptible(lane) if lane in PREEMPTING_LANES else None
+            if victim is None:
+                self.rejected += 1
+                raise AdmissionRejected(
+                    f"Model {self.model} is at capacity ({self.in_flight} jobs in flight, queue full)",
+                    retry_after=self.queue_timeout
+                )
+            self._queue.remove(victim)
+            self.preempted[victim.lane] += 1
+            self.rejected += 1
+            victim.future.set_exception(AdmissionRejected(
+                f"Model {self.model} is at capacity (queued {victim.lane} request preempted by {lane} work)",
+                retry_after=self.queue_timeout * LANE_QUEUE_TIMEOUT_FACTORS[victim.lane]
+            ))
+        
+        waiter = Waiter(weight, lane, tenant, asyncio.get_running_loop().create_future())
+        self._queue.push(waiter)
+        # A higher lane may fit right away even if the lower lanes' heads don't
+        self._dispatch()
+        timeout = self.queue_timeout * LANE_QUEUE_TIMEOUT_FACTORS[lane]
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout=timeout)
+        except asyncio.TimeoutError:
+            if waiter.future.done():
+                # Admitted (or preempted) at the same moment the timeout fired
+                waiter.future.result()
+                return
+            self._queue.remove(waiter)
+            self.rejected += 1
+            raise AdmissionRejected(
+                f"Model {self.model} is at capacity (waited {timeout}s in queue)",
+                retry_after=timeout
+            )
+        except asyncio.CancelledError:
+            if not waiter.future.done():
+                self._queue.remove(waiter)
+            elif waiter.future.exception() is None:
+                self.release(weight)
+            raise
+    
+    def _dispatch(self) -> None:
+        # Highest lane first, fair order within it; a head that doesn't fit holds back lower lanes
+        while (waiter := self._queue.peek()) is not None and self._fits(waiter.weight):
+            self._queue.pop()
+            self.in_flight += waiter.weight
+            self.admitted += 1
+            waiter.future.set_result(None)
+    
+    def release(self, weight: int) -> None:
+        self.in_flight -= weight
+        self._dispatch()
+    
+    def utilisation(self) -> float:
+        """Admitted plus queued upstream jobs (weights, not requests) per slot of the current limit."""
+        return (self.in_flight + self._queue.weight) / self.limit
+    
+    def observe(self, latency: float, error: Optional[BaseException] = None, size: int = 1) -> None:
+        """Adjust the limit from one upstream attempt of `size` images."""
+        if error is not None and not is_retryable(error):
+            return
+        baseline = self.baseline_latency.get(size)
+        if error is not None or (baseline is not None and latency > baseline * self.latency_tolerance):
+            if error is not None:
+                self.errors += 1
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        if error is None:
+            self.baseline_latency[size] = latency if baseline is None else 0.9 * baseline + 0.1 * latency
+        # A raised limit takes effect at the next release, once the attempt's own request is done with it
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queued": len(self._queue),
+            "queued_weight": self._queue.weight,
+            "lanes": dict(self._queue.depth),
+            "preempted": dict(self.preempted),
+            "baseline_latency": dict(self.baseline_latency),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "errors": self.errors
+        }
+
+
+class AdmissionController:
+    """Holds one AdaptiveLimiter per model id."""
+    
+    def __init__(
+        self,
+        model_limits: Optional[Dict[str, Dict[str, Any]]] = None,
+        tenant_weights: Optional[Dict[str, float]] = None
+    ):
+        self.model_limits = MODEL_ADMISSION_LIMITS if model_limits is None else model_limits
+        self.tenant_weights = tenant_weights or {}
+        self.limiters: Dict[str, AdaptiveLimiter] = {}
+    
+    def limiter(self, model: str) -> AdaptiveLimiter:
+        limiter = self.limiters.get(model)
+        if limiter is None:
+            options = {**DEFAULT_ADMISSION_LIMITS, **self.model_limits.get(model, {})}
+            limiter = AdaptiveLimiter(model, tenant_weights=self.tenant_weights, **options)
+            self.limiters[model] = limiter
+        return limiter
+    
+    @asynccontextmanager
+    async def admit(self, model: str, weight: int = 1, lane: str = "standard", tenant: str = "anonymous"):
+        """
+        Hold `weight` slots of the model's budget for the duration of the block.
+        
+        Only slots are accounted here; report upstream attempts to the
+        limiter's observe() to adjust the limit.
+        """
+        limiter = self.limiter(model)
+        await limiter.acquire(weight, lane, tenant)
+        try:
+            yield
+        finally:
+            limiter.release(weight)
+    
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {model: limiter.snapshot() for model, limiter in self.limiters.items()}
+    
+    def lanes(self) -> Dict[str, Dict[str, int]]:
+        """Queue depth and preempted requests per lane, summed over models."""
+        snapshots = [limiter.snapshot() for limiter in self.limiters.values()]
+        return {
+            lane: {
+                "queued": sum(snapshot["lanes"][lane] for snapshot in snapshots),
+                "preempted": sum(snapshot["preempted"][lane] for snapshot in snapshots)
+            }
+            for lane in PRIORITY_LANES
+        }
+
+
+# ============================================================================
+# MODE PLANNER - Pick batch or parallel per request from live data
+# ============================================================================
+
+# Outcomes kept per (model, inspiration, mode) and per (model, mode)
+PLANNER_WINDOW = 100
+
+# Samples a mode needs before its numbers are trusted
+PLANNER_MIN_SAMPLES = 10
+
+# Switch away from the configured mode only if the other one scores this much better
+PLANNER_MARGIN = 0.15
+
+# Share of requests that try the other mode while it lacks samples
+PLANNER_EXPLORE_RATE = 0.05
+
+# Model budget utilisation at or above which batch (fewest calls) is forced over parallel (one call per image)
+PLANNER_LOAD_THRESHOLD = 0.75
+
+
+class ExecutionModePlanner:
+    """
+    Chooses batch vs parallel at request time within an inspiration's allowed_modes.
+    
+    Under load (the model's admission budget mostly used) batch wins, since it
+    needs the fewest upstream slots. Otherwise the mode with the
+    lower expected latency (p50 / success rate, discounted by the
+    near-duplicate rate where the diversity guard has checked images) wins,
+    preferring the configured mode unless the other is clearly better.
+    """
+    
+    def __init__(self, window: int = PLANNER_WINDOW, rng: Optional[random.Random] = None):
+        self.window = window
+        self.rng = rng or random.Random()
+        self._outcomes: Dict[Tuple[str, ...], "deque[Tuple[float, bool]]"] = {}
+        self._duplicates: Dict[Tuple[str, ...], "deque[Tuple[int, int]]"] = {}
+        self.decisions: Dict[str, int] = {}
+    
+    def record(self, model: str, inspiration: str, mode: str, latency: float, ok: bool) -> None:
+        """Record one generation outcome (cache hits and client errors are not outcomes)."""
+        for key in ((model, inspiration, mode), (model, mode)):
+            self._outcomes.setdefault(key, deque(maxlen=self.window)).append((latency, ok))
+    
+    def record_duplicates(self, model: str, inspiration: str, mode: str, checked: int, duplicates: int) -> None:
+        """Record a diversity check of one generation: images checked and near-duplicates among them."""
+        self._duplicates.setdefault((model, inspiration, mode), deque(maxlen=self.window)).append((checked, duplicates))
+    
+    def duplicate_rate(self, model: str, inspiration: str, mode: str) -> float:
+        """Share of checked images that were near-duplicates (0 without enough checks)."""
+        checks = self._duplicates.get((model, inspiration, mode))
+        if not checks or len(checks) < PLANNER_MIN_SAMPLES:
+            return 0.0
+        return sum(d for _, d in checks) / max(1, sum(c for c, _ in checks))
+    
+    def score(self, model: str, inspiration: str, mode: str) -> Optional[float]:
+        """Expected seconds per successful generation of distinct images, or None without enough samples."""
+        for key in ((model, inspiration, mode), (model, mode)):
+            outcomes = self._outcomes.get(key)
+            if outcomes and len(outcomes) >= PLANNER_MIN_SAMPLES:
+                successes = sorted(latency for latency, ok in outcomes if ok)
+                distinct = 1 - self.duplicate_rate(model, inspiration, mode)
+                if not successes or distinct <= 0:
+                    return math.inf
+                return successes[len(successes) // 2] * len(outcomes) / len(successes) / distinct
+        return None
+    
+    def choose(self, plan: "InspirationPlan", utilisation: float) -> Tuple[str, str]:
+        """
+        Pick the mode for one request.
+        
+        Args:
+            plan: Compiled inspiration plan (execution_mode, allowed_modes)
+            utilisation: (in-flight + queued weight) / limit of the model's admission budget
+        
+        Returns:
+            (mode, reason)
+        """
+        mode, reason = self._choose(plan, utilisation)
+        self.decisions[reason] = self.decisions.get(reason, 0) + 1
+        return mode, reason
+    
+    def _choose(self, plan: "InspirationPlan", utilisation: float) -> Tuple[str, str]:
+        configured = plan.execution_mode
+        if len(plan.allowed_modes) == 1:
+            return configured, "pinned"
+        if utilisation >= PLANNER_LOAD_THRESHOLD and "batch" in plan.allowed_modes:
+            return "batch", "load"
+        
+        other = next(mode for mode in plan.allowed_modes if mode != configured)
+        configured_score = self.score(plan.model, plan.name, configured)
+        other_score = self.score(plan.model, plan.name, other)
+        if configured_score is None or other_score is None:
+            if other_score is None and self.rng.random() < PLANNER_EXPLORE_RATE:
+                return other, "explore"
+            return configured, "default"
+        if other_score < configured_score * (1 - PLANNER_MARGIN):
+            return other, "faster"
+        return configured, "default"
+    
+    def snapshot(self) -> Dict[str, int]:
+        """Decisions taken since startup, by reason."""
+        return dict(self.decisions)
+
+
+# ============================================================================
+# COST BUDGETS - Per-API-key daily spend limits on estimated upstream cost
+# ============================================================================
+
+# Request header carrying the caller's API key. The header is caller-supplied, so only
+# keys listed in the budgets or weights config count as tenants (see resolve_tenant).
+TENANT_HEADER = os.environ.get("STOCK_INSPIRATIONS_TENANT_HEADER", "x-api-key")
+
+# Daily USD budgets as JSON: {"<api key>": 25.0, "*": 5.0}; "*" applies to requests
+# without an API key. When set, unlisted keys are rejected. Unset = unlimited.
+BUDGETS_JSON = os.environ.get("STOCK_INSPIRATIONS_BUDGETS", "")
+
+# SQLite file holding spend and reservations, on storage shared by all runners, so the
+# budget is enforced across runners and restarts. Unset = in memory, per runner.
+BUDGET_DB_PATH = os.environ.get("STOCK_INSPIRATIONS_BUDGET_DB")
+
+# How long a reservation holds budget if its runner dies before settling it (seconds);
+# long enough for an async job to wait out a full job queue
+BUDGET_RESERVATION_TTL = 6 * 3600.0
+
+
+class BudgetExceeded(Exception):
+    """Raised when a request would take a tenant over its budget (mapped to HTTP 402)."""
+    
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TenantRejected(Exception):
+    """Raised for a missing or unlisted API key while budgets are enforced (mapped to HTTP 401/403)."""
+    
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def tenant_id(api_key: Optional[str]) -> str:
+    """Stable tenant id for an API key; raw keys are never stored or logged."""
+    if not api_key:
+        return "anonymous"
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+def resolve_tenant(api_key: Optional[str], budgets: Dict[str, float], weights: Dict[str, float]) -> str:
+    """
+    Tenant for a request's API key.
+    
+    Nothing authenticates the header, so inventing a new key must not buy a
+    fresh budget or fair-queuing share: keys listed in the budgets or weights
+    config are tenants of their own, requests without a key share
+    "anonymous" (the "*" budget), and unlisted keys are rejected while
+    budgets are configured, or share "anonymous" otherwise.
+    
+    Raises:
+        TenantRejected: If budgets are configured and the key is unlisted (403), or missing without a "*" budget (401)
+    """
+    tenant = tenant_id(api_key)
+    if tenant in budgets or tenant in weights:
+        return tenant
+    if budgets and api_key:
+        raise TenantRejected("Unknown API key", status_code=403)
+    if budgets and "*" not in budgets:
+        raise TenantRejected(f"An API key is required (send it in the {TENANT_HEADER} header)", status_code=401)
+    return "anonymous"
+
+
+def parse_tenant_values(config: str, setting: str, allow_zero: bool = True) -> Dict[str, float]:
+    """
+    Per-API-key numbers (budgets, weights) re-keyed by tenant id, "*" kept as the default.
+    
+    Raises:
+        ValueError: If the config is not a JSON object of non-negative (or positive) numbers
+    """
+    if not config.strip():
+        return {}
+    try:
+        raw = json.loads(config)
+    except ValueError as e:
+        raise ValueError(f"{setting} is not valid JSON: {e}")
+    if not isinstance(raw, dict):
+        raise ValueError(f"{setting} must be a JSON object")
+    values = {}
+    for key, value in raw.items():
+        tenant = "*" if key == "*" else tenant_id(key)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0 or (value == 0 and not allow_zero):
+            raise ValueError(f"{setting}: value for {tenant} must be a {'non-negative' if allow_zero else 'positive'} number")
+        values[tenant] = float(value)
+    return values
+
+
+class BudgetLedger:
+    """
+    Tracks estimated spend per tenant per UTC day against its budget.
+    
+    A generation that needs upstream work reserves its estimated cost before
+    the first upstream call and settles to the cost actually incurred
+    (retries and hedges included) when it finishes, so concurrent requests
+    cannot overspend by more than their estimates' error. Cache hits and
+    coalesced requests reserve and pay nothing; async jobs reserve when
+    they are submitted.
+    
+    Spend and reservations live in SQLite. Pointed at a file on storage
+    shared by all runners (BUDGET_DB_PATH), every runner enforces the same
+    budget and spend survives restarts; the default in-memory database is
+    per runner. Reservations left behind by a crashed runner lapse after
+    BUDGET_RESERVATION_TTL.
+    """
+    
+    def __init__(self, budgets: Dict[str, float], db_path: Optional[str] = None):
+        self.budgets = budgets
+        # Autocommit, so reserve() can hold a write lock across its check and insert
+        self._db = sqlite3.connect(db_path or ":memory:", check_same_thread=False, isolation_level=None, timeout=30.0)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS budget_spend "
+            "(day INTEGER NOT NULL, tenant TEXT NOT NULL, spent REAL NOT NULL, PRIMARY KEY (day, tenant))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS budget_reservations "
+            "(reservation_id TEXT PRIMARY KEY, tenant TEXT NOT NULL, amount REAL NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._day: Optional[int] = None
+        self.rejected = 0
+    
+    @staticmethod
+    def _today() -> int:
+        return int(time.time() // 86400)
+    
+    def _roll(self) -> int:
+        day = self._today()
+        if day != self._day:
+            self._day = day
+            self._db.execute("DELETE FROM budget_spend WHERE day < ?", (day,))
+        return day
+    
+    def limit(self, tenant: str) -> Optional[float]:
+        return self.budgets.get(tenant, self.budgets.get("*"))
+    
+    def remaining(self, tenant: str) -> Optional[float]:
+        """Budget left today (None if unlimited)."""
+        limit = self.limit(tenant)
+        if limit is None:
+            return None
+        day = self._roll()
+        spent = self._db.execute(
+            "SELECT COALESCE(SUM(spent), 0) FROM budget_spend WHERE day = ? AND tenant = ?", (day, tenant)
+        ).fetchone()[0]
+        reserved = self._db.execute(
+            "SELECT COALESCE(SUM(amount), 0) FROM budget_reservations WHERE tenant = ? AND expires_at > ?",
+            (tenant, time.time())
+        ).fetchone()[0]
+        return limit - spent - reserved
+    
+    def check(self, tenant: str, amount: float = 0.0) -> None:
+        """
+        Raises:
+            BudgetExceeded: If amount does not fit in the tenant's remaining budget
+        """
+        remaining = self.remaining(tenant)
+        if remaining is not None and (amount > remaining or remaining <= 0):
+            self.rejected += 1
+            raise BudgetExceeded(
+                f"Daily budget of ${self.limit(tenant):.2f} exhausted "
+                f"(${max(0.0, remaining):.4f} left, request needs ~${amount:.4f})",
+                retry_after=(self._today() + 1) * 86400 - time.time()
+            )
+    
+    def reserve(self, tenant: str, amount: float) -> Optional[str]:
+        """
+        Hold amount against the tenant's budget; returns the reservation id for settle().
+        
+        Returns None for tenants without a budget (nothing to hold).
+        
+        Raises:
+            BudgetExceeded: If amount does not fit in the tenant's remaining budget
+        """
+        if self.limit(tenant) is None:
+            return None
+        reservation = uuid.uuid4().hex
+        # Other runners' reserve() calls wait on this lock, so none can pass the same check
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            self.check(tenant, amount)
+            self._db.execute(
+                "INSERT INTO budget_reservations (reservation_id, tenant, amount, expires_at) VALUES (?, ?, ?, ?)",
+                (reservation, tenant, amount, time.time() + BUDGET_RESERVATION_TTL)
+            )
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+        return reservation
+    
+    def settle(self, tenant: str, reservation: Optional[str], actual: float) -> None:
+        """Release a reservation (if any) and book the actual cost."""
+        day = self._roll()
+        self._db.execute("BEGIN IMMEDIATE")
+        if reservation is not None:
+            self._db.execute("DELETE FROM budget_reservations WHERE reservation_id = ?", (reservation,))
+        if actual:
+            self._db.execute(
+                "INSERT INTO budget_spend (day, tenant, spent) VALUES (?, ?, ?) "
+                "ON CONFLICT (day, tenant) DO UPDATE SET spent = spent + excluded.spent",
+                (day, tenant, actual)
+            )
+        self._db.execute("DELETE FROM budget_reservations WHERE expires_at <= ?", (time.time(),))
+        self._db.execute("COMMIT")
+    
+    def release(self, reservation: Optional[str]) -> None:
+        """Drop a reservation without booking anything (no-op if already settled)."""
+        if reservation is not None:
+            self._db.execute("DELETE FROM budget_reservations WHERE reservation_id = ?", (reservation,))
+    
+    def snapshot(self) -> Dict[str, float]:
+        """Today's spend per tenant id."""
+        day = self._roll()
+        return dict(self._db.execute("SELECT tenant, spent FROM budget_spend WHERE day = ?", (day,)).fetchall())
+
+
+# ============================================================================
+# RESULT CACHE - Content-addressed cache in front of the execution unit
+# ============================================================================
+
+# How long a cached result stays valid (seconds)
+RESULT_CACHE_TTL = 3600.0
+
+# Max entries kept in the in-process LRU tier
+RESULT_CACHE_MAX_ENTRIES = 512
+
+# Optional SQLite file for the persistent tier (unset = memory only)
+RESULT_CACHE_DB_PATH = os.environ.get("STOCK_INSPIRATIONS_CACHE_DB")
+
+
+def generation_cache_key(
+    model: str,
+    arguments: Dict[str, Any],
+    num_images: int = DEFAULT_NUM_IMAGES
+) -> str:
+    """
+    Stable hash of a generation's request inputs.
+    
+    The execution mode is deliberately left out: the planner picks it per
+    request from live load, and a mode switch must not turn an identical
+    request into a cache miss or stop it from coalescing.
+    """
+    payload = {
+        "model": model,
+        "num_images": num_images,
+        "arguments": arguments
+    }
+    encoded = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Two-tier result cache: in-process LRU with TTL, optionally backed by SQLite.
+    
+    SQLite lookups are local and sub-millisecond, so they run inline on the
+    event loop rather than in a thread.
+    """
+    
+    def __init__(
+        self,
+        max_entries: int = RESULT_CACHE_MAX_ENTRIES,
+        ttl: float = RESULT_CACHE_TTL,
+        db_path: Optional[str] = None
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, List[Dict[str, Any]]]]" = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.misses = 0
+        
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key TEXT PRIMARY KEY, images TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.commit()
+    
+    def get(self, key: str) -> Optional[List[Dict[str, Any]]]:
+        """Return cached images for key, or None if missing or expired."""
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, images = entry
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return images
+            del self._entries[key]
+        
+        if self._db is not None:
+            row = self._db.execute(
+                "SELECT images, expires_at FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                if row[1] > now:
+                    images = json.loads(row[0])
+                    self._remember(key, images, row[1])
+                    self.hits += 1
+                    return images
+                self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+                self._db.commit()
+        
+        self.misses += 1
+        return None
+    
+    def put(self, key: str, images: List[Dict[str, Any]]) -> None:
+        """Store images under key in every tier."""
+        expires_at = time.time() + self.ttl
+        self._remember(key, images, expires_at)
+        if self._db is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results (key, images, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(images), expires_at)
+            )
+            self._db.commit()
+    
+    def _remember(self, key: str, images: List[Dict[str, Any]], expires_at: float) -> None:
+        self._entries[key] = (expires_at, images)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one in-flight task.
+    
+    The shared task is shielded, so a caller that disconnects does not
+    cancel the work for the others.
+    """
+    
+    def __init__(self):
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self.leaders = 0
+        self.coalesced = 0
+    
+    def running(self, key: str) -> bool:
+        """Whether a call for key is in flight (a run() now would join it)."""
+        return key in self._in_flight
+    
+    async def run(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Await factory() for key, joining an identical call already in flight.
+        
+        Returns:
+            (result, whether this call joined another caller's task)
+        """
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task), True
+        
+        self.leaders += 1
+        task = asyncio.ensure_future(factory())
+        self._in_flight[key] = task
+        task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(task), False
+
+
+async def execute_generation_cached(
+    cache: Optional[ResultCache],
+    backend: ModelBackend,
+    arguments: Dict[str, Any],
+    execution_mode: str,
+    request_id: str,
+    num_images: int = DEFAULT_NUM_IMAGES,
+    variant_timeout: Optional[float] = VARIANT_TIMEOUT,
+    on_image: Optional[ImageCallback] = None,
+    single_flight: Optional[SingleFlight] = None,
+    admission: Optional[AdmissionController] = None,
+    stats: Optional[GenerationStats] = None,
+    priority: str = "standard",
+    tenant: str = "anonymous",
+    budgets: Optional[BudgetLedger] = None,
+    reservation: Optional[str] = None
+) -> Tuple[List[Dict[str, Any]], str]:
+    """
+    Run a generation behind the result cache and single-flight coalescing.
+    
+    Only complete results are stored, so a partial run (dropped calls) is
+    retried on the next call. Upstream work (never cache hits or
+    coalesced calls) reserves its estimated cost against the tenant's
+    budget, if given, and goes through the model's admission limiter, if
+    given, queued in the priority lane and tenant's fair share; hedges take
+    their own slot the same way. A reservation made earlier (async jobs
+    reserve at submit) is used instead of a new one and always settled,
+    to zero on a cache hit.
+    
+    Raises:
+        BudgetExceeded: If the tenant cannot afford the upstream work
+        AdmissionRejected: If the model's limiter sheds the request
+    
+    Returns:
+        (generated images, source) where source is "generated", "cache" or "coalesced"
+    """
+    model = backend.model_id
+    if stats is None:
+        stats = GenerationStats()
+    prepaid = reservation is not None
+    reserved = False
+    
+    def reserve() -> None:
+        # Called by the caller that will run the upstream work, right before it starts
+        nonlocal reservation, reserved
+        if budgets is not None:
+            if not prepaid:
+                estimate = estimate_generation_cost(backend, arguments, execution_mode, num_images)
+                reservation = budgets.reserve(tenant, estimate)
+            reserved = True
+    
+    async def generate() -> List[Dict[str, Any]]:
+        cost_before = stats.cost
+        try:
+            if admission is None:
+                return await run_generation(
+                    backend, arguments, execution_mode, request_id,
+                    num_images, variant_timeout, on_image, stats
+                )
+            weight = len(split_images(num_images, execution_mode, backend.max_images_per_call))
+            
+            def admit_hedge() -> AsyncContextManager[Any]:
+                # A hedge is one more upstream job, admitted like the calls it duplicates
+                return admission.admit(model, weight=1, lane=priority, tenant=tenant)
+            
+            def on_attempt(call_images: int, latency: float, error: Optional[BaseException]) -> None:
+                # Per attempt, not per generation: no retry backoff or mixed call sizes in the samples
+                admission.limiter(model).observe(latency, error, size=call_images)
+            
+            admission_start = time.time()
+            async with admission.admit(model, weight=weight, lane=priority, tenant=tenant):
+                stats.record("admission_wait", time.time() - admission_start)
+                return await run_generation(
+                    backend, arguments, execution_mode, request_id,
+                    num_images, variant_timeout, on_image, stats, admit_hedge, on_attempt
+                )
+        finally:
+            if reserved:
+                budgets.settle(tenant, reservation, stats.cost - cost_before)
+    
+    async def lookup() -> Tuple[List[Dict[str, Any]], str]:
+        if cache is None and single_flight is None:
+            reserve()
+            return await generate(), "generated"
+        
+        key = generation_cache_key(model, arguments, num_images)
+        
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                print(f"[{request_id}] Cache hit: {key[:12]}")
+                if on_image:
+                    for image in cached:
+                        await on_image(image)
+                return cached, "cache"
+        
+        async def generate_and_store() -> List[Dict[str, Any]]:
+            images = await generate()
+            if cache is not None and len(images) >= num_images:
+                cache.put(key, images)
+            return images
+        
+        if single_flight is None:
+            reserve()
+            return await generate_and_store(), "generated"
+        
+        # Only the leader pays; nothing awaits between this check and run(), so it stays accurate
+        if not single_flight.running(key):
+            reserve()
+        images, joined = await single_flight.run(key, generate_and_store)
+        if not joined:
+            return images, "generated"
+        
+        # The leader's on_image fired for its own caller; replay for this one
+        print(f"[{request_id}] Coalesced with in-flight request: {key[:12]}")
+        if on_image:
+            for image in images:
+                await on_image(image)
+        return images, "coalesced"
+    
+    try:
+        return await lookup()
+    finally:
+        if prepaid and budgets is not None and not reserved:
+            # Served from cache or coalesced: the prepaid reservation is released unspent
+            budgets.settle(tenant, reservation, 0.0)
+
+
+# ============================================================================
+# INPUT PREFLIGHT - Validate (and optionally shrink) input images up front
+# ============================================================================
+
+# Content types the models accept as input
+PREFLIGHT_ALLOWED_TYPES = ("image/jpeg", "image/png", "image/webp")
+
+# Inputs larger than this are rejected outright
+PREFLIGHT_MAX_BYTES = 25 * 1024 * 1024
+
+# Inputs above either limit are downscaled and re-hosted (if Pillow is available)
+PREFLIGHT_REHOST_BYTES = 8 * 1024 * 1024
+PREFLIGHT_MAX_DIMENSION = 2048
+
+# Inputs smaller than this on either side are rejected
+PREFLIGHT_MIN_DIMENSION = 64
+
+# Bytes fetched to read the image header (dimensions)
+PREFLIGHT_HEADER_BYTES = 64 * 1024
+
+# How long a check without an ETag stays valid (seconds)
+PREFLIGHT_CACHE_TTL = 600.0
+
+# Schemes preflight will fetch; data:image/ URIs carry the image inline and are never fetched
+PREFLIGHT_FETCH_SCHEMES = ("http", "https")
+
+
+class RehostFailed(Exception):
+    """Raised when an oversized input could not be fetched or re-hosted on fal storage (mapped to HTTP 502)."""
+
+
+def is_public_address(address: str) -> bool:
+    """Whether an IP address is publicly routable (not private, loopback, link-local, reserved or multicast)."""
+    ip = ipaddress.ip_address(address)
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+async def resolve_host(host: str, port: int) -> List[str]:
+    """All addresses a host name resolves to."""
+    infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    return list(dict.fromkeys(info[4][0] for info in infos))
+
+
+async def public_addresses(
+    url: httpx.URL,
+    resolve: Optional[Callable[[str, int], Awaitable[List[str]]]] = None
+) -> List[str]:
+    """
+    Addresses of a URL's host, if it may be contacted on behalf of a caller.
+    
+    Raises:
+        ValueError: For a scheme other than http/https or a host with any non-public address
+        OSError: If the host does not resolve
+    """
+    if url.scheme not in PREFLIGHT_FETCH_SCHEMES:
+        raise ValueError(f"{url.scheme}:// URLs are not allowed")
+    addresses = await (resolve or resolve_host)(url.host, url.port or (443 if url.scheme == "https" else 80))
+    if not addresses or not all(is_public_address(address) for address in addresses):
+        raise ValueError(f"{url.host} is not a public address")
+    return addresses
+
+
+class PublicAddressTransport(httpx.AsyncBaseTransport):
+    """
+    Transport that only connects to public addresses.
+    
+    Input image and webhook URLs come from callers, so every request (redirect hops
+    included) has its host resolved first and is refused unless it uses
+    http/https and every resolved address is public. The connection is then
+    pinned to the checked address, so a second DNS answer cannot point it
+    somewhere else.
+    
+    Raises:
+        ValueError: For a disallowed scheme or a non-public address
+    """
+    
+    def __init__(
+        self,
+        transport: httpx.AsyncBaseTransport,
+        resolve: Optional[Callable[[str, int], Awaitable[List[str]]]] = None
+    ):
+        self.transport = transport
+        self.resolve = resolve
+    
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        url = request.url
+        try:
+            addresses = await public_addresses(url, self.resolve)
+        except OSError as e:
+            raise httpx.ConnectError(f"Could not resolve {url.host}: {e}", request=request)
+        
+        # The Host header keeps the name; TLS verifies the certificate against it via SNI
+        extensions = dict(request.extensions)
+        if url.scheme == "https":
+            extensions["sni_hostname"] = url.host
+        pinned = httpx.Request(
+            request.method,
+            url.copy_with(host=addresses[0]),
+            headers=request.headers,
+            stream=request.stream,
+            extensions=extensions
+        )
+        return await self.transport.handle_async_request(pinned)
+    
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+@dataclass(frozen=True)
+class PreflightResult:
+    """Outcome of checking one input image URL."""
+    url: str
+    content_type: Optional[str]
+    size: Optional[int]
+    width: Optional[int]
+    height: Optional[int]
+    etag: Optional[str] = None
+    rehosted_from: Optional[str] = None
+
+
+def image_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    """Read (width, height) from a PNG, JPEG, WebP or GIF header, if present in data."""
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+    
+    if data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+        return int.from_bytes(data[6:8], "little"), int.from_bytes(data[8:10], "little")
+    
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP" and len(data) >= 30:
+        chunk = data[12:16]
+        if chunk == b"VP8 ":
+            return int.from_bytes(data[26:28], "little") & 0x3FFF, int.from_bytes(data[28:30], "little") & 0x3FFF
+        if chunk == b"VP8L":
+            bits = int.from_bytes(data[21:25], "little")
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8X":
+            return int.from_bytes(data[24:27], "little") + 1, int.from_bytes(data[27:30], "little") + 1
+        return None
+    
+    if data[:2] == b"\xff\xd8":
+        # Walk JPEG segments until a start-of-frame marker
+        pos = 2
+        while pos + 9 < len(data):
+            if data[pos] != 0xFF:
+                pos += 1
+                continue
+            marker = data[pos + 1]
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+                pos += 1 if marker == 0xFF else 2
+                continue
+            length = int.from_bytes(data[pos + 2:pos + 4], "big")
+            if marker in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF):
+                height = int.from_bytes(data[pos + 5:pos + 7], "big")
+                width = int.from_bytes(data[pos + 7:pos + 9], "big")
+                return width, height
+            pos += 2 + length
+    
+    return None
+
+
+class ImagePreflight:
+    """
+    Checks input image URLs before any upstream job is queued.
+    
+    A URL checked within PREFLIGHT_CACHE_TTL is served from the cache with no
+    request at all. Otherwise it gets a HEAD (status, content type, size,
+    ETag) and, unless the cached check has the same ETag, a ranged GET of the
+    header to read its dimensions. Oversized images are downscaled to
+    PREFLIGHT_MAX_DIMENSION and re-hosted on fal storage when rehost is on
+    and Pillow is installed; otherwise they are passed through unchanged
+    (up to PREFLIGHT_MAX_BYTES). The client should use a
+    PublicAddressTransport so caller URLs cannot reach internal hosts.
+    """
+    
+    def __init__(self, client: Any, rehost: bool = True, max_entries: int = 1024):
+        self.client = client
+        self.rehost = rehost
+        self.max_entries = max_entries
+        self._checked: "OrderedDict[str, Tuple[Optional[str], float, PreflightResult]]" = OrderedDict()
+        self.checks = 0
+        self.cache_hits = 0
+        self.rejected = 0
+        self.rehosted = 0
+    
+    async def check_all(self, urls: List[str]) -> List[PreflightResult]:
+        """
+        Check every URL concurrently.
+        
+        Raises:
+            ValueError: Describing every URL that failed its check
+        """
+        results = await asyncio.gather(*[self.check(url) for url in urls], return_exceptions=True)
+        errors = [str(r) for r in results if isinstance(r, ValueError)]
+        if errors:
+            self.rejected += 1
+            raise ValueError("Invalid input image(s): " + "; ".join(errors))
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+    
+    async def check(self, url: str) -> PreflightResult:
+        """
+        Check one URL.
+        
+        Raises:
+            ValueError: If the image is unusable or its URL is not allowed
+            RehostFailed: If an oversized image could not be re-hosted
+        """
+        if url.startswith("data:image/"):
+            # Inline inputs are passed through unchecked
+            return PreflightResult(url=url, content_type=None, size=None, width=None, height=None)
+        if not url.startswith(tuple(f"{scheme}://" for scheme in PREFLIGHT_FETCH_SCHEMES)):
+            raise ValueError(f"{url[:64]} is not an http(s):// or data:image/ URL")
+        
+        self.checks += 1
+        fresh = self._fresh(url)
+        if fresh is not None:
+            self.cache_hits += 1
+            return fresh
+        
+        try:
+            head = await self.client.head(url, follow_redirects=True)
+            if head.status_code in (403, 405, 501):
+                # Some hosts refuse HEAD - the ranged GET below carries the same headers
+                head = None
+            elif head.status_code >= 400:
+                raise ValueError(f"{url} returned HTTP {head.status_code}")
+            
+            etag = head.headers.get("etag") if head is not None else None
+            cached = self._cached(url, etag)
+            if cached is not None:
+                # Unchanged since the last check: good for another TTL
+                self.cache_hits += 1
+                self._remember(url, etag, cached)
+                return cached
+            
+            # Servers that ignore Range still only get read up to the header size
+            header_bytes = b""
+            async with self.client.stream(
+                "GET",
+                url,
+                headers={"Range": f"bytes=0-{PREFLIGHT_HEADER_BYTES - 1}"},
+                follow_redirects=True
+            ) as response:
+                if response.status_code >= 400:
+                    raise ValueError(f"{url} returned HTTP {response.status_code}")
+                async for chunk in response.aiter_bytes():
+                    header_bytes += chunk
+                    if len(header_bytes) >= PREFLIGHT_HEADER_BYTES:
+                        break
+        except httpx.HTTPError as e:
+            raise ValueError(f"{url} could not be fetched ({type(e).__name__})")
+        
+        headers = head.headers if head is not None else response.headers
+        etag = etag or response.headers.get("etag")
+        content_type = (headers.get("content-type") or response.headers.get("content-type") or "").split(";")[0].strip().lower()
+        size = _content_size(head, response)
+        dimensions = image_dimensions(header_bytes)
+        
+        if content_type in ("", "application/octet-stream", "binary/octet-stream"):
+            # Generic or missing type (common on object storage) - trust the header sniff
+            if dimensions is None:
+                raise ValueError(f"{url} is not a recognizable image")
+        elif content_type not in PREFLIGHT_ALLOWED_TYPES:
+            raise ValueError(f"{url} has unsupported content type {content_type}")
+        if size is not None and size > PREFLIGHT_MAX_BYTES:
+            raise ValueError(f"{url} is {size / 1024 / 1024:.1f} MB (max {PREFLIGHT_MAX_BYTES // 1024 // 1024} MB)")
+        if dimensions is not None and min(dimensions) < PREFLIGHT_MIN_DIMENSION:
+            raise ValueError(f"{url} is {dimensions[0]}x{dimensions[1]} (min {PREFLIGHT_MIN_DIMENSION}px per side)")
+        
+        result = PreflightResult(
+            url=url,
+            content_type=content_type or None,
+            size=size,
+            width=dimensions[0] if dimensions else None,
+            height=dimensions[1] if dimensions else None,
+            etag=etag
+        )
+        
+        oversized = (
+            (size is not None and size > PREFLIGHT_REHOST_BYTES)
+            or (dimensions is not None and max(dimensions) > PREFLIGHT_MAX_DIMENSION)
+        )
+        if oversized and self.rehost:
+            result = await self._downscale_and_rehost(result)
+        
+        self._remember(url, etag, result)
+        return result
+    
+    async def _downscale_and_rehost(self, result: PreflightResult) -> PreflightResult:
+        try:
+            from PIL import Image
+        except ImportError:
+            return result
+        
+        # Streamed with a cap: without a Content-Length the HEAD size check could not apply
+        body = bytearray()
+        try:
+            async with self.client.stream("GET", result.url, follow_redirects=True) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes():
+                    body += chunk
+                    if len(body) > PREFLIGHT_MAX_BYTES:
+                        raise ValueError(f"{result.url} is over {PREFLIGHT_MAX_BYTES // 1024 // 1024} MB")
+        except httpx.HTTPError as e:
+            raise RehostFailed(f"Could not fetch oversized input {result.url} to downscale it ({type(e).__name__})")
+        
+        def shrink() -> Tuple[bytes, str, Tuple[int, int]]:
+            image = Image.open(io.BytesIO(body))
+            image.thumbnail((PREFLIGHT_MAX_DIMENSION, PREFLIGHT_MAX_DIMENSION))
+            buffer = io.BytesIO()
+            if image.mode in ("RGBA", "LA", "P"):
+                image.save(buffer, format="PNG", optimize=True)
+                return buffer.getvalue(), "image/png", image.size
+            image.convert("RGB").save(buffer, format="JPEG", quality=92)
+            return buffer.getvalue(), "image/jpeg", image.size
+        
+        try:
+            data, content_type, (width, height) = await asyncio.to_thread(shrink)
+        except (OSError, Image.DecompressionBombError) as e:
+            # Pillow raises OSError (UnidentifiedImageError) for data it cannot decode
+            raise ValueError(f"{result.url} could not be decoded as an image ({type(e).__name__})")
+        try:
+            url = await fal_upload(data, content_type)
+        except Exception as e:
+            print(f"Re-hosting {result.url} failed: {type(e).__name__}: {e}")
+            raise RehostFailed(f"Could not re-host downscaled input {result.url} on fal storage; retry, or send it at most {PREFLIGHT_MAX_DIMENSION}px per side")
+        self.rehosted += 1
+        print(f"Re-hosted {result.url} ({result.size} bytes) as {width}x{height} ({len(data)} bytes)")
+        return PreflightResult(
+            url=url,
+            content_type=content_type,
+            size=len(data),
+            width=width,
+            height=height,
+            etag=result.etag,
+            rehosted_from=result.url
+        )
+    
+    def _fresh(self, url: str) -> Optional[PreflightResult]:
+        """Result of a check made within PREFLIGHT_CACHE_TTL, trusted without revalidation."""
+        entry = self._checked.get(url)
+        if entry is None or time.time() - entry[1] >= PREFLIGHT_CACHE_TTL:
+            return None
+        self._checked.move_to_end(url)
+        return entry[2]
+    
+    def _cached(self, url: str, etag: Optional[str]) -> Optional[PreflightResult]:
+        """Result of an older check, if the URL still has the same ETag."""
+        entry = self._checked.get(url)
+        if entry is None or etag is None or entry[0] != etag:
+            return None
+        self._checked.move_to_end(url)
+        return entry[2]
+    
+    def _remember(self, url: str, etag: Optional[str], result: PreflightResult) -> None:
+        self._checked[url] = (etag, time.time(), result)
+        self._checked.move_to_end(url)
+        while len(self._checked) > self.max_entries:
+            self._checked.popitem(last=False)
+
+
+def _content_size(head: Any, response: Any) -> Optional[int]:
+    """Total image size from HEAD Content-Length or the ranged GET's Content-Range."""
+    if head is not None and head.headers.get("content-length"):
+        return int(head.headers["content-length"])
+    content_range = response.headers.get("content-range", "")
+    if "/" in content_range and not content_range.endswith("/*"):
+        return int(content_range.rsplit("/", 1)[1])
+    if response.status_code == 200 and response.headers.get("content-length"):
+        return int(response.headers["content-length"])
+    return None
+
+
+# ============================================================================
+# OUTPUT RENDITIONS - Transcode and resize generated images for delivery
+# ============================================================================
+
+# Delivery formats for renditions (models always return lossless PNG)
+RENDITION_FORMATS = ("webp", "jpeg", "avif", "png")
+
+# Pillow format name and content type per rendition format
+RENDITION_ENCODERS = {
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "avif": ("AVIF", "image/avif"),
+    "png": ("PNG", "image/png"),
+}
+
+# Max thumbnail sizes per request (each is a max width/height in pixels)
+RENDITION_MAX_SIZES = 6
+
+# Generated images fetched and transcoded at the same time, across requests
+RENDITION_MAX_CONCURRENCY = 8
+
+
+RenditionFormat = Literal[RENDITION_FORMATS]  # type: ignore
+
+
+def rendition_format_supported(output_format: str) -> bool:
+    """Whether the installed Pillow can encode output_format (AVIF needs libavif)."""
+    try:
+        from PIL import features
+    except ImportError:
+        return False
+    if output_format == "avif":
+        if features.check("avif"):
+            return True
+        # Older Pillow builds get AVIF from the optional plugin
+        return importlib.util.find_spec("pillow_avif") is not None
+    return True
+
+
+def encode_renditions(
+    data: bytes,
+    output_format: str,
+    quality: int,
+    sizes: List[int],
+    include_original: bool
+) -> List[Tuple[str, bytes, int, int]]:
+    """
+    Decode data once and encode every requested rendition.
+    
+    Sizes are processed largest first, each downscaled from the previous
+    rendition rather than from the full image. Sizes at or above the
+    original's dimensions are not upscaled and collapse into one rendition.
+    
+    Returns:
+        (label, encoded bytes, width, height) per rendition: "original", then
+        the sizes as their pixel value, largest first
+    """
+    from PIL import Image, features
+    if output_format == "avif" and not features.check("avif"):
+        import pillow_avif  # noqa: F401 - registers the AVIF plugin on older Pillow
+    
+    pillow_format, _ = RENDITION_ENCODERS[output_format]
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    if output_format == "jpeg":
+        image = image.convert("RGB")
+    elif image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() or image.mode == "P" else "RGB")
+    
+    save_options = {
+        "webp": {"quality": quality, "method": 4},
+        "jpeg": {"quality": quality, "optimize": True, "progressive": True},
+        "avif": {"quality": quality},
+        "png": {"optimize": True},
+    }[output_format]
+    
+    def encode(img: Any) -> bytes:
+        buffer = io.BytesIO()
+        img.save(buffer, format=pillow_format, **save_options)
+        return buffer.getvalue()
+    
+    renditions = []
+    seen = set()
+    if include_original:
+        renditions.append(("original", encode(image), image.width, image.height))
+        seen.add(image.size)
+    current = image
+    for size in sorted(set(sizes), reverse=True):
+        if size < max(current.size):
+            current = current.copy()
+            current.thumbnail((size, size), Image.LANCZOS)
+        if current.size in seen:
+            continue
+        seen.add(current.size)
+        renditions.append((str(size), encode(current), current.width, current.height))
+    return renditions
+
+
+class RenditionPipeline:
+    """
+    Post-processes generated images into delivery renditions.
+    
+    Images are fetched and transcoded concurrently (bounded by
+    RENDITION_MAX_CONCURRENCY); each image is decoded once and all its sizes
+    are encoded in one worker-thread pass. Renditions are uploaded to fal
+    storage, or only measured when upload is off.
+    """
+    
+    def __init__(self, client: Any, max_concurrency: int = RENDITION_MAX_CONCURRENCY):
+        self.client = client
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.images = 0
+        self.renditions = 0
+        self.failures = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+    
+    async def render_all(self, images: List[Dict[str, Any]], options: Any) -> List[Dict[str, Any]]:
+        """
+        Add "renditions" (or "rendition_error") to a copy of every image dict.
+        
+        A failed image keeps its original URL; other images are unaffected.
+        """
+        async def render_one(image: Dict[str, Any]) -> Dict[str, Any]:
+            try:
+                return {**image, "renditions": await self.render(image["url"], options)}
+            except Exception as e:
+                self.failures += 1
+                print(f"Renditions failed for {image['url']}: {e}")
+                return {**image, "rendition_error": str(e) or type(e).__name__}
+        
+        return await asyncio.gather(*[render_one(image) for image in images])
+    
+    async def render(self, url: str, options: Any) -> List[Dict[str, Any]]:
+        """Fetch one image and return its renditions as dicts (see Rendition)."""
+        async with self._semaphore:
+            response = await self.client.get(url, follow_redirects=True)
+            if response.status_code >= 400:
+                raise ValueError(f"{url} returned HTTP {response.status_code}")
+            encoded = await asyncio.to_thread(
+                encode_renditions,
+                response.content,
+                options.format,
+                options.quality,
+                options.sizes,
+                options.include_original
+            )
+        self.images += 1
+        self.bytes_in += len(response.content)
+        
+        _, content_type = RENDITION_ENCODERS[options.format]
+        if options.upload:
+            urls = await asyncio.gather(*[fal_upload(data, content_type) for _, data, _, _ in encoded])
+        else:
+            urls = [None] * len(encoded)
+        
+        renditions = []
+        for (label, data, width, height), rendition_url in zip(encoded, urls):
+            self.renditions += 1
+            self.bytes_out += len(data)
+            renditions.append({
+                "label": label,
+                "url": rendition_url,
+                "format": options.format,
+                "content_type": content_type,
+                "width": width,
+                "height": height,
+                "bytes": len(data)
+            })
+        return renditions
+    
+    def snapshot(self) -> Dict[str, int]:
+        return {
+            "images": self.images,
+            "renditions": self.renditions,
+            "failures": self.failures,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out
+        }
+
+
+# ============================================================================
+# DIVERSITY GUARD - Perceptual-hash near-duplicate detection of variants
+# ============================================================================
+
+# Side of the grayscale thumbnail the DCT hash is computed from
+PHASH_SAMPLE_SIZE = 32
+
+# Low-frequency DCT block kept for the hash (8x8 = 64-bit hash)
+PHASH_BLOCK_SIZE = 8
+
+# Hashes within this many differing bits (of 64) count as near-duplicates
+DIVERSITY_MAX_DISTANCE = 10
+
+# Regeneration rounds for near-duplicates before they are returned flagged
+DIVERSITY_MAX_ROUNDS = 1
+
+
+def perceptual_hashes(images: List[bytes]) -> Any:
+    """
+    DCT perceptual hash of each image, computed for all images at once.
+    
+    Each image is reduced to a PHASH_SAMPLE_SIZE grayscale square; one
+    batched matrix product gives every 2D DCT, and each bit of the hash is
+    whether a low-frequency coefficient is above that image's median.
+    
+    Returns:
+        Boolean array of shape (len(images), PHASH_BLOCK_SIZE ** 2)
+    """
+    import numpy as np
+    from PIL import Image
+    
+    size = PHASH_SAMPLE_SIZE
+    pixels = np.stack([
+        np.asarray(
+            Image.open(io.BytesIO(data)).convert("L").resize((size, size), Image.LANCZOS),
+            dtype=np.float32
+        )
+        for data in images
+    ])
+    n = np.arange(size)
+    dct = np.sqrt(2 / size) * np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size))
+    dct[0] /= np.sqrt(2)
+    coefficients = (dct @ pixels @ dct.T)[:, :PHASH_BLOCK_SIZE, :PHASH_BLOCK_SIZE].reshape(len(images), -1)
+    # The DC term (overall brightness) is excluded from the median
+    median = np.median(coefficients[:, 1:], axis=1, keepdims=True)
+    return coefficients > median
+
+
+def hamming_distances(hashes: Any, others: Any) -> Any:
+    """Pairwise differing-bit counts, shape (len(hashes), len(others))."""
+    return (hashes[:, None, :] != others[None, :, :]).sum(axis=-1)
+
+
+def near_duplicates(hashes: Any, max_distance: int = DIVERSITY_MAX_DISTANCE) -> List[Optional[int]]:
+    """
+    For each image, the position of an earlier kept image it nearly duplicates, else None.
+    
+    The first image of a group of near-duplicates is kept; later ones are
+    flagged against it.
+    """
+    distances = hamming_distances(hashes, hashes)
+    duplicate_of: List[Optional[int]] = []
+    kept: List[int] = []
+    for i in range(len(hashes)):
+        match = next((j for j in kept if distances[i, j] <= max_distance), None)
+        duplicate_of.append(match)
+        if match is None:
+            kept.append(i)
+    return duplicate_of
+
+
+class DiversityGuard:
+    """Fetches generated images concurrently and hashes them for near-duplicate checks."""
+    
+    def __init__(self, client: Any):
+        self.client = client
+    
+    async def hashes(self, urls: List[str]) -> Any:
+        """
+        Perceptual hashes of the images at urls.
+        
+        Raises:
+            ValueError: If an image cannot be fetched
+        """
+        async def fetch(url: str) -> bytes:
+            response = await self.client.get(url, follow_redirects=True)
+            if response.status_code >= 400:
+                raise ValueError(f"{url} returned HTTP {response.status_code}")
+            return response.content
+        
+        images = await asyncio.gather(*[fetch(url) for url in urls])
+        return await asyncio.to_thread(perceptual_hashes, images)
+
+
+# ============================================================================
+# METRICS - Prometheus-style request and stage histograms
+# ============================================================================
+
+# Histogram buckets (seconds), from in-process stages up to full generations
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 7.5, 10, 15, 20, 30, 45, 60, 90, 120)
+
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], le: Optional[str] = None) -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Monotonic counter with labels, rendered in Prometheus text format."""
+    
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values: Dict[Tuple[str, ...], float] = {}
+    
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.label_names)
+        self._values[key] = self._values.get(key, 0) + amount
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram with labels, rendered in Prometheus text format."""
+    
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        label_names: Tuple[str, ...],
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS
+    ):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+    
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.label_names)
+        # Per series: one count per bucket, then +Inf count and sum
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0.0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += 1
+        series[-1] += value
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self._series.items()):
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, f'{bound:g}')} {count:g}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, '+Inf')} {series[-2]:g}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {series[-2]:g}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {series[-1]}")
+        return lines
+
+
+class AppMetrics:
+    """All metrics exported by the /metrics endpoint."""
+    
+    def __init__(self):
+        labels = ("inspiration", "model", "execution_mode")
+        self.request_seconds = Histogram(
+            "stock_inspirations_request_seconds",
+            "End-to-end request latency",
+            labels + ("quality", "status")
+        )
+        self.stage_seconds = Histogram(
+            "stock_inspirations_stage_seconds",
+            "Latency of each request stage (validation, preflight, submit, queue_wait, model_runtime, ...)",
+            ("stage",) + labels
+        )
+        self.upstream_calls = Counter(
+            "stock_inspirations_upstream_calls_total",
+            "Upstream model jobs submitted",
+            labels
+        )
+        self.retries = Counter("stock_inspirations_retries_total", "Upstream jobs retried", labels)
+        self.hedges = Counter("stock_inspirations_hedges_total", "Hedge jobs submitted for stragglers", labels)
+        self.dropped_calls = Counter(
+            "stock_inspirations_dropped_calls_total",
+            "Upstream calls that failed or timed out for good, leaving their images missing",
+            labels
+        )
+        # Per quality tier: what each tier costs upstream
+        self.inference_seconds = Counter(
+            "stock_inspirations_inference_seconds_total",
+            "Model inference time reported by fal for completed upstream jobs",
+            ("model", "quality")
+        )
+        self.images = Counter("stock_inspirations_images_total", "Images generated", ("model", "quality"))
+        self.lane_wait_seconds = Histogram(
+            "stock_inspirations_lane_wait_seconds",
+            "Time generations waited for upstream admission, per priority lane",
+            ("lane",)
+        )
+        self.cost = Counter(
+            "stock_inspirations_cost_usd_total",
+            "Estimated USD cost of upstream jobs (divide by images_total for cost per image)",
+            ("model", "quality", "execution_mode")
+        )
+        # Diversity guard: duplicates / checked is the near-duplicate rate per inspiration and mode
+        self.diversity_checked = Counter(
+            "stock_inspirations_diversity_checked_total",
+            "Generated images checked for near-duplicates",
+            labels
+        )
+        self.duplicates = Counter(
+            "stock_inspirations_near_duplicates_total",
+            "Generated images found to be near-duplicates of another image in the same result",
+            labels
+        )
+        self.regenerated = Counter(
+            "stock_inspirations_regenerated_total",
+            "Near-duplicate images replaced by a regenerated one",
+            labels
+        )
+    
+    def record_request(
+        self,
+        inspiration: str,
+        model: str,
+        execution_mode: str,
+        quality: str,
+        status: str,
+        seconds: float,
+        stats: GenerationStats,
+        priority: str = "standard"
+    ) -> None:
+        labels = {"inspiration": inspiration, "model": model, "execution_mode": execution_mode}
+        self.request_seconds.observe(seconds, quality=quality, status=status, **labels)
+        self.inference_seconds.inc(stats.inference_seconds, model=model, quality=quality)
+        self.images.inc(stats.images, model=model, quality=quality)
+        self.cost.inc(stats.cost, model=model, quality=quality, execution_mode=execution_mode)
+        for stage, stage_seconds in stats.spans:
+            self.stage_seconds.observe(stage_seconds, stage=stage, **labels)
+            if stage == "admission_wait":
+                self.lane_wait_seconds.observe(stage_seconds, lane=priority)
+        self.upstream_calls.inc(stats.upstream_calls, **labels)
+        self.retries.inc(stats.retries, **labels)
+        self.hedges.inc(stats.hedges, **labels)
+        self.dropped_calls.inc(len(stats.dropped), **labels)
+        if stats.diversity_checked:
+            self.diversity_checked.inc(stats.diversity_checked, **labels)
+            self.duplicates.inc(stats.duplicates, **labels)
+            self.regenerated.inc(stats.regenerated, **labels)
+    
+    def render(self) -> List[str]:
+        lines: List[str] = []
+        for metric in (
+            self.request_seconds, self.stage_seconds, self.lane_wait_seconds, self.upstream_calls,
+            self.retries, self.hedges, self.dropped_calls, self.inference_seconds, self.images, self.cost,
+            self.diversity_checked, self.duplicates, self.regenerated
+        ):
+            lines.extend(metric.render())
+        return lines
+
+
+def render_gauges(name: str, help_text: str, label_name: str, values: Dict[str, float]) -> List[str]:
+    """Render a point-in-time gauge family (e.g. admission limits per model)."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    for label_value, value in sorted(values.items()):
+        lines.append(f"{name}{_format_labels((label_name,), (label_value,))} {value}")
+    return lines
+
+
+def render_counters(name: str, help_text: str, label_name: str, values: Dict[str, float]) -> List[str]:
+    """Render totals kept by a component since startup (e.g. cache hits) as a Counter named name_total."""
+    counter = Counter(f"{name}_total", help_text, (label_name,))
+    for label_value, value in values.items():
+        counter.inc(value, **{label_name: label_value})
+    return counter.render()
+
+
+# ============================================================================
+# ASYNC JOBS - Submit now, poll or receive a webhook later
+# ============================================================================
+
+# Background workers running queued jobs (per app instance)
+JOB_WORKERS = 4
+
+# Max jobs waiting for a worker; further submissions get 429
+JOB_QUEUE_MAX = 1000
+
+# How long finished job records are kept (seconds)
+JOB_TTL = 24 * 3600.0
+
+# SQLite file for job records, on storage shared by all runners. /jobs is
+# disabled without it: a poll may land on any runner, and the app scales to zero.
+JOB_STORE_DB_PATH = os.environ.get("STOCK_INSPIRATIONS_JOB_DB")
+
+# Runner keep-alive (seconds) when jobs are enabled, so queued jobs outlive the request that queued them
+JOB_KEEP_ALIVE = 900
+
+# Webhook delivery attempts, with full-jitter exponential backoff between them
+WEBHOOK_ATTEMPTS = 4
+WEBHOOK_BASE_DELAY = 1.0
+WEBHOOK_MAX_DELAY = 30.0
+
+# Runs one job: gets the stored input, job id, tenant id and budget reservation, returns the output dict
+JobRunner = Callable[[Dict[str, Any], str, str, Optional[str]], Awaitable[Dict[str, Any]]]
+
+
+class SQLiteJobStore:
+    """Job records persisted as JSON in a SQLite table."""
+    
+    def __init__(self, db_path: str, ttl: float = JOB_TTL):
+        self.ttl = ttl
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs "
+            "(job_id TEXT PRIMARY KEY, record TEXT NOT NULL, expires_at REAL)"
+        )
+        self._db.commit()
+    
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._db.execute(
+            "SELECT record, expires_at FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        if row[1] is not None and row[1] < time.time():
+            self._db.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+            self._db.commit()
+            return None
+        return json.loads(row[0])
+    
+    def put(self, record: Dict[str, Any]) -> None:
+        completed_at = record.get("completed_at")
+        self._db.execute(
+            "INSERT OR REPLACE INTO jobs (job_id, record, expires_at) VALUES (?, ?, ?)",
+            (record["job_id"], json.dumps(record), completed_at + self.ttl if completed_at else None)
+        )
+        self._db.commit()
+
+
+def make_job_store(db_path: Optional[str] = JOB_STORE_DB_PATH) -> Optional[SQLiteJobStore]:
+    """SQLite store if db_path is set, else None (jobs disabled)."""
+    return SQLiteJobStore(db_path) if db_path else None
+
 
-async def execute_generation(
-    model: str,
-    prompt: str,
-    image_urls: List[str],
-    aspect_ratio: Optional[str],
-    execution_mode: str,
-    request_id: str,
-    camera_params: Optional[Dict[str, Any]] = None
-) -> List[Dict[str, Any]]:
+class JobQueue:
     """
-    Execute image generation with specified strategy.
-    
-    Args:
-        model: Model endpoint (e.g., "fal-ai/nano-banana/edit")
-        prompt: Generation prompt
-        image_urls: Input image URLs
-        aspect_ratio: Optional aspect ratio
-        execution_mode: "parallel" or "batch"
-        request_id: Request ID for logging
+    Bounded queue of inspiration jobs run by a fixed pool of background workers.
     
-    Returns:
-        List of generated images (always 3)
+    Each job's record moves queued -> running -> completed/failed in the
+    store. If the job has a webhook_url, the final record is POSTed there;
+    the client should use a PublicAddressTransport, as webhook URLs come
+    from callers.
     """
-    import fal_client
-    
-    # Aspect ratio to dimensions mapping for Qwen model
-    QWEN_ASPECT_RATIO_DIMENSIONS = {
-        "1:1": {"width": 1080, "height": 1080},
-        "2:3": {"width": 1000, "height": 1500},
-        "4:5": {"width": 1080, "height": 1350},
-        "16:9": {"width": 1920, "height": 1080},
-        "9:16": {"width": 1080, "height": 1920}
-    }
     
-    # Check if this is a Qwen model
-    is_qwen_model = "qwen-image-edit-plus-lora-gallery" in model
-    
-    # Build base arguments
-    base_arguments = {
-        "image_urls": image_urls,
-        "output_format": "png"
-    }
-    
-    # Add prompt only for non-Qwen models (Qwen doesn't use text prompts)
-    if not is_qwen_model:
-        base_arguments["prompt"] = prompt
-        base_arguments["limit_generations"] = True
-    else:
-        # Qwen model - add fixed parameters
-        base_arguments["guidance_scale"] = 5
-        base_arguments["num_inference_steps"] = 30
-        base_arguments["acceleration"] = "none"
-        base_arguments["negative_prompt"] = "bad quality, blurred, artifact"
-        
-        # Add camera parameters if provided
-        if camera_params:
-            base_arguments.update(camera_params)
-            print(f"[{request_id}] Qwen model - camera params: {camera_params}")
-    
-    # Handle aspect ratio based on model type
-    if aspect_ratio:
-        if is_qwen_model:
-            # Qwen model uses width/height instead of aspect_ratio string
-            if aspect_ratio in QWEN_ASPECT_RATIO_DIMENSIONS:
-                base_arguments["image_size"] = QWEN_ASPECT_RATIO_DIMENSIONS[aspect_ratio]
-                print(f"[{request_id}] Qwen model - using dimensions: {QWEN_ASPECT_RATIO_DIMENSIONS[aspect_ratio]}")
-            else:
-                raise ValueError(f"Unsupported aspect ratio for Qwen model: {aspect_ratio}")
-        else:
-            # Nano Banana uses aspect_ratio string
-            base_arguments["aspect_ratio"] = aspect_ratio
+    def __init__(
+        self,
+        store: Any,
+        runner: JobRunner,
+        client: httpx.AsyncClient,
+        workers: int = JOB_WORKERS,
+        max_queued: int = JOB_QUEUE_MAX,
+        budgets: Optional[BudgetLedger] = None
+    ):
+        self.store = store
+        self.runner = runner
+        self.client = client
+        self.budgets = budgets
+        self.workers = workers
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queued)
+        self._tasks: List[asyncio.Task] = []
+        # Queued or running on this runner, failed on shutdown so polls don't wait forever
+        self._unfinished: set = set()
+        self.submitted = 0
+        self.webhooks_delivered = 0
+        self.webhooks_failed = 0
     
-    if execution_mode == "parallel":
-        # PARALLEL MODE: 3 separate requests for maximum diversity
-        print(f"[{request_id}] Execution mode: PARALLEL (3 separate requests)")
-        
-        handlers = []
-        for i in range(3):
-            arguments = {**base_arguments, "num_images": 1}
-            handler = await fal_client.submit_async(model, arguments=arguments)
-            handlers.append(handler)
-            print(f"[{request_id}] Request {i+1}/3 submitted")
-        
-        # Wait for all 3 requests to complete in parallel
-        results = await asyncio.gather(*[h.get() for h in handlers])
-        
-        # Parse results from all 3 requests
-        generated_images = []
-        for idx, result in enumerate(results):
-            if "images" in result and len(result["images"]) > 0:
-                generated_images.append({
-                    "url": result["images"][0].get("url", ""),
-                    "index": idx
-                })
-        
-        print(f"[{request_id}] Collected {len(generated_images)} images from parallel requests")
-        return generated_images
-        
-    else:
-        # BATCH MODE: Single request with num_images=3
-        print(f"[{request_id}] Execution mode: BATCH (single request, 3 images)")
+    def submit(
+        self,
+        job_input: Dict[str, Any],
+        webhook_url: Optional[str] = None,
+        tenant: str = "anonymous",
+        reservation: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Queue a job and return its record.
         
-        arguments = {**base_arguments, "num_images": 3}
-        handler = await fal_client.submit_async(model, arguments=arguments)
+        reservation is the job's budget reservation, handed to the runner to
+        settle; whatever the runner leaves unsettled is released when the
+        job finishes or the runner shuts down.
         
-        # Wait for completion
-        async for event in handler.iter_events(with_logs=True):
-            if hasattr(event, 'message'):
-                print(f"[{request_id}] {event.message}")
+        Raises:
+            AdmissionRejected: If the queue is full
+        """
+        # Workers start on first use, inside the serving event loop
+        if not self._tasks:
+            self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+        if self._queue.full():
+            raise AdmissionRejected(f"Job queue is full ({self._queue.maxsize} jobs waiting)", retry_after=30.0)
         
-        result = await handler.get()
+        record = {
+            "job_id": uuid.uuid4().hex,
+            "status": "queued",
+            "input": job_input,
+            "tenant": tenant,
+            "reservation": reservation,
+            "webhook_url": webhook_url,
+            "created_at": time.time(),
+            "started_at": None,
+            "completed_at": None,
+            "output": None,
+            "status_code": None,
+            "error": None,
+            "webhook_delivered": None
+        }
+        self.store.put(record)
+        self._queue.put_nowait(record["job_id"])
+        self._unfinished.add(record["job_id"])
+        self.submitted += 1
+        return record
+    
+    async def _work(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            except Exception as e:
+                print(f"[job {job_id[:8]}] Worker error: {e}")
+            finally:
+                self._queue.task_done()
+            # Not reached when cancelled mid-job: close() still has to fail it
+            self._unfinished.discard(job_id)
+    
+    async def _run(self, job_id: str) -> None:
+        record = self.store.get(job_id)
+        if record is None:
+            return
+        record.update(status="running", started_at=time.time())
+        self.store.put(record)
         
-        # Parse results
-        generated_images = []
-        if "images" in result:
-            for idx, img in enumerate(result["images"]):
-                generated_images.append({
-                    "url": img.get("url", ""),
-                    "index": idx
-                })
+        try:
+            record["output"] = await self.runner(
+                record["input"], job_id, record.get("tenant", "anonymous"), record.get("reservation")
+            )
+            record.update(status="completed", status_code=200)
+        except HTTPException as e:
+            record.update(status="failed", status_code=e.status_code, error=e.detail)
+        except Exception as e:
+            record.update(status="failed", status_code=500, error=str(e))
+        finally:
+            if self.budgets is not None:
+                self.budgets.release(record.get("reservation"))
+        record["completed_at"] = time.time()
+        self.store.put(record)
         
-        print(f"[{request_id}] Generated {len(generated_images)} images in batch mode")
-        return generated_images
+        if record["webhook_url"]:
+            record["webhook_delivered"] = await self._deliver(record)
+            self.store.put(record)
+    
+    async def _deliver(self, record: Dict[str, Any]) -> bool:
+        """POST the finished record to its webhook; retries 5xx, 429 and network errors."""
+        payload = {k: v for k, v in record.items() if k not in ("input", "tenant", "reservation", "webhook_delivered")}
+        label = f"[job {record['job_id'][:8]}]"
+        for attempt in range(WEBHOOK_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(random.uniform(0, min(WEBHOOK_MAX_DELAY, WEBHOOK_BASE_DELAY * 2 ** attempt)))
+            try:
+                response = await self.client.post(record["webhook_url"], json=payload)
+            except httpx.HTTPError as e:
+                print(f"{label} Webhook attempt {attempt + 1}/{WEBHOOK_ATTEMPTS} failed: {type(e).__name__}")
+                continue
+            except ValueError as e:
+                # Host now resolves to a non-public address (or redirected to one)
+                print(f"{label} Webhook refused: {e}")
+                break
+            if response.status_code < 300:
+                self.webhooks_delivered += 1
+                return True
+            print(f"{label} Webhook attempt {attempt + 1}/{WEBHOOK_ATTEMPTS} returned {response.status_code}")
+            if response.status_code < 500 and response.status_code != 429:
+                break
+        self.webhooks_failed += 1
+        return False
+    
+    async def close(self) -> None:
+        """Stop the workers and fail this runner's unfinished jobs, so callers know to resubmit."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for job_id in self._unfinished:
+            record = self.store.get(job_id)
+            if record is None or record["status"] not in ("queued", "running"):
+                continue
+            if self.budgets is not None:
+                self.budgets.release(record.get("reservation"))
+            record.update(
+                status="failed",
+                status_code=503,
+                error="The runner stopped before this job finished; submit it again",
+                completed_at=time.time()
+            )
+            self.store.put(record)
+        if self._unfinished:
+            print(f"Failed {len(self._unfinished)} unfinished job(s) on shutdown")
+        self._unfinished.clear()
+    
+    def snapshot(self) -> Dict[str, int]:
+        return {
+            "queued": self._queue.qsize(),
+            "submitted": self.submitted,
+            "webhooks_delivered": self.webhooks_delivered,
+            "webhooks_failed": self.webhooks_failed
+        }
 
 
 # ============================================================================
 # INPUT & OUTPUT MODELS
 # ============================================================================
 
+class OutputOptions(BaseModel):
+    """Post-processing of generated images into delivery renditions."""
+    format: RenditionFormat = Field(  # type: ignore
+        default="webp",
+        description=f"Rendition format ({', '.join(RENDITION_FORMATS)}; avif needs Pillow AVIF support)"
+    )
+    quality: int = Field(default=80, ge=1, le=100, description="Encoder quality (ignored for png)")
+    sizes: List[int] = Field(
+        default_factory=list,
+        max_length=RENDITION_MAX_SIZES,
+        description="Thumbnail sizes: max width/height in pixels, aspect ratio kept, never upscaled",
+        examples=[[400, 1200]]
+    )
+    include_original: bool = Field(
+        default=True,
+        description="Also transcode the full-size image to format"
+    )
+    upload: bool = Field(
+        default=True,
+        description="Upload renditions and return their URLs; if false only their dimensions and byte sizes are returned"
+    )
+
+
 class InspirationInput(BaseModel):
     """Input for the inspiration endpoint."""
     inspiration_name: InspirationName = Field(  # type: ignore
@@ -717,7 +4036,7 @@ class InspirationInput(BaseModel):
         description="List of input image URLs (1-5 images depending on inspiration)",
         examples=[["https://v3b.fal.media/files/b/zebra/shBQJppM86yD1p3nKJxS2.jpg"]]
     )
-    aspect_ratio: Optional[Literal["1:1", "2:3", "4:5", "16:9", "9:16"]] = Field(
+    aspect_ratio: Optional[AspectRatio] = Field(  # type: ignore
         default=None,
         description="Aspect ratio of the generated image. Supported values: 1:1, 2:3, 4:5, 16:9, 9:16"
     )
@@ -726,18 +4045,96 @@ class InspirationInput(BaseModel):
         description="Optional extra instructions to append to the base prompt",
         examples=["make the image more vibrant and dramatic, with different camera angles"]
     )
+    num_images: Optional[int] = Field(
+        default=None,
+        ge=1,
+        le=MAX_NUM_IMAGES,
+        description=f"Number of images to generate (1-{MAX_NUM_IMAGES}); defaults to the inspiration's num_images (3)"
+    )
+    use_cache: bool = Field(
+        default=True,
+        description="Reuse a cached or in-flight result for an identical request instead of regenerating"
+    )
+    validate_images: bool = Field(
+        default=True,
+        description="Check input image URLs (reachable, image type, size, dimensions) before generating"
+    )
+    quality: Quality = Field(  # type: ignore
+        default="standard",
+        description=(
+            "Render tier: draft (fast, fewer steps, half size), standard, or final (more steps). "
+            "Only Qwen multiple-angles has tiers; Nano Banana renders and costs the same at every tier"
+        )
+    )
+    output: Optional[OutputOptions] = Field(
+        default=None,
+        description="Transcode/resize the generated images (e.g. WebP thumbnails); originals are PNG"
+    )
+    priority: Priority = Field(  # type: ignore
+        default="standard",
+        description="Scheduling lane: interactive (designer waiting), standard, or bulk (catalog runs; may be preempted while queued)"
+    )
+    diversity: Literal["off", "flag", "regenerate"] = Field(
+        default="off",
+        description="Near-duplicate check of the generated images: off, flag them, or regenerate them (flagging any left)"
+    )
+
+
+class TimelineEvent(BaseModel):
+    """A status event of one upstream model job."""
+    job: str = Field(description="Sub-request: 'batch' / 'batch-N', 'request-N', with '-hedge' for hedge jobs")
+    status: Literal["submitted", "queued", "in_progress", "completed", "hedged", "retrying", "failed"] = Field(
+        description="Job status at this point"
+    )
+    elapsed: float = Field(description="Seconds since the generation started")
+    position: Optional[int] = Field(default=None, description="Position in the upstream queue (queued events)")
+    detail: Optional[str] = Field(default=None, description="Extra information (hedge reason, error message)")
+
+
+class Rendition(BaseModel):
+    """A transcoded and/or resized copy of a generated image."""
+    label: str = Field(description="'original' (full size) or the requested size, e.g. '400'")
+    url: Optional[str] = Field(default=None, description="URL of the rendition (null when upload is off)")
+    format: str = Field(description="Rendition format")
+    content_type: str = Field(description="MIME type of the rendition")
+    width: int = Field(description="Width in pixels")
+    height: int = Field(description="Height in pixels")
+    bytes: int = Field(description="Encoded size in bytes")
 
 
 class GeneratedImage(BaseModel):
     """A single generated image."""
     url: str = Field(description="URL of the generated image")
-    index: int = Field(description="Index of the image (0-2)")
+    index: int = Field(description="Index of the image (0 to num_images - 1)")
+    latency: Optional[float] = Field(
+        default=None,
+        description="Seconds from submission to completion of the request that produced this image"
+    )
+    renditions: Optional[List[Rendition]] = Field(
+        default=None,
+        description="Post-processed copies, if output options were given"
+    )
+    rendition_error: Optional[str] = Field(
+        default=None,
+        description="Why post-processing failed for this image (url is still the original)"
+    )
+    near_duplicate_of: Optional[int] = Field(
+        default=None,
+        description="Index of an image in the same result this one nearly duplicates (diversity guard)"
+    )
 
 
 class InspirationOutput(BaseModel):
     """Output from the inspiration endpoint."""
-    success: bool = Field(description="Whether the generation was successful")
-    images: List[GeneratedImage] = Field(description="List of generated images (always 3)")
+    success: bool = Field(description="Whether the generation was successful (see shortfall for partial results)")
+    images: List[GeneratedImage] = Field(
+        description="List of generated images (num_images, fewer if some upstream calls failed)"
+    )
+    num_images: int = Field(default=0, description="Number of images requested")
+    shortfall: int = Field(
+        default=0,
+        description="Requested images missing from images because their upstream calls failed or timed out"
+    )
     inspiration_name: str = Field(description="The inspiration that was applied")
     prompt_used: str = Field(description="The actual prompt sent to the model")
     input_image_count: int = Field(description="Number of input images provided")
@@ -746,12 +4143,208 @@ class InspirationOutput(BaseModel):
         description="Aspect ratio used for generation"
     )
     execution_mode: str = Field(description="Execution mode used (parallel or batch)")
+    mode_decision: str = Field(
+        default="default",
+        description="Why execution_mode was chosen: default (configured), pinned, load, faster or explore"
+    )
     model: str = Field(description="Model used for generation")
+    quality: str = Field(default="standard", description="Quality tier rendered (draft, standard or final)")
     processing_time: float = Field(description="Time taken in seconds")
+    inference_time: Optional[float] = Field(
+        default=None,
+        description="Model inference seconds reported by fal, summed over upstream jobs (null for cache hits)"
+    )
+    cache_hit: bool = Field(default=False, description="Whether the images were served from the result cache")
+    coalesced: bool = Field(
+        default=False,
+        description="Whether this request shared an identical in-flight generation instead of starting its own"
+    )
+    retries: int = Field(default=0, description="Upstream jobs retried after a failure")
+    hedges: int = Field(default=0, description="Duplicate upstream jobs submitted for stragglers")
+    near_duplicates: Optional[int] = Field(
+        default=None,
+        description="Near-duplicate images found by the diversity guard (null if not checked)"
+    )
+    regenerated: int = Field(default=0, description="Near-duplicate images replaced by regenerated ones")
+    upstream_calls: int = Field(default=0, description="Upstream model jobs submitted, including retries and hedges")
+    cost_estimate: float = Field(
+        default=0.0,
+        description="Estimated USD cost of those upstream jobs (0 for cache hits and coalesced requests)"
+    )
+    timeline: List[TimelineEvent] = Field(
+        default_factory=list,
+        description="Upstream status events (queue position, start, completion) per sub-request; empty when served from cache or coalesced"
+    )
     request_id: str = Field(description="Unique request ID")
+    error: Optional[str] = Field(
+        default=None,
+        description="Error message if failed, or which upstream calls failed when shortfall > 0"
+    )
+
+
+# Max jobs accepted by a single /batch request
+MAX_BATCH_JOBS = 100
+
+# Default number of jobs per model that a batch runs at the same time
+BATCH_MAX_CONCURRENCY_PER_MODEL = 4
+
+
+class BatchInput(BaseModel):
+    """Input for the batch endpoint."""
+    # Jobs that don't validate are kept as dicts and fail on their own, not the whole batch
+    jobs: List[Union[InspirationInput, Dict[str, Any]]] = Field(
+        min_length=1,
+        max_length=MAX_BATCH_JOBS,
+        description=f"Inspiration jobs to run (1-{MAX_BATCH_JOBS}), each with the main endpoint's input fields"
+    )
+    max_concurrency_per_model: int = Field(
+        default=BATCH_MAX_CONCURRENCY_PER_MODEL,
+        ge=1,
+        le=16,
+        description="Max jobs running at the same time for each model"
+    )
+
+
+class BatchJobResult(BaseModel):
+    """Result of one job in a batch."""
+    job_index: int = Field(description="Position of the job in the request")
+    success: bool = Field(description="Whether this job succeeded")
+    output: Optional[InspirationOutput] = Field(default=None, description="Job output if successful")
+    status_code: Optional[int] = Field(default=None, description="HTTP status the job would have returned if failed")
+    error: Optional[str] = Field(default=None, description="Error message if failed")
+
+
+class BatchOutput(BaseModel):
+    """Output from the batch endpoint."""
+    results: List[BatchJobResult] = Field(description="Per-job results, in request order")
+    succeeded: int = Field(description="Number of successful jobs")
+    failed: int = Field(description="Number of failed jobs")
+    processing_time: float = Field(description="Time taken for the whole batch in seconds")
+    request_id: str = Field(description="Unique batch request ID")
+
+
+# Images per inspiration in a preview run, unless num_images is given
+PREVIEW_NUM_IMAGES = 1
+
+# Default number of inspirations a preview runs at the same time
+PREVIEW_MAX_CONCURRENCY = 6
+
+# Inspiration categories, e.g. "Creative", "Marketplace"
+# Categories of the embedded inspirations. The API schema is built once, so with an
+# external (hot-reloadable) registry it points at the live list instead of naming them.
+INSPIRATION_CATEGORIES = tuple(sorted({cfg["category"] for cfg in INSPIRATIONS.values()}))
+CATEGORY_DESCRIPTION = (
+    "Run every inspiration in this category (the loaded registry's categories, listed by /registry/reload)"
+    if INSPIRATIONS_REGISTRY_PATH
+    else f"Run every inspiration in this category ({', '.join(INSPIRATION_CATEGORIES)})"
+)
+
+
+class PreviewInput(BaseModel):
+    """Input for the preview endpoint: one image set, many inspirations."""
+    image_urls: List[str] = Field(
+        description="Input image URLs, shared by every selected inspiration",
+        min_length=1
+    )
+    category: Optional[str] = Field(
+        default=None,
+        description=CATEGORY_DESCRIPTION
+    )
+    inspiration_names: Optional[List[InspirationName]] = Field(  # type: ignore
+        default=None,
+        min_length=1,
+        description="Run these inspirations (instead of a category)"
+    )
+    aspect_ratio: Optional[AspectRatio] = Field(default=None, description="Aspect ratio of the generated images")
+    extra_prompt: Optional[str] = Field(default=None, description="Extra instructions appended to every prompt")
+    preview: bool = Field(
+        default=True,
+        description=(
+            f"Lower-cost renders: {PREVIEW_NUM_IMAGES} image per inspiration at draft quality. Draft only "
+            "saves on Qwen multiple-angles (fewer steps, half size); Nano Banana inspirations save through "
+            "the image count alone, so a preview with num_images costs as much as a full run there"
+        )
+    )
+    num_images: Optional[int] = Field(
+        default=None,
+        ge=1,
+        le=MAX_NUM_IMAGES,
+        description="Images per inspiration (default: 1 with preview, else the inspiration's default)"
+    )
+    max_concurrency: int = Field(
+        default=PREVIEW_MAX_CONCURRENCY,
+        ge=1,
+        le=16,
+        description="Max inspirations generating at the same time"
+    )
+    use_cache: bool = Field(default=True, description="Reuse cached or in-flight results for identical jobs")
+    validate_images: bool = Field(default=True, description="Check input image URLs once before generating")
+    output: Optional[OutputOptions] = Field(default=None, description="Renditions to produce for every image")
+    priority: Priority = Field(default="standard", description="Scheduling lane for every job")  # type: ignore
+
+
+class PreviewResult(BaseModel):
+    """Result for one inspiration in a preview run."""
+    inspiration_name: str = Field(description="Inspiration key")
+    name: str = Field(description="Inspiration display name")
+    success: bool = Field(description="Whether this inspiration succeeded")
+    output: Optional[InspirationOutput] = Field(default=None, description="Output if successful")
+    status_code: Optional[int] = Field(default=None, description="HTTP status the job would have returned if failed")
     error: Optional[str] = Field(default=None, description="Error message if failed")
 
 
+class PreviewOutput(BaseModel):
+    """Output from the preview endpoint."""
+    results: List[PreviewResult] = Field(description="One result per selected inspiration, in selection order")
+    skipped: Dict[str, str] = Field(
+        default_factory=dict,
+        description="Selected inspirations not run, with the reason (e.g. wrong number of input images)"
+    )
+    succeeded: int = Field(description="Number of inspirations that succeeded")
+    failed: int = Field(description="Number of inspirations that failed")
+    processing_time: float = Field(description="Time taken for the whole preview in seconds")
+    request_id: str = Field(description="Unique preview request ID")
+
+
+class JobSubmitInput(InspirationInput):
+    """Input for an async job: a normal request plus an optional webhook."""
+    webhook_url: Optional[str] = Field(
+        default=None,
+        description="Public http(s) URL that receives a POST with the job record once the job finishes"
+    )
+
+
+class JobStatusInput(BaseModel):
+    """Input for polling an async job."""
+    job_id: str = Field(description="Job ID returned by /jobs")
+
+
+class JobStatus(BaseModel):
+    """State of an async job."""
+    job_id: str = Field(description="Unique job ID")
+    status: Literal["queued", "running", "completed", "failed"] = Field(description="Job state")
+    created_at: float = Field(description="Unix time the job was queued")
+    started_at: Optional[float] = Field(default=None, description="Unix time a worker picked the job up")
+    completed_at: Optional[float] = Field(default=None, description="Unix time the job finished")
+    output: Optional[InspirationOutput] = Field(default=None, description="Result, once completed")
+    status_code: Optional[int] = Field(default=None, description="HTTP status the synchronous endpoint would have returned")
+    error: Optional[str] = Field(default=None, description="Error message, if failed")
+    webhook_delivered: Optional[bool] = Field(
+        default=None,
+        description="Whether the webhook POST succeeded (null if no webhook or not sent yet)"
+    )
+
+
+class RegistryInfo(BaseModel):
+    """The inspiration registry currently serving requests."""
+    version: str = Field(description="Content hash of the loaded inspiration definitions")
+    source: str = Field(description="Registry file/directory, or 'embedded'")
+    loaded_at: float = Field(description="Unix time this version was loaded")
+    inspirations: int = Field(description="Number of inspirations")
+    categories: Dict[str, List[str]] = Field(description="Inspiration keys per category")
+    changed: bool = Field(description="Whether the reload swapped in a different version")
+
+
 # ============================================================================
 # FAL SERVERLESS APP
 # ============================================================================
@@ -761,43 +4354,728 @@ class StockInspirations(fal.App):
     
     # CPU-optimized configuration (nano-banana runs on FAL's GPU infrastructure)
     machine_type = "M"  # M = CPU machine (cheap & fast deployment)
-    min_concurrency = 0  # Scale to zero when idle
+    min_concurrency = 1 if JOB_STORE_DB_PATH else 0  # Scale to zero when idle, unless async jobs are enabled
     max_concurrency = 2  # Limit concurrent requests
     max_multiplexing = 2  # Handle multiple requests per worker
     request_timeout = 120  # 2 minutes max per request
     startup_timeout = 60  # 1 minute for startup
-    keep_alive = 0  # No keep-alive (scale to zero)
+    keep_alive = JOB_KEEP_ALIVE if JOB_STORE_DB_PATH else 0  # No keep-alive (scale to zero) without async jobs
     
     # Minimal requirements for CPU deployment
     requirements = [
-        "fal-client>=0.4.0",
+        "fal-client>=1.0.3,<2",
         "pydantic>=2.0.0",
+        "httpx>=0.24.0",
+        "h2>=4.0.0",
+        "pillow>=10.0.0",
+        "numpy>=1.24.0",
+        "pyyaml>=6.0",
     ]
     
     def setup(self):
         """Initialize the app."""
+        if os.environ.get("STOCK_INSPIRATIONS_FAKE_BACKEND"):
+            # Offline mode for load tests: no upstream calls are made
+            install_fake_backends(
+                latency_median=float(os.environ.get("STOCK_INSPIRATIONS_FAKE_LATENCY", "8.0")),
+                failure_rate=float(os.environ.get("STOCK_INSPIRATIONS_FAKE_FAILURE_RATE", "0.0"))
+            )
+            print("Using fake model backends (STOCK_INSPIRATIONS_FAKE_BACKEND is set)")
+        # One pooled client for every upstream submit/status/result/upload call
+        self.fal_client = PooledFalClient()
+        set_fal_client(self.fal_client)
+        # Invalid inspiration configs fail here, at startup, not mid-request
+        self.registry = load_registry(INSPIRATIONS_REGISTRY_PATH)
+        self.registry_watcher = None
+        if INSPIRATIONS_REGISTRY_PATH and REGISTRY_POLL_INTERVAL > 0:
+            self.registry_watcher = asyncio.ensure_future(self._watch_registry())
+        self.result_cache = ResultCache(db_path=RESULT_CACHE_DB_PATH)
+        self.single_flight = SingleFlight()
+        self.tenant_weights = parse_tenant_values(TENANT_WEIGHTS_JSON, "STOCK_INSPIRATIONS_TENANT_WEIGHTS", allow_zero=False)
+        self.admission = AdmissionController(tenant_weights=self.tenant_weights)
+        self.planner = ExecutionModePlanner()
+        self.budgets = BudgetLedger(parse_tenant_values(BUDGETS_JSON, "STOCK_INSPIRATIONS_BUDGETS"), db_path=BUDGET_DB_PATH)
+        self.preflight = ImagePreflight(
+            httpx.AsyncClient(
+                timeout=httpx.Timeout(5.0),
+                transport=PublicAddressTransport(httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=50)))
+            )
+        )
+        self.rendition_formats = frozenset(f for f in RENDITION_FORMATS if rendition_format_supported(f))
+        self.renditions = RenditionPipeline(
+            httpx.AsyncClient(timeout=httpx.Timeout(30.0), limits=httpx.Limits(max_connections=RENDITION_MAX_CONCURRENCY))
+        )
+        self.diversity = DiversityGuard(self.renditions.client)
+        self.metrics = AppMetrics()
+        # Only with a shared store (see JOB_STORE_DB_PATH); /jobs refuses work otherwise
+        self.jobs = JobQueue(
+            store=make_job_store(JOB_STORE_DB_PATH),
+            runner=self._run_job,
+            budgets=self.budgets,
+            client=httpx.AsyncClient(
+                timeout=httpx.Timeout(10.0),
+                transport=PublicAddressTransport(httpx.AsyncHTTPTransport())
+            )
+        )
         print("Stock Inspirations app initialized")
-        print(f"Available inspirations: {', '.join(list_inspirations())}")
+        print(f"Available inspirations: {', '.join(self.registry.plans)} (registry {self.registry.version} from {self.registry.source})")
+    
+    async def teardown(self):
+        """Stop the registry watcher and job workers, and close pooled HTTP clients."""
+        if self.registry_watcher is not None:
+            self.registry_watcher.cancel()
+        await self.jobs.close()
+        await self.fal_client.aclose()
+        await self.preflight.client.aclose()
+        await self.renditions.client.aclose()
+        await self.jobs.client.aclose()
     
     @fal.endpoint("/")
-    async def generate(self, input: InspirationInput) -> InspirationOutput:
+    async def generate(self, input: InspirationInput, request: Request) -> InspirationOutput:
         """
-        Apply an inspiration to input images and generate 3 output images.
+        Apply an inspiration to input images and generate output images (3 by default).
         
         This is a blackbox service - you provide:
         - inspiration_name: Which inspiration to apply
         - image_urls: Input images
         - aspect_ratio: (optional) Aspect ratio for output
         - extra_prompt: (optional) Extra instructions
+        - num_images: (optional) How many images to generate
         
-        You get back 3 generated images.
+        You get back num_images generated images.
         
         Execution modes:
-        - PARALLEL: 3 separate requests for maximum diversity (variations, angles, close-ups)
-        - BATCH: Single request with 3 images for consistent results (backgrounds, styles)
+        - PARALLEL: One request per image for maximum diversity (variations, angles, close-ups)
+        - BATCH: As few requests as the model allows, several images each, for consistent results (backgrounds, styles)
+        """
+        request_id = str(uuid.uuid4())[:8]
+        return await self._generate(input, request_id, tenant=self._tenant(request))
+    
+    @fal.endpoint("/batch")
+    async def generate_batch(self, input: BatchInput, request: Request) -> BatchOutput:
+        """
+        Run many inspiration jobs in one request.
+        
+        Jobs are scheduled concurrently, with at most
+        max_concurrency_per_model jobs in flight per model. A failing job
+        does not fail the batch - its error is reported in its result.
+        """
+        batch_id = str(uuid.uuid4())[:8]
+        start_time = time.time()
+        print(f"[{batch_id}] Starting batch with {len(input.jobs)} jobs")
+        
+        # All jobs see the same registry, even if it is reloaded mid-batch
+        registry = self.registry
+        tenant = self._tenant(request)
+        
+        # A job that fails schema validation gets its own 422 result; the others still run
+        jobs: List[Optional[InspirationInput]] = []
+        invalid: Dict[int, str] = {}
+        for job_index, job in enumerate(input.jobs):
+            if isinstance(job, dict):
+                try:
+                    job = InspirationInput.model_validate(job)
+                except ValidationError as e:
+                    invalid[job_index] = "; ".join(
+                        f"{'.'.join(str(part) for part in error['loc']) or 'job'}: {error['msg']}"
+                        for error in e.errors()
+                    )
+                    job = None
+            jobs.append(job)
+        
+        # One semaphore per model bounds upstream load regardless of job order
+        job_models = [
+            plan.model if job is not None and (plan := registry.plans.get(job.inspiration_name)) else None
+            for job in jobs
+        ]
+        semaphores = {
+            model: asyncio.Semaphore(input.max_concurrency_per_model)
+            for model in set(job_models)
+        }
+        
+        async def run_job(job_index: int, job: Optional[InspirationInput]) -> BatchJobResult:
+            if job is None:
+                return BatchJobResult(job_index=job_index, success=False, status_code=422, error=invalid[job_index])
+            async with semaphores[job_models[job_index]]:
+                try:
+                    output = await self._generate(job, f"{batch_id}-{job_index}", registry=registry, tenant=tenant)
+                    return BatchJobResult(job_index=job_index, success=True, output=output)
+                except HTTPException as e:
+                    return BatchJobResult(
+                        job_index=job_index,
+                        success=False,
+                        status_code=e.status_code,
+                        error=e.detail
+                    )
+        
+        results = await asyncio.gather(*[run_job(i, job) for i, job in enumerate(jobs)])
+        
+        succeeded = sum(1 for r in results if r.success)
+        processing_time = time.time() - start_time
+        print(f"[{batch_id}] Batch done: {succeeded}/{len(results)} succeeded in {processing_time:.2f}s")
+        
+        return BatchOutput(
+            results=results,
+            succeeded=succeeded,
+            failed=len(results) - succeeded,
+            processing_time=processing_time,
+            request_id=batch_id
+        )
+    
+    @fal.endpoint("/preview")
+    async def generate_preview(self, input: PreviewInput, request: Request) -> PreviewOutput:
+        """
+        Run many inspirations on one image set, e.g. "try all Creative styles".
+        
+        Input images are validated once and shared. Inspirations run
+        concurrently, at most max_concurrency at a time, and results are
+        grouped per inspiration. Inspirations that cannot take this number of
+        input images are listed in skipped.
+        """
+        preview_id = str(uuid.uuid4())[:8]
+        start_time = time.time()
+        
+        if (input.category is None) == (input.inspiration_names is None):
+            raise HTTPException(status_code=400, detail="Provide exactly one of category or inspiration_names")
+        registry = self.registry
+        tenant = self._tenant(request)
+        if input.category is not None:
+            names = next(
+                (list(names) for category, names in registry.categories.items()
+                 if category.lower() == input.category.lower()),
+                None
+            )
+            if not names:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Unknown category: {input.category}. Available: {', '.join(registry.categories)}"
+                )
+        else:
+            names = list(dict.fromkeys(input.inspiration_names))
+        
+        # Shared inputs are checked once; per-inspiration constraints skip instead of failing
+        errors = validate_shared_inputs(input.image_urls, input.extra_prompt)
+        if errors:
+            raise HTTPException(status_code=400, detail="; ".join(errors))
+        skipped = {}
+        for name in names:
+            constraints = registry.constraints.get(name)
+            if constraints is None:
+                skipped[name] = "unknown inspiration"
+            elif not constraints.min_images <= len(input.image_urls) <= constraints.max_images:
+                skipped[name] = f"requires {constraints.min_images}-{constraints.max_images} input images"
+            elif input.aspect_ratio is not None and input.aspect_ratio not in constraints.aspect_ratios:
+                skipped[name] = f"does not support aspect ratio {input.aspect_ratio}"
+        names = [name for name in names if name not in skipped]
+        print(f"[{preview_id}] Preview of {len(names)} inspirations ({len(skipped)} skipped)")
+        
+        # Validate (and re-host) the shared inputs once, not per inspiration
+        image_urls = input.image_urls
+        if input.validate_images and names:
+            try:
+                image_urls = [result.url for result in await self.preflight.check_all(image_urls)]
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            except RehostFailed as e:
+                raise HTTPException(status_code=502, detail=str(e))
+        
+        semaphore = asyncio.Semaphore(input.max_concurrency)
+        num_images = input.num_images or (PREVIEW_NUM_IMAGES if input.preview else None)
+        
+        async def run_one(index: int, name: str) -> PreviewResult:
+            job = InspirationInput(
+                inspiration_name=name,
+                image_urls=image_urls,
+                aspect_ratio=input.aspect_ratio,
+                extra_prompt=input.extra_prompt,
+                num_images=num_images,
+                use_cache=input.use_cache,
+                validate_images=False,
+                quality="draft" if input.preview else "standard",
+                output=input.output,
+                priority=input.priority
+            )
+            display_name = registry.plans[name].display_name
+            async with semaphore:
+                try:
+                    output = await self._generate(job, f"{preview_id}-{index}", registry=registry, tenant=tenant)
+                    return PreviewResult(inspiration_name=name, name=display_name, success=True, output=output)
+                except HTTPException as e:
+                    return PreviewResult(
+                        inspiration_name=name,
+                        name=display_name,
+                        success=False,
+                        status_code=e.status_code,
+                        error=e.detail
+                    )
+        
+        results = await asyncio.gather(*[run_one(i, name) for i, name in enumerate(names)])
+        
+        succeeded = sum(1 for r in results if r.success)
+        processing_time = time.time() - start_time
+        print(f"[{preview_id}] Preview done: {succeeded}/{len(results)} succeeded in {processing_time:.2f}s")
+        
+        return PreviewOutput(
+            results=results,
+            skipped=skipped,
+            succeeded=succeeded,
+            failed=len(results) - succeeded,
+            processing_time=processing_time,
+            request_id=preview_id
+        )
+    
+    @fal.endpoint("/stream")
+    async def generate_stream(self, input: InspirationInput, request: Request) -> StreamingResponse:
+        """
+        Same as the main endpoint, but streams results as JSON lines.
+        
+        Upstream status events are emitted as they happen:
+            {"type": "progress", "event": {"job": str, "status": str, "position": int | null, ...}}
+        each image is emitted as soon as it completes:
+            {"type": "image", "image": {...}, "elapsed": float}
+        followed by one final record:
+            {"type": "summary", "output": {...}}
+        or, on failure:
+            {"type": "error", "status_code": int, "error": str, "request_id": str}
         """
         request_id = str(uuid.uuid4())[:8]
         start_time = time.time()
+        # Invalid input or API key is a plain 4xx, not a stream that only carries an error record
+        self._reject_invalid(input, self.registry, request_id)
+        tenant = self._tenant(request)
+        records: asyncio.Queue = asyncio.Queue()
+        
+        async def on_image(image: Dict[str, Any]) -> None:
+            await records.put({
+                "type": "image",
+                "image": GeneratedImage(**image).model_dump(),
+                "elapsed": time.time() - start_time
+            })
+        
+        async def on_progress(event: Dict[str, Any]) -> None:
+            await records.put({"type": "progress", "event": TimelineEvent(**event).model_dump()})
+        
+        async def run() -> None:
+            try:
+                output = await self._generate(
+                    input,
+                    request_id,
+                    on_image=on_image,
+                    on_progress=on_progress,
+                    tenant=tenant
+                )
+                await records.put({"type": "summary", "output": output.model_dump()})
+            except HTTPException as e:
+                await records.put({
+                    "type": "error",
+                    "status_code": e.status_code,
+                    "error": e.detail,
+                    "request_id": request_id
+                })
+            finally:
+                await records.put(None)
+        
+        async def lines():
+            task = asyncio.create_task(run())
+            try:
+                while (record := await records.get()) is not None:
+                    yield json.dumps(record) + "\n"
+            finally:
+                # Client disconnected early: stop waiting on upstream jobs
+                task.cancel()
+        
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+    
+    @fal.endpoint("/jobs")
+    async def submit_job(self, input: JobSubmitInput, request: Request) -> JobStatus:
+        """
+        Queue a job and return immediately with its job_id.
+        
+        The job runs on a background worker pool. Poll /jobs/status with the
+        job_id, or pass webhook_url to receive the final job record by POST.
+        Returns 503 unless STOCK_INSPIRATIONS_JOB_DB points at a shared store.
+        """
+        self._require_job_store()
+        # Invalid input and exhausted budgets fail now rather than when a worker picks the job up
+        self._reject_invalid(input, self.registry, "jobs")
+        if input.webhook_url is not None:
+            # The job record is POSTed there later, from inside fal's network
+            try:
+                await public_addresses(httpx.URL(input.webhook_url))
+            except (ValueError, httpx.InvalidURL) as e:
+                raise HTTPException(status_code=400, detail=f"Invalid webhook_url: {e}")
+            except OSError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid webhook_url: host does not resolve ({e})")
+        tenant = self._tenant(request)
+        reservation = None
+        try:
+            # Hold the job's worst-case cost now, so a queued job cannot outspend the budget
+            reservation = self.budgets.reserve(tenant, self._estimate_job_cost(input))
+            record = self.jobs.submit(
+                input.model_dump(exclude={"webhook_url"}),
+                webhook_url=input.webhook_url,
+                tenant=tenant,
+                reservation=reservation
+            )
+        except BudgetExceeded as e:
+            raise HTTPException(
+                status_code=402,
+                detail=str(e),
+                headers={"Retry-After": str(int(math.ceil(e.retry_after)))}
+            )
+        except AdmissionRejected as e:
+            self.budgets.release(reservation)
+            raise HTTPException(
+                status_code=429,
+                detail=str(e),
+                headers={"Retry-After": str(int(math.ceil(e.retry_after)))}
+            )
+        print(f"[job {record['job_id'][:8]}] Queued ({input.inspiration_name})")
+        return JobStatus(**record)
+    
+    def _estimate_job_cost(self, input: InspirationInput) -> float:
+        """Estimated upstream cost of a job in the costlier of the modes the planner may pick."""
+        plan = self.registry.plans[input.inspiration_name]
+        arguments = plan.arguments(input.image_urls, plan.build_prompt(input.extra_prompt), input.aspect_ratio, input.quality)
+        num_images = input.num_images or plan.num_images
+        return max(
+            estimate_generation_cost(plan.backend, arguments, mode, num_images)
+            for mode in plan.allowed_modes
+        )
+    
+    def _require_job_store(self) -> None:
+        if self.jobs.store is None:
+            # Runner-local jobs would be lost on scale-down and invisible to polls on other runners
+            raise HTTPException(
+                status_code=503,
+                detail="Async jobs are disabled: set STOCK_INSPIRATIONS_JOB_DB to a store shared by all runners"
+            )
+    
+    @fal.endpoint("/jobs/status")
+    async def job_status(self, input: JobStatusInput) -> JobStatus:
+        """Return the current state (and result, once finished) of an async job."""
+        self._require_job_store()
+        record = self.jobs.store.get(input.job_id)
+        if record is None:
+            raise HTTPException(status_code=404, detail=f"Unknown or expired job: {input.job_id}")
+        return JobStatus(**record)
+    
+    @fal.endpoint("/registry/reload")
+    async def reload_registry_endpoint(self) -> RegistryInfo:
+        """
+        Reload inspirations from the registry path now.
+        
+        Returns 400 (and keeps serving the current registry) if the files are invalid.
+        """
+        try:
+            changed = await self.reload_registry()
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        registry = self.registry
+        return RegistryInfo(
+            version=registry.version,
+            source=registry.source,
+            loaded_at=registry.loaded_at,
+            inspirations=len(registry.plans),
+            categories={category: list(names) for category, names in registry.categories.items()},
+            changed=changed
+        )
+    
+    async def reload_registry(self) -> bool:
+        """
+        Build a new registry and swap it in; returns whether the version changed.
+        
+        The files are read, parsed and compiled in a worker thread, so
+        requests keep being served from the current registry meanwhile.
+        
+        Raises:
+            ValueError: If the registry files are invalid (the old registry stays active)
+        """
+        registry = await asyncio.to_thread(load_registry, INSPIRATIONS_REGISTRY_PATH)
+        if registry.version == self.registry.version:
+            return False
+        # Single attribute assignment: requests see either the old or the new registry
+        self.registry = registry
+        print(f"Inspiration registry reloaded: version {registry.version}, {len(registry.plans)} inspirations")
+        return True
+    
+    async def _watch_registry(self) -> None:
+        """Reload the registry whenever its files change."""
+        fingerprint = await asyncio.to_thread(registry_fingerprint, INSPIRATIONS_REGISTRY_PATH)
+        while True:
+            await asyncio.sleep(REGISTRY_POLL_INTERVAL)
+            try:
+                current = await asyncio.to_thread(registry_fingerprint, INSPIRATIONS_REGISTRY_PATH)
+                if current == fingerprint:
+                    continue
+                # Remember the broken version too, so it is reported once, not every poll
+                fingerprint = current
+                await self.reload_registry()
+            except (OSError, ValueError) as e:
+                print(f"Inspiration registry reload failed, keeping version {self.registry.version}: {e}")
+    
+    async def _run_job(
+        self,
+        job_input: Dict[str, Any],
+        job_id: str,
+        tenant: str,
+        reservation: Optional[str]
+    ) -> Dict[str, Any]:
+        """Job runner for self.jobs: the normal request path, keyed by job id, paid from the submit-time reservation."""
+        output = await self._generate(InspirationInput(**job_input), job_id[:8], tenant=tenant, reservation=reservation)
+        return output.model_dump()
+    
+    @fal.endpoint("/metrics")
+    async def metrics_endpoint(self) -> PlainTextResponse:
+        """
+        Prometheus text exposition of request/stage latency histograms and
+        live admission, cache, coalescing and pre-flight state.
+        """
+        lines = self.metrics.render()
+        admission = self.admission.snapshot()
+        lines += render_gauges(
+            "stock_inspirations_admission_limit", "Current adaptive concurrency limit", "model",
+            {model: s["limit"] for model, s in admission.items()}
+        )
+        lines += render_gauges(
+            "stock_inspirations_admission_in_flight", "Upstream jobs currently admitted", "model",
+            {model: s["in_flight"] for model, s in admission.items()}
+        )
+        lines += render_gauges(
+            "stock_inspirations_admission_waiting", "Requests waiting for admission", "model",
+            {model: s["queued"] for model, s in admission.items()}
+        )
+        lanes = self.admission.lanes()
+        lines += render_gauges(
+            "stock_inspirations_lane_queued", "Requests waiting for admission per priority lane (all models)", "lane",
+            {lane: s["queued"] for lane, s in lanes.items()}
+        )
+        lines += render_counters(
+            "stock_inspirations_lane_preempted", "Queued requests evicted by higher-priority work", "lane",
+            {lane: s["preempted"] for lane, s in lanes.items()}
+        )
+        lines += render_counters(
+            "stock_inspirations_cache_lookups", "Result cache lookups", "result",
+            {"hit": self.result_cache.hits, "miss": self.result_cache.misses}
+        )
+        lines += render_counters(
+            "stock_inspirations_single_flight", "Generations run as leader or coalesced onto one", "role",
+            {"leader": self.single_flight.leaders, "coalesced": self.single_flight.coalesced}
+        )
+        lines += render_counters(
+            "stock_inspirations_preflight", "Input image pre-flight outcomes", "outcome",
+            {
+                "checked": self.preflight.checks,
+                "cache_hit": self.preflight.cache_hits,
+                "rejected": self.preflight.rejected,
+                "rehosted": self.preflight.rehosted
+            }
+        )
+        lines += render_counters(
+            "stock_inspirations_mode_decisions", "Execution mode planner decisions", "reason",
+            self.planner.snapshot()
+        )
+        fal_pool = self.fal_client.snapshot()
+        lines += render_counters(
+            "stock_inspirations_fal_requests", "Requests sent by the shared fal client", "client",
+            {"fal": fal_pool["requests"]}
+        )
+        lines += render_gauges(
+            "stock_inspirations_fal_pool", "Shared fal client pooled connections", "kind",
+            {k: v for k, v in fal_pool.items() if k not in ("requests", "http2")}
+        )
+        jobs = self.jobs.snapshot()
+        lines += render_gauges(
+            "stock_inspirations_jobs_queued", "Async jobs waiting for a worker", "state",
+            {"queued": jobs["queued"]}
+        )
+        lines += render_counters(
+            "stock_inspirations_jobs", "Async jobs submitted and webhook deliveries", "event",
+            {k: v for k, v in jobs.items() if k != "queued"}
+        )
+        lines += render_counters(
+            "stock_inspirations_renditions", "Output post-processing: images, renditions, failures and bytes in/out", "kind",
+            self.renditions.snapshot()
+        )
+        lines += render_gauges(
+            "stock_inspirations_budget_spent_usd", "Estimated spend today per tenant (hashed API key)", "tenant",
+            self.budgets.snapshot()
+        )
+        lines += render_counters(
+            "stock_inspirations_budget_rejections", "Requests rejected for exceeding a budget", "reason",
+            {"budget": self.budgets.rejected}
+        )
+        lines += render_gauges(
+            "stock_inspirations_registry_inspirations", "Inspirations in the active registry", "version",
+            {self.registry.version: len(self.registry.plans)}
+        )
+        return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+    
+    async def _generate(
+        self,
+        input: InspirationInput,
+        request_id: str,
+        on_image: Optional[ImageCallback] = None,
+        on_progress: Optional[ProgressCallback] = None,
+        registry: Optional[Registry] = None,
+        tenant: str = "anonymous",
+        reservation: Optional[str] = None
+    ) -> InspirationOutput:
+        """Run a single inspiration job and record its metrics; raises HTTPException on failure."""
+        start_time = time.time()
+        stats = GenerationStats(on_progress=on_progress)
+        status = "500"
+        # Captured once: a concurrent reload must not swap the plan mid-request
+        registry = registry or self.registry
+        plan = registry.plans.get(input.inspiration_name)
+        try:
+            output = await self._run_inspiration(input, request_id, stats, registry, tenant, on_image, reservation)
+            status = "200"
+            return output
+        except HTTPException as e:
+            status = str(e.status_code)
+            raise
+        finally:
+            self.metrics.record_request(
+                # Caller-supplied names would make label cardinality unbounded
+                inspiration=input.inspiration_name if plan else "unknown",
+                model=plan.model if plan else "unknown",
+                execution_mode=stats.execution_mode or (plan.execution_mode if plan else "unknown"),
+                quality=input.quality,
+                status=status,
+                seconds=time.time() - start_time,
+                stats=stats,
+                priority=input.priority
+            )
+    
+    async def _check_diversity(
+        self,
+        input: InspirationInput,
+        plan: InspirationPlan,
+        arguments: Dict[str, Any],
+        execution_mode: str,
+        source: str,
+        images: List[Dict[str, Any]],
+        request_id: str,
+        stats: GenerationStats,
+        tenant: str
+    ) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """
+        Flag (and with diversity="regenerate", replace) near-duplicate images.
+        
+        Replacements are generated in parallel mode, one independent request
+        per image, and only accepted if they are distinct from every kept
+        image. The check is best-effort: if images cannot be fetched the
+        result is returned unchecked.
+        
+        Returns:
+            (images, number of near-duplicates found, or None if unchecked)
+        """
+        try:
+            hashes = await self.diversity.hashes([image["url"] for image in images])
+        except Exception as e:
+            print(f"[{request_id}] Diversity check skipped: {e}")
+            return images, None
+        
+        duplicate_of = near_duplicates(hashes)
+        slots = [i for i, match in enumerate(duplicate_of) if match is not None]
+        found = len(slots)
+        stats.diversity_checked += len(images)
+        stats.duplicates += found
+        if source == "generated":
+            self.planner.record_duplicates(plan.model, plan.name, execution_mode, len(images), found)
+        print(f"[{request_id}] Diversity: {found}/{len(images)} near-duplicates")
+        
+        images = [dict(image) for image in images]
+        if input.diversity == "regenerate" and slots:
+            import numpy as np
+            kept = hashes[[i for i, match in enumerate(duplicate_of) if match is None]]
+            for _ in range(DIVERSITY_MAX_ROUNDS):
+                try:
+                    replacements, _ = await execute_generation_cached(
+                        cache=None,
+                        single_flight=None,
+                        admission=self.admission,
+                        stats=stats,
+                        backend=plan.backend,
+                        arguments=arguments,
+                        execution_mode="parallel",
+                        request_id=request_id,
+                        num_images=len(slots),
+                        priority=input.priority,
+                        tenant=tenant,
+                        budgets=self.budgets
+                    )
+                    new_hashes = await self.diversity.hashes([image["url"] for image in replacements])
+                except Exception as e:
+                    # Keep the flagged originals rather than failing a successful request
+                    print(f"[{request_id}] Regeneration of near-duplicates failed: {e}")
+                    break
+                for replacement, new_hash in zip(replacements, new_hashes):
+                    if not slots or (hamming_distances(new_hash[None], kept) <= DIVERSITY_MAX_DISTANCE).any():
+                        continue
+                    slot = slots.pop(0)
+                    images[slot] = {**replacement, "index": slot}
+                    duplicate_of[slot] = None
+                    kept = np.vstack([kept, new_hash])
+                    stats.regenerated += 1
+                if not slots:
+                    break
+        
+        for image, match in zip(images, duplicate_of):
+            if match is not None:
+                image["near_duplicate_of"] = images[match]["index"]
+        return images, found
+    
+    def _tenant(self, request: Request) -> str:
+        """
+        Tenant id for a request (see resolve_tenant).
+        
+        Raises:
+            HTTPException: 401/403 for a missing or unlisted API key while budgets are configured
+        """
+        try:
+            return resolve_tenant(request.headers.get(TENANT_HEADER), self.budgets.budgets, self.tenant_weights)
+        except TenantRejected as e:
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+    
+    def _reject_invalid(self, input: InspirationInput, registry: Registry, request_id: str) -> None:
+        """
+        Check a request against the registry's constraint index and the output options.
+        
+        Raises:
+            HTTPException: 400 listing every problem found
+        """
+        errors = registry.validate(input.inspiration_name, input.image_urls, input.aspect_ratio, input.extra_prompt)
+        if input.output is not None:
+            if not input.output.include_original and not input.output.sizes:
+                errors.append("output needs include_original or at least one size")
+            if any(not 16 <= size <= 4096 for size in input.output.sizes):
+                errors.append("output sizes must be between 16 and 4096 pixels")
+            if input.output.format not in self.rendition_formats:
+                errors.append(f"Output format '{input.output.format}' is not supported on this server")
+        if errors:
+            error_msg = "; ".join(errors)
+            print(f"[{request_id}] Rejected: {error_msg}")
+            raise HTTPException(status_code=400, detail=error_msg)
+    
+    async def _run_inspiration(
+        self,
+        input: InspirationInput,
+        request_id: str,
+        stats: GenerationStats,
+        registry: Registry,
+        tenant: str,
+        on_image: Optional[ImageCallback] = None,
+        reservation: Optional[str] = None
+    ) -> InspirationOutput:
+        """Validate, plan and execute one inspiration job, recording stage spans in stats."""
+        start_time = time.time()
+        
+        # Every input constraint in one pass, before any logging, I/O or upstream work
+        self._reject_invalid(input, registry, request_id)
+        plan = registry.plans[input.inspiration_name]
+        stats.record("validation", time.time() - start_time)
         
         print(f"[{request_id}] Starting request")
         print(f"[{request_id}] Inspiration: {input.inspiration_name}")
@@ -805,50 +5083,83 @@ class StockInspirations(fal.App):
         if input.aspect_ratio:
             print(f"[{request_id}] Aspect ratio: {input.aspect_ratio}")
         
-        # Get inspiration config
-        inspiration = get_inspiration(input.inspiration_name)
-        if not inspiration:
-            available = list_inspirations()
-            error_msg = f"Unknown inspiration: {input.inspiration_name}. Available: {', '.join(available)}"
-            print(f"[{request_id}] Error: {error_msg}")
-            raise HTTPException(status_code=400, detail=error_msg)
-        
-        # Validate input image count
-        if not validate_input_count(input.inspiration_name, len(input.image_urls)):
-            error_msg = (
-                f"Inspiration '{input.inspiration_name}' requires "
-                f"{inspiration['min_images']}-{inspiration['max_images']} images, "
-                f"but {len(input.image_urls)} were provided"
-            )
-            print(f"[{request_id}] Error: {error_msg}")
-            raise HTTPException(status_code=400, detail=error_msg)
-        
         # Build prompt (blackbox magic)
-        prompt = build_prompt(input.inspiration_name, input.extra_prompt)
+        stage_start = time.time()
+        prompt = plan.build_prompt(input.extra_prompt)
+        stats.record("prompt_build", time.time() - stage_start)
         print(f"[{request_id}] Prompt: {prompt}")
         
-        # Get execution strategy from inspiration config
-        execution_mode = inspiration.get("execution_mode", "batch")
-        model = inspiration.get("model", "fal-ai/nano-banana/edit")
-        camera_params = inspiration.get("camera_params", None)
-        
+        model = plan.model
+        num_images = input.num_images or plan.num_images
+        # Batch vs parallel from live latency/success data and current load
+        execution_mode, mode_decision = self.planner.choose(plan, self.admission.limiter(model).utilisation())
+        stats.execution_mode = execution_mode
         print(f"[{request_id}] Model: {model}")
-        print(f"[{request_id}] Strategy: {execution_mode.upper()}")
+        print(f"[{request_id}] Strategy: {execution_mode.upper()} ({mode_decision}), {num_images} image(s)")
         
+        generation_start = None
         try:
-            # Execute generation using the configured strategy
-            generated_images = await execute_generation(
-                model=model,
-                prompt=prompt,
-                image_urls=input.image_urls,
-                aspect_ratio=input.aspect_ratio,
+            # Fail bad inputs in milliseconds, before any upstream job is queued
+            image_urls = input.image_urls
+            if input.validate_images:
+                preflight_start = time.time()
+                checked = await self.preflight.check_all(image_urls)
+                image_urls = [result.url for result in checked]
+                stats.record("preflight", time.time() - preflight_start)
+                print(f"[{request_id}] Input images checked in {time.time() - preflight_start:.2f}s")
+            
+            # Template lookup plus merge of the per-request fields
+            stage_start = time.time()
+            arguments = plan.arguments(image_urls, prompt, input.aspect_ratio, input.quality)
+            stats.record("arguments", time.time() - stage_start)
+            
+            # Execute generation using the planned strategy; only upstream work is charged to the budget
+            generation_start = time.time()
+            generated_images, source = await execute_generation_cached(
+                cache=self.result_cache if input.use_cache else None,
+                single_flight=self.single_flight if input.use_cache else None,
+                admission=self.admission,
+                stats=stats,
+                backend=plan.backend,
+                arguments=arguments,
                 execution_mode=execution_mode,
                 request_id=request_id,
-                camera_params=camera_params
+                num_images=num_images,
+                on_image=on_image,
+                priority=input.priority,
+                tenant=tenant,
+                budgets=self.budgets,
+                reservation=reservation
             )
+            if source == "generated":
+                self.planner.record(model, plan.name, execution_mode, time.time() - generation_start, ok=True)
+            
+            # Optional near-duplicate check, before renditions so replacements get them too
+            near_duplicates = None
+            if input.diversity != "off" and len(generated_images) > 1:
+                stage_start = time.time()
+                generated_images, near_duplicates = await self._check_diversity(
+                    input, plan, arguments, execution_mode, source, generated_images, request_id, stats, tenant
+                )
+                stats.record("diversity", time.time() - stage_start)
+            
+            # Optional delivery renditions (transcode + thumbnails), all images at once
+            if input.output is not None:
+                stage_start = time.time()
+                generated_images = await self.renditions.render_all(generated_images, input.output)
+                stats.record("postprocess", time.time() - stage_start)
+                print(f"[{request_id}] Renditions ({input.output.format}) done in {time.time() - stage_start:.2f}s")
             
             processing_time = time.time() - start_time
             print(f"[{request_id}] Success! Generated {len(generated_images)} images in {processing_time:.2f}s")
+            # Partial result: say which images are missing and why instead of dropping them silently
+            shortfall = max(0, num_images - len(generated_images))
+            error = None
+            if shortfall:
+                error = f"{shortfall} of {num_images} images could not be generated"
+                if stats.dropped:
+                    error += ": " + "; ".join(stats.dropped)
+                print(f"[{request_id}] {error}")
             
             return InspirationOutput(
                 success=True,
@@ -858,12 +5169,52 @@ class StockInspirations(fal.App):
                 input_image_count=len(input.image_urls),
                 aspect_ratio=input.aspect_ratio,
                 execution_mode=execution_mode,
+                mode_decision=mode_decision,
                 model=model,
+                quality=input.quality,
+                num_images=num_images,
+                shortfall=shortfall,
                 processing_time=processing_time,
+                inference_time=stats.inference_seconds if stats.upstream_calls else None,
+                cache_hit=source == "cache",
+                coalesced=source == "coalesced",
+                retries=stats.retries,
+                hedges=stats.hedges,
+                near_duplicates=near_duplicates,
+                regenerated=stats.regenerated,
+                upstream_calls=stats.upstream_calls,
+                cost_estimate=round(stats.cost, 6),
+                timeline=[TimelineEvent(**event) for event in stats.timeline],
                 request_id=request_id,
-                error=None
+                error=error
             )
         
+        except BudgetExceeded as e:
+            # The caller's daily spend limit would be exceeded
+            processing_time = time.time() - start_time
+            print(f"[{request_id}] Over budget ({processing_time:.2f}s): {e}")
+            raise HTTPException(
+                status_code=402,
+                detail=str(e),
+                headers={"Retry-After": str(int(math.ceil(e.retry_after)))}
+            )
+        
+        except AdmissionRejected as e:
+            # Load shedding - the model's concurrency budget is exhausted
+            processing_time = time.time() - start_time
+            print(f"[{request_id}] Rejected ({processing_time:.2f}s): {e}")
+            raise HTTPException(
+                status_code=429,
+                detail=str(e),
+                headers={"Retry-After": str(int(math.ceil(e.retry_after)))}
+            )
+        
+        except RehostFailed as e:
+            # Input was fine, but fal storage could not take the downscaled copy
+            processing_time = time.time() - start_time
+            print(f"[{request_id}] Re-host failed ({processing_time:.2f}s): {e}")
+            raise HTTPException(status_code=502, detail=str(e))
+        
         except ValueError as e:
             # Client errors (invalid input, unsupported aspect ratio, etc.)
             processing_time = time.time() - start_time
@@ -874,7 +5225,14 @@ class StockInspirations(fal.App):
         except Exception as e:
             # Server errors (model failures, network issues, etc.)
             processing_time = time.time() - start_time
+            if generation_start is not None:
+                self.planner.record(model, plan.name, execution_mode, time.time() - generation_start, ok=False)
             error_msg = str(e)
+            rejection = upstream_rejection(e)
+            if rejection is not None:
+                # Permanent upstream failure: surface the model's own message
+                print(f"[{request_id}] Upstream Error ({processing_time:.2f}s): {rejection[1]}")
+                raise HTTPException(status_code=rejection[0], detail=rejection[1])
             print(f"[{request_id}] Server Error ({processing_time:.2f}s): {error_msg}")
             raise HTTPException(status_code=500, detail=f"Image generation failed: {error_msg}")
 
@@ -0,0 +1,1373 @@
+"""
+Unit tests for the Stock Inspirations app. No network access or fal
+credentials are needed: upstream HTTP goes through httpx.MockTransport and
+upstream jobs through scripted in-process backends.
+
+Run with: python -m pytest -q
+"""
+
+import asyncio
+import io
+import json
+
+import fal_client
+import httpx
+import pytest
+
+import stock_inspirations_app as app
+
+
+def http_error(status: int) -> httpx.HTTPStatusError:
+    request = httpx.Request("GET", f"{app.FAL_QUEUE_URL}/fal-ai/nano-banana/edit/requests/req-1")
+    return httpx.HTTPStatusError(f"HTTP {status}", request=request, response=httpx.Response(status, request=request))
+
+
+class ScriptedHandle:
+    """Upstream job that completes at once with a result or raises an error."""
+
+    def __init__(self, outcome):
+        self.outcome = outcome
+
+    async def iter_events(self, *, with_logs=False, interval=0.1):
+        yield fal_client.Completed(logs=[] if with_logs else None, metrics={})
+
+    async def get(self, *, interval=0.1):
+        if isinstance(self.outcome, BaseException):
+            raise self.outcome
+        return self.outcome
+
+    async def cancel(self):
+        pass
+
+
+class ScriptedBackend(app.PromptEditBackend):
+    """Nano-banana backend whose jobs succeed or fail in a scripted order."""
+
+    def __init__(self, *outcomes, model_id="fal-ai/nano-banana/edit"):
+        super().__init__(model_id)
+        self.outcomes = list(outcomes)
+        self.submitted = 0
+        self.arguments = []
+
+    async def submit(self, arguments):
+        self.submitted += 1
+        self.arguments.append(arguments)
+        outcome = self.outcomes.pop(0) if self.outcomes else None
+        if outcome is None:
+            outcome = {"images": [
+                {"url": f"https://cdn.local/{self.submitted}/{i}.png"} for i in range(arguments.get("num_images", 1))
+            ]}
+        return ScriptedHandle(outcome)
+
+
+async def post(path, payload, headers=None):
+    """POST to a freshly set-up app instance in-process; returns the response."""
+    asgi = app.StockInspirations(_allow_init=True)._build_app()
+    async with asgi.router.lifespan_context(asgi):
+        transport = httpx.ASGITransport(app=asgi)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=None) as client:
+            return await client.post(path, json=payload, headers=headers or {})
+
+
+@pytest.fixture
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(app, "RETRY_BASE_DELAY", 0.0)
+
+
+# ============================================================================
+# UPSTREAM CLIENT
+# ============================================================================
+
+def queue_transport(requests, statuses, result):
+    """Mock fal queue API: one job that reports statuses in order, then result."""
+    base = f"{app.FAL_QUEUE_URL}/fal-ai/nano-banana/edit/requests/req-1"
+    statuses = list(statuses)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        url = str(request.url)
+        if request.method == "POST" and url == f"{app.FAL_QUEUE_URL}/fal-ai/nano-banana/edit":
+            return httpx.Response(200, json={
+                "request_id": "req-1",
+                "status_url": f"{base}/status",
+                "response_url": base,
+                "cancel_url": f"{base}/cancel"
+            })
+        if request.method == "GET" and url.startswith(f"{base}/status"):
+            return httpx.Response(200, json=statuses.pop(0) if len(statuses) > 1 else statuses[0])
+        if request.method == "GET" and url == base:
+            return httpx.Response(200, json=result)
+        if request.method == "PUT" and url == f"{base}/cancel":
+            return httpx.Response(202, json={"status": "CANCELLATION_REQUESTED"})
+        return httpx.Response(404, json={"detail": "not found"})
+
+    return httpx.MockTransport(handler)
+
+
+def test_pooled_client_submit_follows_queue_api():
+    requests = []
+    statuses = [
+        {"status": "IN_QUEUE", "queue_position": 2},
+        {"status": "IN_PROGRESS", "logs": [{"message": "step 1"}]},
+        {"status": "COMPLETED", "logs": [], "metrics": {"inference_time": 1.5}}
+    ]
+    result = {"images": [{"url": "https://cdn.local/0.png"}]}
+    client = app.PooledFalClient(key="test-key", transport=queue_transport(requests, statuses, result))
+
+    async def run():
+        handle = await client.submit("fal-ai/nano-banana/edit", {"prompt": "p", "image_urls": []})
+        events = [event async for event in handle.iter_events(with_logs=True, interval=0)]
+        output = await handle.get(interval=0)
+        await handle.cancel()
+        await client.aclose()
+        return handle, events, output
+
+    handle, events, output = asyncio.run(run())
+
+    assert handle.request_id == "req-1"
+    assert [type(event) for event in events] == [fal_client.Queued, fal_client.InProgress, fal_client.Completed]
+    assert events[0].position == 2
+    assert events[-1].metrics == {"inference_time": 1.5}
+    assert output == result
+    assert json.loads(requests[0].content) == {"prompt": "p", "image_urls": []}
+    assert all(r.headers["Authorization"] == "Key test-key" for r in requests)
+    assert client.snapshot()["requests"] == len(requests)
+
+
+def test_backend_submit_uses_shared_client():
+    requests = []
+    statuses = [{"status": "COMPLETED", "logs": None, "metrics": {}}]
+    result = {"images": [{"url": "https://cdn.local/0.png"}]}
+    client = app.PooledFalClient(key="test-key", transport=queue_transport(requests, statuses, result))
+    backend = app.PromptEditBackend("fal-ai/nano-banana/edit")
+
+    async def run():
+        app.set_fal_client(client)
+        try:
+            handle = await backend.submit({"prompt": "p", "image_urls": [], "num_images": 1})
+            return await handle.get(interval=0)
+        finally:
+            app.set_fal_client(None)
+            await client.aclose()
+
+    assert asyncio.run(run()) == result
+
+
+def test_upstream_http_errors_carry_status():
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(422, json={"detail": "bad arguments"})
+
+    client = app.PooledFalClient(key="test-key", transport=httpx.MockTransport(handler))
+
+    async def run():
+        try:
+            await client.submit("fal-ai/nano-banana/edit", {})
+        except httpx.HTTPStatusError as e:
+            return e.response.status_code
+        finally:
+            await client.aclose()
+
+    assert asyncio.run(run()) == 422
+
+
+def test_completed_job_result_is_fetched_without_another_status_poll():
+    requests = []
+    statuses = [{"status": "IN_PROGRESS", "logs": []}, {"status": "COMPLETED", "logs": [], "metrics": {}}]
+    result = {"images": [{"url": "https://cdn.local/0.png"}]}
+    client = app.PooledFalClient(key="test-key", transport=queue_transport(requests, statuses, result))
+    backend = app.PromptEditBackend("fal-ai/nano-banana/edit")
+
+    async def run():
+        app.set_fal_client(client)
+        try:
+            return await app.run_upstream_job(backend, {"prompt": "p", "num_images": 1}, "[test]", app.GenerationStats())
+        finally:
+            app.set_fal_client(None)
+            await client.aclose()
+
+    assert asyncio.run(run()) == result
+    assert sum(1 for r in requests if r.url.path.endswith("/status")) == 2
+
+
+def test_background_cancels_are_kept_until_done():
+    cancelled = []
+
+    class Handle:
+        async def cancel(self):
+            await asyncio.sleep(0)
+            cancelled.append(self)
+
+    async def run():
+        app.cancel_in_background(Handle())
+        assert len(app._PENDING_CANCELS) == 1
+        await asyncio.gather(*app._PENDING_CANCELS)
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert len(cancelled) == 1
+    assert not app._PENDING_CANCELS
+
+
+# ============================================================================
+# EXECUTION UNIT
+# ============================================================================
+
+def test_is_retryable_only_for_transient_failures():
+    assert app.is_retryable(asyncio.TimeoutError())
+    assert app.is_retryable(httpx.ConnectError("refused"))
+    assert app.is_retryable(http_error(429))
+    assert app.is_retryable(http_error(503))
+    assert app.is_retryable(app.FakeBackendError("simulated"))
+    assert not app.is_retryable(http_error(400))
+    assert not app.is_retryable(http_error(422))
+    assert not app.is_retryable(app.UpstreamError("no images"))
+
+
+def test_permanent_upstream_errors_are_not_retried(no_retry_delay):
+    backend = ScriptedBackend(http_error(422))
+    stats = app.GenerationStats()
+
+    async def run():
+        with pytest.raises(httpx.HTTPStatusError):
+            await app.run_upstream_job(backend, {"num_images": 1}, "[test]", stats)
+
+    asyncio.run(run())
+    assert backend.submitted == 1
+    assert stats.retries == 0
+
+
+def test_transient_upstream_errors_are_retried(no_retry_delay):
+    backend = ScriptedBackend(http_error(503), http_error(429))
+    stats = app.GenerationStats()
+    result = asyncio.run(app.run_upstream_job(backend, {"num_images": 1}, "[test]", stats))
+    assert len(result["images"]) == 1
+    assert backend.submitted == 3
+    assert stats.retries == 2
+
+
+def test_split_images_into_upstream_calls():
+    assert app.split_images(12, "batch", 4) == [4, 4, 4]
+    assert app.split_images(5, "batch", 4) == [3, 2]
+    assert app.split_images(4, "batch", 4) == [4]
+    assert app.split_images(3, "parallel", 4) == [1, 1, 1]
+
+
+def test_batch_fan_out_covers_every_requested_image():
+    backend = ScriptedBackend()
+    images = asyncio.run(app.run_generation(backend, {"prompt": "p"}, "batch", "test", num_images=12))
+    assert [arguments["num_images"] for arguments in backend.arguments] == [4, 4, 4]
+    assert [image["index"] for image in images] == list(range(12))
+
+
+def test_timeline_records_queue_positions_and_stage_spans():
+    class QueuedHandle(ScriptedHandle):
+        async def iter_events(self, *, with_logs=False, interval=0.1):
+            for position in (3, 3, 1):
+                yield fal_client.Queued(position=position)
+            yield fal_client.InProgress(logs=[{"message": "step 1"}])
+            yield fal_client.Completed(logs=[], metrics={"inference_time": 2.5})
+
+    class QueuedBackend(ScriptedBackend):
+        async def submit(self, arguments):
+            return QueuedHandle((await super().submit(arguments)).outcome)
+
+    forwarded = []
+
+    async def on_progress(event):
+        forwarded.append(event)
+
+    stats = app.GenerationStats(on_progress=on_progress)
+    asyncio.run(app.run_upstream_job(QueuedBackend(), {"num_images": 1}, "[test]", stats))
+
+    # Repeated positions are reported once
+    assert [(e["status"], e.get("position")) for e in stats.timeline] == [
+        ("submitted", None), ("queued", 3), ("queued", 1), ("in_progress", None), ("completed", None)
+    ]
+    assert forwarded == stats.timeline
+    assert all(e["job"] == "batch" for e in stats.timeline)
+    assert [stage for stage, _ in stats.spans] == ["submit", "queue_wait", "model_runtime", "result_fetch"]
+    assert all(seconds >= 0 for _, seconds in stats.spans)
+    assert stats.inference_seconds == 2.5
+
+
+def test_parallel_calls_run_concurrently_with_a_per_call_timeout():
+    class SlowBackend(ScriptedBackend):
+        async def submit(self, arguments):
+            handle = await super().submit(arguments)
+            # The third call straggles past the per-call timeout
+            return DelayedHandle(handle.outcome, 5.0 if self.submitted == 3 else 0.2)
+
+    backend = SlowBackend()
+    stats = app.GenerationStats()
+
+    async def run():
+        start = asyncio.get_running_loop().time()
+        images = await app.run_generation(
+            backend, {"prompt": "p"}, "parallel", "test", num_images=3, variant_timeout=0.5, stats=stats
+        )
+        return images, asyncio.get_running_loop().time() - start
+
+    images, elapsed = asyncio.run(run())
+    assert backend.submitted == 3
+    assert [arguments["num_images"] for arguments in backend.arguments] == [1, 1, 1]
+    # Concurrent: bounded by the timeout, not the sum of the call latencies
+    assert elapsed < 1.0
+    assert sorted(image["index"] for image in images) == [0, 1]
+    assert stats.dropped == ["request-3: timed out after 0.5s"]
+
+
+def test_partial_generation_reports_shortfall(monkeypatch):
+    # Pinned to parallel: one upstream call per image, two of them rejected for good
+    backend = ScriptedBackend(None, http_error(422), http_error(422))
+    monkeypatch.setitem(app.MODEL_BACKENDS, backend.model_id, backend)
+    response = asyncio.run(post("/", {
+        "inspiration_name": "creative_color_material",
+        "image_urls": ["https://example.com/a.jpg"],
+        "num_images": 3,
+        "validate_images": False,
+        "use_cache": False
+    }))
+    assert response.status_code == 200
+    output = response.json()
+    assert len(output["images"]) == 1
+    assert output["num_images"] == 3
+    assert output["shortfall"] == 2
+    assert "2 of 3 images could not be generated" in output["error"]
+
+
+def upstream_http_error(status: int, detail) -> httpx.HTTPStatusError:
+    request = httpx.Request("GET", f"{app.FAL_QUEUE_URL}/fal-ai/nano-banana/edit/requests/req-1")
+    response = httpx.Response(status, json={"detail": detail}, request=request)
+    return httpx.HTTPStatusError(f"HTTP {status}", request=request, response=response)
+
+
+@pytest.mark.parametrize("status, detail, expected", [
+    (422, [{"loc": ["body", "image_urls"], "msg": "image could not be decoded"}], 422),
+    (400, "prompt rejected by the content checker", 422),
+    (403, "key has no access to this model", 502)
+])
+def test_permanent_upstream_failures_keep_the_upstream_message(monkeypatch, status, detail, expected):
+    backend = ScriptedBackend(*[upstream_http_error(status, detail)] * 3)
+    monkeypatch.setitem(app.MODEL_BACKENDS, backend.model_id, backend)
+    response = asyncio.run(post("/", {
+        "inspiration_name": "creative_color_material",
+        "image_urls": ["https://example.com/a.jpg"],
+        "num_images": 3,
+        "validate_images": False,
+        "use_cache": False
+    }))
+    assert response.status_code == expected
+    message = detail[0]["msg"] if isinstance(detail, list) else detail
+    assert f"({status}): {message}" in response.json()["detail"]
+
+
+# ============================================================================
+# ADMISSION CONTROL
+# ============================================================================
+
+class DelayedHandle(ScriptedHandle):
+    """Upstream job that completes after a delay."""
+
+    def __init__(self, outcome, delay):
+        super().__init__(outcome)
+        self.delay = delay
+
+    async def iter_events(self, *, with_logs=False, interval=0.1):
+        await asyncio.sleep(self.delay)
+        yield fal_client.Completed(logs=[] if with_logs else None, metrics={})
+
+
+class StragglerBackend(ScriptedBackend):
+    """First job straggles, later ones (hedges) finish at once; records in-flight slots per submit."""
+
+    def __init__(self, admission, straggle=0.3):
+        super().__init__()
+        self.admission = admission
+        self.straggle = straggle
+        self.in_flight = []
+
+    async def submit(self, arguments):
+        self.in_flight.append(self.admission.limiter(self.model_id).in_flight)
+        handle = await super().submit(arguments)
+        return DelayedHandle(handle.outcome, self.straggle if self.submitted == 1 else 0.0)
+
+
+def run_straggler(monkeypatch, limits):
+    """One single-image generation whose job straggles past p90; returns (backend, stats, images)."""
+    admission = app.AdmissionController(model_limits={"fal-ai/nano-banana/edit": limits})
+    backend = StragglerBackend(admission)
+    latencies = app.LatencyTracker()
+    for _ in range(app.HEDGE_MIN_SAMPLES):
+        latencies.record(backend.model_id, 1, 0.01)
+    monkeypatch.setattr(app, "JOB_LATENCIES", latencies)
+    stats = app.GenerationStats()
+    images, _ = asyncio.run(app.execute_generation_cached(
+        None, backend, {"prompt": "p", "image_urls": ["https://example.com/a.jpg"]}, "batch", "req",
+        num_images=1, admission=admission, stats=stats
+    ))
+    return backend, stats, images
+
+
+def test_hedges_take_an_admission_slot(monkeypatch):
+    backend, stats, images = run_straggler(monkeypatch, {"initial_limit": 2, "min_limit": 1})
+    limiter = backend.admission.limiter(backend.model_id)
+    assert backend.in_flight == [1, 2]
+    assert stats.hedges == 1
+    assert images[0]["url"] == "https://cdn.local/2/0.png"
+    assert limiter.admitted == 2
+    assert limiter.in_flight == 0
+
+
+def test_hedges_without_capacity_are_skipped(monkeypatch):
+    # Queue full: the hedge is shed and the original runs on unhedged
+    backend, stats, images = run_straggler(monkeypatch, {"initial_limit": 1, "min_limit": 1, "max_queue": 0})
+    limiter = backend.admission.limiter(backend.model_id)
+    assert backend.submitted == 1
+    assert stats.hedges == 0
+    assert images[0]["url"] == "https://cdn.local/1/0.png"
+    assert (limiter.rejected, limiter.in_flight) == (1, 0)
+
+    # Room to queue: the hedge waits for a slot and is withdrawn when the original finishes
+    backend, stats, images = run_straggler(monkeypatch, {"initial_limit": 1, "min_limit": 1})
+    limiter = backend.admission.limiter(backend.model_id)
+    assert backend.submitted == 1
+    assert stats.hedges == 0
+    assert limiter.snapshot()["queued"] == 0
+    assert (limiter.admitted, limiter.rejected, limiter.in_flight) == (1, 0, 0)
+
+
+def test_limiter_grows_additively_on_success():
+    limiter = app.AdaptiveLimiter("model", initial_limit=4, max_limit=5)
+    for _ in range(4):
+        limiter.observe(1.0)
+    # About one slot per window of `limit` successful attempts
+    assert 4.9 < limiter.limit < 5.0
+    assert limiter.baseline_latency == {1: pytest.approx(1.0)}
+
+    for _ in range(4):
+        limiter.observe(1.0)
+    assert limiter.limit == 5.0
+
+
+def test_limiter_backs_off_on_transient_errors_and_congestion():
+    limiter = app.AdaptiveLimiter("model", initial_limit=8, min_limit=2, backoff=0.5, latency_tolerance=2.0)
+    limiter.observe(1.0)
+    baseline = limiter.limit
+    limiter.observe(5.0, http_error(503))
+    assert limiter.limit == pytest.approx(baseline / 2)
+    assert limiter.errors == 1
+
+    # Successful but far slower than the baseline for its size: congestion
+    limiter.observe(2.5)
+    assert limiter.limit == pytest.approx(baseline / 4)
+    assert limiter.errors == 1
+
+    for _ in range(3):
+        limiter.observe(5.0, asyncio.TimeoutError())
+    assert limiter.limit == 2.0
+
+
+def test_limiter_ignores_permanent_errors_and_compares_like_sizes():
+    limiter = app.AdaptiveLimiter("model", initial_limit=8, latency_tolerance=2.0)
+    limiter.observe(1.0, size=1)
+    limit = limiter.limit
+    # Bad client input says nothing about upstream load
+    limiter.observe(0.5, http_error(422))
+    limiter.observe(0.5, app.UpstreamError("no images"))
+    assert limiter.limit == limit
+    assert limiter.errors == 0
+
+    # A 4-image call is slower than a 1-image one without being congested
+    limiter.observe(3.0, size=4)
+    assert limiter.limit > limit
+    assert limiter.baseline_latency == {1: pytest.approx(1.0), 4: pytest.approx(3.0)}
+
+
+def test_admission_slots_do_not_feed_aimd():
+    admission = app.AdmissionController(model_limits={"model": {"initial_limit": 4}})
+
+    async def run():
+        with pytest.raises(httpx.HTTPStatusError):
+            async with admission.admit("model", weight=2):
+                await asyncio.sleep(0.01)
+                raise http_error(422)
+
+    asyncio.run(run())
+    limiter = admission.limiter("model")
+    assert (limiter.limit, limiter.in_flight, limiter.baseline_latency) == (4.0, 0, {})
+
+
+def queued(lane, tenant, weight=1):
+    # LaneScheduler only orders waiters; it never touches their futures
+    return app.Waiter(weight, lane, tenant, future=None)
+
+
+def drain(scheduler):
+    order = []
+    while scheduler.peek() is not None:
+        waiter = scheduler.pop()
+        order.append((waiter.lane, waiter.tenant))
+    return order
+
+
+def test_utilisation_counts_queued_weight_not_waiters():
+    limiter = app.AdaptiveLimiter("model", initial_limit=4, min_limit=4)
+
+    async def run():
+        await limiter.acquire(weight=4)
+        small = asyncio.ensure_future(limiter.acquire(weight=1))
+        large = asyncio.ensure_future(limiter.acquire(weight=12))
+        await asyncio.sleep(0)
+        assert limiter.snapshot()["queued"] == 2
+        assert limiter.snapshot()["queued_weight"] == 13
+        assert limiter.utilisation() == (4 + 13) / 4
+        large.cancel()
+        await asyncio.gather(large, return_exceptions=True)
+        assert limiter.utilisation() == (4 + 1) / 4
+        limiter.release(4)
+        await small
+        assert limiter.snapshot()["queued_weight"] == 0
+
+    asyncio.run(run())
+
+
+def test_lanes_are_served_in_strict_priority():
+    scheduler = app.LaneScheduler()
+    for lane in ("bulk", "standard", "interactive", "bulk", "interactive"):
+        scheduler.push(queued(lane, "a"))
+    assert [lane for lane, _ in drain(scheduler)] == ["interactive", "interactive", "standard", "bulk", "bulk"]
+    assert len(scheduler) == 0
+
+
+def test_tenants_share_a_lane_by_weight():
+    scheduler = app.LaneScheduler({"heavy": 2, "*": 1})
+    for _ in range(6):
+        scheduler.push(queued("standard", "heavy"))
+    for _ in range(3):
+        scheduler.push(queued("standard", "light"))
+    order = [tenant for _, tenant in drain(scheduler)]
+    assert order == ["heavy", "heavy", "light"] * 3
+
+
+def test_deep_backlog_does_not_block_other_tenants():
+    scheduler = app.LaneScheduler()
+    for _ in range(10):
+        scheduler.push(queued("bulk", "backlog"))
+    scheduler.pop()
+    scheduler.pop()
+    # A tenant arriving later starts at the lane's virtual time, not behind the backlog
+    scheduler.push(queued("bulk", "newcomer"))
+    order = [tenant for _, tenant in drain(scheduler)]
+    assert order.index("newcomer") == 1
+
+
+def test_removed_waiters_are_skipped():
+    scheduler = app.LaneScheduler()
+    first, second = queued("standard", "a"), queued("standard", "b")
+    scheduler.push(first)
+    scheduler.push(second)
+    scheduler.remove(first)
+    assert scheduler.depth["standard"] == 1
+    assert scheduler.pop() is second
+    assert len(scheduler) == 0
+
+
+def test_limiter_admits_higher_lanes_first():
+    limiter = app.AdaptiveLimiter("model", initial_limit=1, min_limit=1)
+    admitted = []
+
+    async def wait(lane):
+        await limiter.acquire(lane=lane)
+        admitted.append(lane)
+
+    async def run():
+        await limiter.acquire()
+        waiters = [asyncio.ensure_future(wait(lane)) for lane in ("bulk", "standard", "interactive")]
+        await asyncio.sleep(0)
+        assert limiter.snapshot()["lanes"] == {"interactive": 1, "standard": 1, "bulk": 1}
+        for _ in range(3):
+            limiter.release(1)
+            await asyncio.sleep(0)
+        await asyncio.gather(*waiters)
+
+    asyncio.run(run())
+    assert admitted == ["interactive", "standard", "bulk"]
+
+
+def test_interactive_arrival_overtakes_queued_bulk_below_the_queue_limit():
+    limiter = app.AdaptiveLimiter("model", initial_limit=1, min_limit=1, max_queue=8)
+    admitted = []
+
+    async def wait(lane):
+        await limiter.acquire(lane=lane)
+        admitted.append(lane)
+
+    async def run():
+        await limiter.acquire()
+        bulk = [asyncio.ensure_future(wait("bulk")) for _ in range(3)]
+        await asyncio.sleep(0)
+        interactive = asyncio.ensure_future(wait("interactive"))
+        await asyncio.sleep(0)
+        limiter.release(1)
+        await interactive
+        for _ in range(3):
+            limiter.release(1)
+            await asyncio.sleep(0)
+        await asyncio.gather(*bulk)
+
+    asyncio.run(run())
+    # Deferred, not evicted
+    assert admitted == ["interactive", "bulk", "bulk", "bulk"]
+    assert limiter.preempted["bulk"] == 0
+
+
+def test_full_queue_preempts_bulk_for_interactive():
+    limiter = app.AdaptiveLimiter("model", initial_limit=1, min_limit=1, max_queue=1)
+
+    async def run():
+        await limiter.acquire()
+        bulk = asyncio.ensure_future(limiter.acquire(lane="bulk"))
+        await asyncio.sleep(0)
+        interactive = asyncio.ensure_future(limiter.acquire(lane="interactive"))
+        await asyncio.sleep(0)
+        with pytest.raises(app.AdmissionRejected, match="preempted"):
+            await bulk
+        limiter.release(1)
+        await interactive
+
+    asyncio.run(run())
+    assert limiter.preempted["bulk"] == 1
+    assert limiter.in_flight == 1
+
+
+def test_full_queue_rejects_standard_instead_of_preempting_bulk():
+    limiter = app.AdaptiveLimiter("model", initial_limit=1, min_limit=1, max_queue=1)
+
+    async def run():
+        await limiter.acquire()
+        bulk = asyncio.ensure_future(limiter.acquire(lane="bulk"))
+        await asyncio.sleep(0)
+        with pytest.raises(app.AdmissionRejected, match="queue full"):
+            await limiter.acquire(lane="standard")
+        limiter.release(1)
+        await bulk
+
+    asyncio.run(run())
+    assert limiter.preempted["bulk"] == 0
+
+
+# ============================================================================
+# BATCH
+# ============================================================================
+
+def test_batch_reports_invalid_jobs_individually(monkeypatch):
+    backend = ScriptedBackend()
+    monkeypatch.setitem(app.MODEL_BACKENDS, backend.model_id, backend)
+    response = asyncio.run(post("/batch", {"jobs": [
+        {
+            "inspiration_name": "creative_color_material",
+            "image_urls": ["https://example.com/a.jpg"],
+            "num_images": 1,
+            "validate_images": False,
+            "use_cache": False
+        },
+        {"inspiration_name": "no_such_inspiration", "image_urls": ["https://example.com/b.jpg"]}
+    ]}))
+    assert response.status_code == 200
+    output = response.json()
+    assert (output["succeeded"], output["failed"]) == (1, 1)
+    valid, invalid = output["results"]
+    assert valid["success"] and len(valid["output"]["images"]) == 1
+    assert not invalid["success"]
+    assert invalid["status_code"] == 422
+    assert "inspiration_name" in invalid["error"]
+    assert backend.submitted == 1
+
+
+# ============================================================================
+# STREAMING
+# ============================================================================
+
+def test_stream_emits_progress_then_images_then_a_summary(monkeypatch):
+    backend = ScriptedBackend()
+    monkeypatch.setitem(app.MODEL_BACKENDS, backend.model_id, backend)
+    response = asyncio.run(post("/stream", {
+        "inspiration_name": "marketplace_pure",
+        "image_urls": ["https://example.com/a.jpg"],
+        "num_images": 2,
+        "validate_images": False,
+        "use_cache": False
+    }))
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    records = [json.loads(line) for line in response.text.splitlines()]
+    types = [record["type"] for record in records]
+
+    assert types[0] == "progress"
+    assert records[0]["event"]["status"] == "submitted"
+    assert types.count("image") == 2
+    # The summary closes the stream, after every image
+    assert types[-1] == "summary"
+    streamed = [record["image"]["url"] for record in records if record["type"] == "image"]
+    assert [image["url"] for image in records[-1]["output"]["images"]] == streamed
+
+
+# ============================================================================
+# PREVIEW
+# ============================================================================
+
+def test_preview_reports_display_names(monkeypatch):
+    backend = ScriptedBackend()
+    monkeypatch.setitem(app.MODEL_BACKENDS, backend.model_id, backend)
+    response = asyncio.run(post("/preview", {
+        "image_urls": ["https://example.com/a.jpg"],
+        "inspiration_names": ["creative_color_material", "marketplace_pure"],
+        "validate_images": False,
+        "use_cache": False
+    }))
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [(r["inspiration_name"], r["name"]) for r in results] == [
+        ("creative_color_material", "Color Material"),
+        ("marketplace_pure", "Pure")
+    ]
+    assert all(r["success"] and len(r["output"]["images"]) == 1 for r in results)
+
+
+def test_preview_savings_on_nano_banana_come_from_the_image_count(monkeypatch):
+    # No step or size parameters: draft is the standard render, one image per inspiration
+    plan = app.compile_plan("marketplace_pure", app.INSPIRATIONS["marketplace_pure"])
+    assert plan.argument_templates["draft"] == plan.argument_templates["standard"]
+    backend = ScriptedBackend()
+    monkeypatch.setitem(app.MODEL_BACKENDS, backend.model_id, backend)
+    response = asyncio.run(post("/preview", {
+        "image_urls": ["https://example.com/a.jpg"],
+        "inspiration_names": ["marketplace_pure"],
+        "validate_images": False,
+        "use_cache": False
+    }))
+    assert response.status_code == 200
+    assert [arguments["num_images"] for arguments in backend.arguments] == [app.PREVIEW_NUM_IMAGES]
+
+
+# ============================================================================
+# ASYNC JOBS
+# ============================================================================
+
+def test_jobs_refused_without_shared_store(monkeypatch):
+    monkeypatch.setattr(app, "JOB_STORE_DB_PATH", None)
+    response = asyncio.run(post("/jobs", {
+        "inspiration_name": "marketplace_pure",
+        "image_urls": ["https://example.com/a.jpg"]
+    }))
+    assert response.status_code == 503
+    assert "STOCK_INSPIRATIONS_JOB_DB" in response.json()["detail"]
+
+
+@pytest.mark.parametrize("webhook_url", [
+    "http://127.0.0.1:8080/hook",
+    "http://169.254.169.254/latest/meta-data",
+    "http://[::1]/hook",
+    "ftp://example.com/hook"
+])
+def test_jobs_refuse_non_public_webhooks(monkeypatch, tmp_path, webhook_url):
+    monkeypatch.setattr(app, "JOB_STORE_DB_PATH", str(tmp_path / "jobs.db"))
+    response = asyncio.run(post("/jobs", {
+        "inspiration_name": "marketplace_pure",
+        "image_urls": ["https://example.com/a.jpg"],
+        "webhook_url": webhook_url
+    }))
+    assert response.status_code == 400
+    assert "Invalid webhook_url" in response.json()["detail"]
+
+
+def test_job_queue_close_fails_unfinished_jobs():
+    started = []
+
+    async def runner(job_input, job_id, tenant, reservation):
+        started.append(job_id)
+        await asyncio.Event().wait()
+
+    async def run():
+        store = app.SQLiteJobStore(":memory:")
+        queue = app.JobQueue(store=store, runner=runner, client=None, workers=1)
+        first = queue.submit({"n": 1})
+        second = queue.submit({"n": 2})
+        while not started:
+            await asyncio.sleep(0)
+        await queue.close()
+        return store.get(first["job_id"]), store.get(second["job_id"])
+
+    running, queued = asyncio.run(run())
+    assert running["status"] == queued["status"] == "failed"
+    assert running["status_code"] == queued["status_code"] == 503
+    assert running["completed_at"] is not None
+
+
+# ============================================================================
+# COST BUDGETS
+# ============================================================================
+
+def test_resolve_tenant_only_trusts_listed_keys():
+    budgets = app.parse_tenant_values('{"key-a": 10, "*": 1}', "BUDGETS")
+    weights = app.parse_tenant_values('{"key-w": 4}', "WEIGHTS", allow_zero=False)
+    assert app.resolve_tenant("key-a", budgets, weights) == app.tenant_id("key-a")
+    assert app.resolve_tenant("key-w", budgets, weights) == app.tenant_id("key-w")
+    assert app.resolve_tenant(None, budgets, weights) == "anonymous"
+    with pytest.raises(app.TenantRejected) as rejected:
+        app.resolve_tenant("made-up-key", budgets, weights)
+    assert rejected.value.status_code == 403
+
+    # Without a "*" budget, callers must send a listed key
+    with pytest.raises(app.TenantRejected) as rejected:
+        app.resolve_tenant(None, {app.tenant_id("key-a"): 10.0}, {})
+    assert rejected.value.status_code == 401
+
+    # Without budgets, invented keys share the anonymous tenant's fair-queuing share
+    assert app.resolve_tenant("made-up-key", {}, weights) == "anonymous"
+
+
+def test_unlisted_api_key_is_rejected(monkeypatch):
+    monkeypatch.setattr(app, "BUDGETS_JSON", '{"key-a": 10, "*": 1}')
+    response = asyncio.run(post("/", {
+        "inspiration_name": "marketplace_pure",
+        "image_urls": ["https://example.com/a.jpg"]
+    }, headers={app.TENANT_HEADER: "made-up-key"}))
+    assert response.status_code == 403
+
+
+def test_budget_charges_only_upstream_work():
+    backend = ScriptedBackend()
+    arguments = {"prompt": "p", "image_urls": ["https://example.com/a.jpg"]}
+    cache = app.ResultCache()
+    tenant = app.tenant_id("key-a")
+    budgets = app.BudgetLedger({tenant: 1.0})
+
+    async def generate(stats):
+        return await app.execute_generation_cached(
+            cache=cache, backend=backend, arguments=arguments, execution_mode="batch",
+            request_id="test", num_images=2, stats=stats, tenant=tenant, budgets=budgets
+        )
+
+    stats = app.GenerationStats()
+    images, source = asyncio.run(generate(stats))
+    assert source == "generated"
+    assert budgets.snapshot()[tenant] == pytest.approx(stats.cost) == pytest.approx(2 * app.DEFAULT_PRICE_PER_IMAGE)
+    assert budgets.remaining(tenant) == pytest.approx(1.0 - stats.cost)
+
+    # Exhausted budget: a cache hit is still served and costs nothing
+    budgets.settle(tenant, None, 10.0)
+    images_again, source = asyncio.run(generate(app.GenerationStats()))
+    assert source == "cache"
+    assert images_again == images
+
+    # ...but new upstream work is refused
+    arguments["prompt"] = "other"
+    with pytest.raises(app.BudgetExceeded):
+        asyncio.run(generate(app.GenerationStats()))
+    assert backend.submitted == 1
+
+
+def test_budget_ledger_is_shared_through_sqlite(tmp_path):
+    db_path = str(tmp_path / "budgets.db")
+    tenant = app.tenant_id("key-a")
+    runner_a = app.BudgetLedger({tenant: 1.0}, db_path=db_path)
+    runner_b = app.BudgetLedger({tenant: 1.0}, db_path=db_path)
+
+    reservation = runner_a.reserve(tenant, 0.75)
+    assert runner_b.remaining(tenant) == pytest.approx(0.25)
+    with pytest.raises(app.BudgetExceeded):
+        runner_b.reserve(tenant, 0.5)
+
+    runner_a.settle(tenant, reservation, 0.5)
+    assert runner_b.remaining(tenant) == pytest.approx(0.5)
+
+    # A restarted runner sees the day's spend
+    restarted = app.BudgetLedger({tenant: 1.0}, db_path=db_path)
+    assert restarted.snapshot() == {tenant: pytest.approx(0.5)}
+    restarted.release(restarted.reserve(tenant, 0.5))
+    assert restarted.remaining(tenant) == pytest.approx(0.5)
+
+
+def test_prepaid_reservation_is_settled_to_actual_cost():
+    backend = ScriptedBackend()
+    arguments = {"prompt": "p", "image_urls": ["https://example.com/a.jpg"]}
+    cache = app.ResultCache()
+    tenant = app.tenant_id("key-a")
+    budgets = app.BudgetLedger({tenant: 1.0})
+
+    def generate(reservation):
+        return asyncio.run(app.execute_generation_cached(
+            cache=cache, backend=backend, arguments=arguments, execution_mode="batch", request_id="test",
+            num_images=1, tenant=tenant, budgets=budgets, reservation=reservation
+        ))
+
+    # Upstream work: the reservation is replaced by the actual cost
+    generate(budgets.reserve(tenant, 0.5))
+    assert budgets.remaining(tenant) == pytest.approx(1.0 - app.DEFAULT_PRICE_PER_IMAGE)
+
+    # Cache hit: the reservation is released unspent
+    _, source = generate(budgets.reserve(tenant, 0.5))
+    assert source == "cache"
+    assert budgets.remaining(tenant) == pytest.approx(1.0 - app.DEFAULT_PRICE_PER_IMAGE)
+
+
+def test_jobs_reserve_their_estimated_cost_at_submit(monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "JOB_STORE_DB_PATH", str(tmp_path / "jobs.db"))
+    monkeypatch.setattr(app, "BUDGET_DB_PATH", str(tmp_path / "budgets.db"))
+    # Nothing spent yet, but three images cost more than the budget
+    monkeypatch.setattr(app, "BUDGETS_JSON", json.dumps({"key-a": 2 * app.DEFAULT_PRICE_PER_IMAGE}))
+    response = asyncio.run(post("/jobs", {
+        "inspiration_name": "creative_color_material",
+        "image_urls": ["https://example.com/a.jpg"],
+        "num_images": 3
+    }, headers={"x-api-key": "key-a"}))
+    assert response.status_code == 402
+    assert "request needs ~$0.1170" in response.json()["detail"]
+
+
+# ============================================================================
+# METRICS
+# ============================================================================
+
+def test_unknown_inspiration_names_collapse_in_metrics():
+    instance = app.StockInspirations(_allow_init=True)
+    asgi = instance._build_app()
+
+    async def run():
+        async with asgi.router.lifespan_context(asgi):
+            for name in ("made-up-1", "made-up-2"):
+                # A registry-backed app accepts any string name; validation rejects it later
+                job = app.InspirationInput(inspiration_name="marketplace_pure", image_urls=["https://example.com/a.jpg"])
+                job.inspiration_name = name
+                with pytest.raises(app.HTTPException):
+                    await instance._generate(job, "test")
+            return "\n".join(instance.metrics.render())
+
+    rendered = asyncio.run(run())
+    assert "made-up" not in rendered
+    assert 'inspiration="unknown"' in rendered
+
+
+def test_metrics_export_totals_as_counters():
+    rendered = asyncio.run(post("/metrics", {})).text
+    for name in (
+        "lane_preempted", "cache_lookups", "single_flight", "preflight", "mode_decisions",
+        "fal_requests", "jobs", "renditions", "budget_rejections"
+    ):
+        assert f"# TYPE stock_inspirations_{name}_total counter" in rendered
+        assert f"# TYPE stock_inspirations_{name} gauge" not in rendered
+    assert 'stock_inspirations_cache_lookups_total{result="hit"} 0' in rendered
+    assert "# TYPE stock_inspirations_admission_limit gauge" in rendered
+
+
+def test_execute_generation_builds_arguments_from_a_plan(monkeypatch):
+    backend = ScriptedBackend()
+    monkeypatch.setitem(app.MODEL_BACKENDS, backend.model_id, backend)
+    plan = app.compile_plan("marketplace_pure", app.INSPIRATIONS["marketplace_pure"])
+    images = asyncio.run(app.execute_generation(
+        plan.model, plan.prompt_template, ["https://example.com/a.jpg"], "4:5", "batch", "test", num_images=2
+    ))
+    assert len(images) == 2
+    expected = plan.arguments(["https://example.com/a.jpg"], plan.prompt_template, "4:5")
+    assert backend.arguments == [{**expected, "num_images": 2}]
+
+
+def test_unknown_models_are_rejected_without_registering(monkeypatch):
+    monkeypatch.setattr(app, "compile_plan", None)  # the ad-hoc path builds one template directly
+    with pytest.raises(ValueError, match="Unknown model: fal-ai/not-a-model"):
+        asyncio.run(app.execute_generation(
+            "fal-ai/not-a-model", "p", ["https://example.com/a.jpg"], None, "batch", "test", num_images=1
+        ))
+    assert "fal-ai/not-a-model" not in app.MODEL_BACKENDS
+
+
+# ============================================================================
+# RESULT CACHE
+# ============================================================================
+
+def test_cache_key_is_content_addressed():
+    key = app.generation_cache_key("m", {"prompt": "p", "image_urls": ["a"]}, 2)
+    assert key == app.generation_cache_key("m", {"image_urls": ["a"], "prompt": "p"}, 2)
+    assert key != app.generation_cache_key("m", {"prompt": "p", "image_urls": ["b"]}, 2)
+    assert key != app.generation_cache_key("m", {"prompt": "p", "image_urls": ["a"]}, 3)
+    assert key != app.generation_cache_key("other", {"prompt": "p", "image_urls": ["a"]}, 2)
+
+
+def test_result_cache_evicts_expires_and_persists(tmp_path):
+    images = [{"url": "https://cdn.local/0.png", "index": 0}]
+    cache = app.ResultCache(max_entries=1, db_path=str(tmp_path / "cache.db"))
+    cache.put("a", images)
+    cache.put("b", images)
+    assert list(cache._entries) == ["b"]
+    # Evicted from memory, still in SQLite; a fresh instance (restart) sees both
+    assert cache.get("a") == images
+    assert app.ResultCache(db_path=str(tmp_path / "cache.db")).get("b") == images
+
+    expired = app.ResultCache(ttl=0.0)
+    expired.put("a", images)
+    assert expired.get("a") is None
+    assert (cache.hits, expired.misses) == (1, 1)
+
+
+def test_cache_and_coalescing_ignore_execution_mode():
+    backend = ScriptedBackend()
+    arguments = {"prompt": "p", "image_urls": ["https://example.com/a.jpg"]}
+    cache = app.ResultCache()
+    single_flight = app.SingleFlight()
+
+    async def generate(mode):
+        return await app.execute_generation_cached(
+            cache=cache, single_flight=single_flight, backend=backend, arguments=arguments,
+            execution_mode=mode, request_id="test", num_images=2
+        )
+
+    async def run():
+        # Concurrent requests planned into different modes still share one generation
+        first, second = await asyncio.gather(generate("batch"), generate("parallel"))
+        third = await generate("parallel")
+        return first, second, third
+
+    (images, source), (coalesced, second_source), (cached, third_source) = asyncio.run(run())
+    assert (source, second_source, third_source) == ("generated", "coalesced", "cache")
+    assert images == coalesced == cached
+    assert backend.submitted == 1
+
+
+# ============================================================================
+# MODEL BACKENDS
+# ============================================================================
+
+def test_fake_backend_is_deterministic_for_a_seed():
+    def simulate(seed):
+        backend = app.FakeBackend(
+            app.PromptEditBackend("fal-ai/nano-banana/edit"),
+            latency_median=0.01, submit_latency=0.0, failure_rate=0.5, seed=seed
+        )
+
+        async def run():
+            handles = [await backend.submit({"num_images": 2}) for _ in range(20)]
+            outcomes = [(handle.latency, handle.fail) for handle in handles]
+            for handle in handles:
+                await handle.cancel()
+            return outcomes
+
+        return asyncio.run(run())
+
+    assert simulate(7) == simulate(7)
+    assert simulate(7) != simulate(8)
+    assert any(fail for _, fail in simulate(7)) and not all(fail for _, fail in simulate(7))
+
+
+def test_install_fake_backends_wraps_each_backend_once(monkeypatch):
+    monkeypatch.setattr(app, "MODEL_BACKENDS", dict(app.MODEL_BACKENDS))
+    qwen = app.MODEL_BACKENDS["fal-ai/qwen-image-edit-plus-lora-gallery/multiple-angles"]
+    app.install_fake_backends(seed=1)
+    app.install_fake_backends(seed=1)
+    fake = app.MODEL_BACKENDS[qwen.model_id]
+    assert isinstance(fake, app.FakeBackend) and fake.wrapped is qwen
+    # Arguments and costs still come from the real backend
+    assert not fake.uses_prompt
+    assert fake.argument_template("16:9") == qwen.argument_template("16:9")
+
+
+def test_qwen_draft_is_half_size_with_or_without_aspect_ratio():
+    backend = app.QwenMultipleAnglesBackend("fal-ai/qwen-image-edit-plus-lora-gallery/multiple-angles")
+    draft = backend.argument_template(None, quality="draft")
+    standard = backend.argument_template(None, quality="standard")
+    assert draft["image_size"] == {"width": 512, "height": 512}
+    assert "image_size" not in standard
+    assert backend.argument_template("16:9", quality="draft")["image_size"] == {"width": 960, "height": 544}
+
+    # Cost follows the effective size: a quarter of the pixels at 12 of 30 steps
+    ratio = backend.estimate_cost(draft) / backend.estimate_cost(standard)
+    assert ratio == pytest.approx(0.25 * 12 / 30)
+
+
+# ============================================================================
+# INSPIRATION REGISTRY
+# ============================================================================
+
+def test_yaml_registry_loads(tmp_path):
+    (tmp_path / "extra.yaml").write_text(
+        "inspirations:\n"
+        "  yaml_pure:\n"
+        "    name: YAML Pure\n"
+        "    category: YAML\n"
+        "    description: Loaded from YAML\n"
+        "    prompt_template: Place the product on white\n"
+        "    min_images: 1\n"
+        "    max_images: 2\n"
+    )
+    registry = app.load_registry(str(tmp_path))
+    assert list(registry.plans) == ["yaml_pure"]
+    assert dict(registry.categories) == {"YAML": ("yaml_pure",)}
+
+
+def test_registry_reload_swaps_plans_and_keeps_them_on_a_broken_file(monkeypatch, tmp_path):
+    registry_file = tmp_path / "inspirations.json"
+
+    def write(prompt):
+        config = {**app.INSPIRATIONS["marketplace_pure"], "prompt_template": prompt}
+        registry_file.write_text(json.dumps({"marketplace_pure": config}))
+
+    write("first prompt")
+    monkeypatch.setattr(app, "INSPIRATIONS_REGISTRY_PATH", str(registry_file))
+    monkeypatch.setattr(app, "REGISTRY_POLL_INTERVAL", 0)
+    backend = ScriptedBackend()
+    monkeypatch.setitem(app.MODEL_BACKENDS, backend.model_id, backend)
+    job = {
+        "inspiration_name": "marketplace_pure",
+        "image_urls": ["https://example.com/a.jpg"],
+        "num_images": 1,
+        "validate_images": False,
+        "use_cache": False
+    }
+
+    async def run():
+        asgi = app.StockInspirations(_allow_init=True)._build_app()
+        async with asgi.router.lifespan_context(asgi):
+            transport = httpx.ASGITransport(app=asgi)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                await client.post("/", json=job)
+                write("second prompt")
+                reloaded = await client.post("/registry/reload", json={})
+                await client.post("/", json=job)
+                registry_file.write_text("{not json")
+                broken = await client.post("/registry/reload", json={})
+                served = await client.post("/", json=job)
+                return reloaded, broken, served
+
+    reloaded, broken, served = asyncio.run(run())
+    assert reloaded.status_code == 200 and reloaded.json()["changed"]
+    assert broken.status_code == 400
+    assert "Cannot parse registry file" in broken.json()["detail"]
+    assert served.status_code == 200
+    assert [arguments["prompt"] for arguments in backend.arguments] == ["first prompt", "second prompt", "second prompt"]
+
+
+def test_validate_reports_every_problem_in_one_pass():
+    registry = app.load_registry(None)
+    errors = registry.validate(
+        "fashion_backshot",
+        ["ftp://example.com/a.jpg", "ftp://example.com/a.jpg"] * 3,
+        extra_prompt="x" * (app.MAX_EXTRA_PROMPT_CHARS + 1)
+    )
+    assert errors == [
+        "Inspiration 'fashion_backshot' requires 2-5 images, but 6 were provided",
+        *["Unsupported image URL 'ftp://example.com/a.jpg': use http(s):// or data:image/ URLs"] * 6,
+        "image_urls contains duplicate URLs",
+        f"extra_prompt is {app.MAX_EXTRA_PROMPT_CHARS + 1} characters (max {app.MAX_EXTRA_PROMPT_CHARS})"
+    ]
+    assert registry.validate("nope", [])[0].startswith("Unknown inspiration: nope. Available: free_editing, ")
+    assert registry.validate("fashion_backshot", ["https://example.com/a.jpg", "https://example.com/b.jpg"]) == []
+
+
+def test_invalid_requests_fail_before_any_upstream_work(monkeypatch):
+    backend = ScriptedBackend()
+    monkeypatch.setitem(app.MODEL_BACKENDS, backend.model_id, backend)
+    response = asyncio.run(post("/", {
+        "inspiration_name": "fashion_backshot",
+        "image_urls": ["https://example.com/a.jpg", "https://example.com/a.jpg"]
+    }))
+    assert response.status_code == 400
+    assert response.json()["detail"] == "image_urls contains duplicate URLs"
+    assert backend.submitted == 0
+
+
+@pytest.mark.parametrize("override, message", [
+    ({"min_images": 3, "max_images": 2}, "invalid image range"),
+    ({"execution_mode": "sideways"}, "does not match the schema"),
+    ({"model": "fal-ai/not-a-model"}, "Unknown model")
+])
+def test_bad_registry_configs_fail_at_load(override, message):
+    config = {**app.INSPIRATIONS["marketplace_pure"], **override}
+    with pytest.raises(ValueError, match=message):
+        app.build_registry({"broken": config}, source="test")
+
+
+# ============================================================================
+# INPUT PREFLIGHT
+# ============================================================================
+
+def png_bytes(width, height):
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+async def fake_resolve(host, port):
+    return {
+        "cdn.example.com": ["93.184.216.34"],
+        "internal.example.com": ["10.0.0.5"],
+        "mixed.example.com": ["93.184.216.34", "127.0.0.1"],
+        "mapped.example.com": ["::ffff:127.0.0.1"]
+    }.get(host, [host])
+
+
+def test_preflight_only_fetches_public_addresses():
+    pytest.importorskip("PIL")
+    image = png_bytes(256, 256)
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if request.url.path == "/redirect":
+            return httpx.Response(302, headers={"location": "http://169.254.169.254/latest/meta-data"})
+        return httpx.Response(200, content=image, headers={"content-type": "image/png"})
+
+    transport = app.PublicAddressTransport(httpx.MockTransport(handler), resolve=fake_resolve)
+    preflight = app.ImagePreflight(httpx.AsyncClient(transport=transport))
+
+    result = asyncio.run(preflight.check("https://cdn.example.com/a.png"))
+    assert (result.width, result.height) == (256, 256)
+    assert {request.url.host for request in requests} == {"93.184.216.34"}
+    assert requests[0].headers["host"] == "cdn.example.com"
+    assert requests[0].extensions["sni_hostname"] == "cdn.example.com"
+
+    requests.clear()
+    for url in [
+        "http://internal.example.com/a.png",
+        "http://mixed.example.com/a.png",
+        "http://mapped.example.com/a.png",
+        "http://127.0.0.1:8080/a.png",
+        "http://169.254.169.254/latest/meta-data",
+        "http://[::1]/a.png"
+    ]:
+        with pytest.raises(ValueError, match="not a public address"):
+            asyncio.run(preflight.check(url))
+    assert requests == []
+
+    # Redirect hops are checked too
+    with pytest.raises(ValueError, match="169.254.169.254 is not a public address"):
+        asyncio.run(preflight.check("https://cdn.example.com/redirect"))
+    assert [request.url.path for request in requests] == ["/redirect"]
+
+    with pytest.raises(ValueError, match="not an http"):
+        asyncio.run(preflight.check("file:///etc/passwd"))
+
+
+def test_rehost_upload_failure_is_a_502(monkeypatch):
+    pytest.importorskip("PIL")
+    image = png_bytes(app.PREFLIGHT_MAX_DIMENSION + 100, 100)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=image, headers={"content-type": "image/png"})
+
+    async def failing_upload(data, content_type):
+        raise RuntimeError("storage unavailable")
+
+    backend = ScriptedBackend()
+    monkeypatch.setitem(app.MODEL_BACKENDS, backend.model_id, backend)
+    monkeypatch.setattr(app, "resolve_host", fake_resolve)
+    monkeypatch.setattr(app.httpx, "AsyncHTTPTransport", lambda **kwargs: httpx.MockTransport(handler))
+    monkeypatch.setattr(app, "fal_upload", failing_upload)
+    response = asyncio.run(post("/", {
+        "inspiration_name": "creative_color_material",
+        "image_urls": ["https://cdn.example.com/large.png"],
+        "use_cache": False
+    }))
+    assert response.status_code == 502
+    assert "Could not re-host" in response.json()["detail"]
+    assert backend.submitted == 0
+
+
+def test_preflight_cache_skips_the_round_trip(monkeypatch):
+    pytest.importorskip("PIL")
+    image = png_bytes(256, 256)
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request.method)
+        return httpx.Response(200, content=image, headers={"content-type": "image/png", "etag": '"v1"'})
+
+    preflight = app.ImagePreflight(httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    url = "https://cdn.example.com/a.png"
+    asyncio.run(preflight.check(url))
+    assert requests == ["HEAD", "GET"]
+
+    asyncio.run(preflight.check(url))
+    assert requests == ["HEAD", "GET"]
+    assert preflight.cache_hits == 1
+
+    # Past the TTL: one HEAD revalidates the unchanged ETag
+    monkeypatch.setattr(app, "PREFLIGHT_CACHE_TTL", 0.0)
+    asyncio.run(preflight.check(url))
+    assert requests == ["HEAD", "GET", "HEAD"]
+    assert preflight.cache_hits == 2
+
+
+def test_rehost_download_is_capped_without_content_length(monkeypatch):
+    pytest.importorskip("PIL")
+    header = png_bytes(app.PREFLIGHT_MAX_DIMENSION + 100, 100)
+    monkeypatch.setattr(app, "PREFLIGHT_MAX_BYTES", 1024 * 1024)
+
+    async def endless():
+        yield header
+        while True:
+            yield b"\0" * 65536
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.method == "HEAD":
+            return httpx.Response(200, headers={"content-type": "image/png"})
+        if "range" in request.headers:
+            return httpx.Response(206, content=header, headers={"content-type": "image/png"})
+        return httpx.Response(200, content=endless(), headers={"content-type": "image/png"})
+
+    preflight = app.ImagePreflight(httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    with pytest.raises(ValueError, match="is over 1 MB"):
+        asyncio.run(preflight.check("https://cdn.example.com/endless.png"))
+
+
+# ============================================================================
+# OUTPUT RENDITIONS
+# ============================================================================
+
+def test_renditions_skip_upscales_and_flatten_alpha_for_jpeg():
+    Image = pytest.importorskip("PIL.Image")
+    buffer = io.BytesIO()
+    Image.new("RGBA", (400, 300), (255, 0, 0, 128)).save(buffer, format="PNG")
+
+    renditions = app.encode_renditions(buffer.getvalue(), "jpeg", 80, [1000, 200, 100], include_original=True)
+
+    # 1000px would upscale the 400px original, so it is dropped without an error
+    assert [(label, width, height) for label, _, width, height in renditions] == [
+        ("original", 400, 300), ("200", 200, 150), ("100", 100, 75)
+    ]
+    for _, data, width, height in renditions:
+        decoded = Image.open(io.BytesIO(data))
+        assert (decoded.format, decoded.mode, decoded.size) == ("JPEG", "RGB", (width, height))
+
+
+# ============================================================================
+# DIVERSITY GUARD
+# ============================================================================
+
+def test_perceptual_hash_matches_blurred_and_resized_copies_but_not_mirrors():
+    pytest.importorskip("numpy")
+    Image = pytest.importorskip("PIL.Image")
+    from PIL import ImageDraw, ImageFilter
+
+    image = Image.new("RGB", (256, 256), "white")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((20, 30, 120, 200), fill="navy")
+    draw.ellipse((150, 40, 240, 130), fill="orange")
+    draw.polygon([(140, 250), (250, 160), (250, 250)], fill="green")
+    variants = [
+        image,
+        image.filter(ImageFilter.GaussianBlur(2)),
+        image.resize((128, 128)),
+        image.transpose(Image.FLIP_LEFT_RIGHT)
+    ]
+
+    def encode(img):
+        buffer = io.BytesIO()
+        img.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    hashes = app.perceptual_hashes([encode(variant) for variant in variants])
+    distances = app.hamming_distances(hashes, hashes)[0]
+    assert list(distances[:3]) == [0, 0, 0]
+    assert distances[3] > app.DIVERSITY_MAX_DISTANCE
+    assert app.near_duplicates(hashes) == [None, 0, 0, None]